@@ -0,0 +1,162 @@
+"""Attachment stores for in-memory Trials
+
+A Trials object's `attachments` is a dict-like mapping of names to blobs
+(strings). A plain dict keeps every blob in the driver's memory, which is
+too much when trials attach e.g. model snapshots. SpillingAttachments keeps
+the most recently written blobs in memory, up to a budget in bytes, and
+spills the rest to files that are memory-mapped when read back.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import collections
+import errno
+import mmap
+import os
+import shutil
+import tempfile
+
+
+class SpillingAttachments(collections.MutableMapping):
+    """Dict of attachments that holds at most `memory_budget` bytes of
+    blobs in memory, evicting the least recently used ones to files in
+    `spill_dir` (a temporary directory by default).
+
+    Reading a spilled blob returns a copy of it, which is not kept: the
+    blob stays on disk, and does not count toward the budget. mmap(name)
+    gives access to a spilled blob without copying it.
+
+    Values that are not strings are kept in memory, and do not count
+    toward the budget.
+    """
+    def __init__(self, memory_budget, spill_dir=None):
+        self.memory_budget = memory_budget
+        self._own_spill_dir = spill_dir is None
+        self.spill_dir = spill_dir
+        # -- name -> value, least recently used first
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        # -- name -> path of the file holding the value
+        self._spilled = {}
+
+    def __getstate__(self):
+        return {'memory_budget': self.memory_budget,
+                'spill_dir': None if self._own_spill_dir else self.spill_dir,
+                'items': dict(self.items())}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['memory_budget'], dct['spill_dir'])
+        self.update(dct['items'])
+
+    def __del__(self):
+        if getattr(self, '_own_spill_dir', False) and self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    @property
+    def memory_bytes(self):
+        """Bytes of blobs held in memory"""
+        return self._memory_bytes
+
+    def _size(self, value):
+        if isinstance(value, str):
+            return len(value)
+        return 0
+
+    def _spill(self, name, value):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='hyperopt_attachments_')
+        elif not os.path.isdir(self.spill_dir):
+            os.makedirs(self.spill_dir)
+        fd, path = tempfile.mkstemp(suffix='.blob', dir=self.spill_dir)
+        fh = os.fdopen(fd, 'wb')
+        try:
+            fh.write(value)
+        finally:
+            fh.close()
+        self._spilled[name] = path
+
+    def _unspill(self, name):
+        path = self._spilled.pop(name, None)
+        if path is not None:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _remember(self, name, value):
+        """Put `value` in memory as the most recently used, and evict
+        the least recently used values to stay within the budget"""
+        self._memory[name] = value
+        self._memory_bytes += self._size(value)
+        while self._memory_bytes > self.memory_budget:
+            for old_name, old_value in self._memory.iteritems():
+                if self._size(old_value):
+                    break
+            else:
+                break
+            del self._memory[old_name]
+            self._memory_bytes -= self._size(old_value)
+            self._spill(old_name, old_value)
+
+    def mmap(self, name):
+        """Return a read-only memory map of the spilled blob `name`, or
+        None if it is held in memory"""
+        if name in self._memory or name not in self._spilled:
+            if name not in self:
+                raise KeyError(name)
+            return None
+        fh = open(self._spilled[name], 'rb')
+        try:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+
+    def __getitem__(self, name):
+        if name in self._memory:
+            # -- now the most recently used
+            value = self._memory.pop(name)
+            self._memory[name] = value
+            return value
+        if name not in self._spilled:
+            raise KeyError(name)
+        if os.path.getsize(self._spilled[name]) == 0:
+            return ''  # -- mmap cannot map an empty file
+        mm = self.mmap(name)
+        try:
+            return mm[:]
+        finally:
+            mm.close()
+
+    def __setitem__(self, name, value):
+        if name in self:
+            del self[name]
+        if self._size(value) > self.memory_budget:
+            self._spill(name, value)
+        else:
+            self._remember(name, value)
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        if name in self._memory:
+            self._memory_bytes -= self._size(self._memory.pop(name))
+        self._unspill(name)
+
+    def __contains__(self, name):
+        return name in self._memory or name in self._spilled
+
+    def __iter__(self):
+        return iter(set(self._memory).union(self._spilled))
+
+    def __len__(self):
+        return len(set(self._memory).union(self._spilled))
+
+    def clear(self):
+        """Remove all attachments, and their spill files"""
+        for name in self._spilled.keys():
+            self._unspill(name)
+        self._memory.clear()
+        self._memory_bytes = 0
@@ -30,12 +30,15 @@ __authors__   = "James Bergstra"
 __license__   = "3-clause BSD License"
 __contact__   = "github.com/jaberg/hyperopt"
 
+import collections
 import copy
 import hashlib
+import itertools
 import logging
 import time
 import datetime
 import sys
+import threading
 
 import numpy as np
 
@@ -46,7 +49,8 @@ import pyll
 from pyll import scope
 from pyll.stochastic import recursive_set_rng_kwarg
 
-from .utils import pmin_sampled
+from .attachments import SpillingAttachments
+from .utils import pmin_analytic
 from .vectorize import VectorizeHelper
 from .vectorize import pretty_names
 from .vectorize import replace_repeat_stochastic
@@ -120,47 +124,92 @@ def StopExperiment(*args, **kwargs):
 
 
 def SONify(arg, memo=None):
+    """Return a copy of `arg` made of types that bson can encode.
+
+    This works with an explicit stack rather than recursion, so that deeply
+    nested or very long results are cheap to convert. Numeric ndarrays are
+    converted in bulk with ndarray.tolist(). Sub-structures that are shared
+    (by id) within `arg` are converted once, and shared in the return value.
+    """
     if memo is None:
         memo = {}
-    if id(arg) in memo:
-        rval = memo[id(arg)]
-    if isinstance(arg, ObjectId):
-        rval = arg
-    elif isinstance(arg, datetime.datetime):
-        rval = arg
-    elif isinstance(arg, np.floating):
-        rval = float(arg)
-    elif isinstance(arg, np.integer):
-        rval = int(arg)
-    elif isinstance(arg, (list, tuple)):
-        rval = type(arg)([SONify(ai, memo) for ai in arg])
-    elif isinstance(arg, dict):
-        rval = dict([(SONify(k, memo), SONify(v, memo))
-            for k, v in arg.items()])
-    elif isinstance(arg, (basestring, float, int, type(None))):
-        rval = arg
-    elif isinstance(arg, np.ndarray):
-        if arg.ndim == 0:
-            rval = SONify(arg.sum())
+    # -- memo maps id(obj) -> (obj, rval); obj is kept so its id stays valid
+    top = [None]
+    # -- each frame means: dst[key] = SONify(obj)
+    stack = [(arg, top, 0)]
+    while stack:
+        frame = stack.pop()
+        if frame[0] is _SONify_finish:
+            _, obj, items, dst, key = frame
+            rval = type(obj)(items)
+            memo[id(obj)] = (obj, rval)
+            dst[key] = rval
+            continue
+        obj, dst, key = frame
+        if type(obj) in _SONify_atoms:
+            dst[key] = obj
+        elif id(obj) in memo:
+            dst[key] = memo[id(obj)][1]
+        elif isinstance(obj, (ObjectId, datetime.datetime)):
+            dst[key] = obj
+        elif isinstance(obj, np.floating):
+            dst[key] = float(obj)
+        elif isinstance(obj, np.integer):
+            dst[key] = int(obj)
+        elif isinstance(obj, dict):
+            rval = dst[key] = {}
+            memo[id(obj)] = (obj, rval)
+            for k, v in obj.iteritems():
+                stack.append((v, rval, SONify(k, memo)))
+        elif isinstance(obj, (list, tuple)):
+            items = [None] * len(obj)
+            if type(obj) is list:
+                dst[key] = items
+                memo[id(obj)] = (obj, items)
+            else:
+                # -- build tuples (and list subclasses) once items are done
+                stack.append((_SONify_finish, obj, items, dst, key))
+            for ii, oi in enumerate(obj):
+                stack.append((oi, items, ii))
+        elif isinstance(obj, (basestring, float, int, type(None))):
+            dst[key] = obj
+        elif isinstance(obj, np.ndarray):
+            kind = obj.dtype.kind
+            if kind in 'iuf':
+                rval = obj.tolist()
+            elif kind == 'b':
+                rval = obj.astype('int').tolist()
+            else:
+                stack.append((obj.tolist(), dst, key))
+                continue
+            memo[id(obj)] = (obj, rval)
+            dst[key] = rval
+        # -- put this after ndarray because ndarray not hashable
+        elif obj in (True, False):
+            dst[key] = int(obj)
         else:
-            rval = map(SONify, arg) # N.B. memo None
-    # -- put this after ndarray because ndarray not hashable
-    elif arg in (True, False):
-        rval = int(arg)
-    else:
-        raise TypeError('SONify', arg)
-    memo[id(rval)] = rval
-    return rval
+            raise TypeError('SONify', obj)
+    return top[0]
+
+
+# -- types that SONify returns as-is, checked before anything else
+_SONify_atoms = set([str, unicode, float, int, bool, type(None)])
+
+# -- stack marker used by SONify
+_SONify_finish = object()
 
 
 def miscs_update_idxs_vals(miscs, idxs, vals, assert_all_vals_used=True,
-                          idxs_map=None):
+                          idxs_map=None, compact=False):
     """
     Unpack the idxs-vals format into the list of dictionaries that is
     `misc`.
 
     idxs_map: a dictionary of id->id mappings so that the misc['idxs'] can
         contain different numbers than the idxs argument. XXX CLARIFY
+
+    compact: write the compact misc format (see compact_misc) instead of
+        one-element and empty lists.
     """
     if idxs_map is None:
         idxs_map = {}
@@ -180,32 +229,81 @@ def miscs_update_idxs_vals(miscs, idxs, vals, assert_all_vals_used=True,
         assert all_ids == set(misc_by_id.keys())
 
     for tid, misc_tid in misc_by_id.items():
-        misc_tid['idxs'] = {}
+        if compact:
+            misc_tid['idxs'] = None
+        else:
+            misc_tid['idxs'] = {}
         misc_tid['vals'] = {}
         for node_id in idxs:
             node_idxs = map(imap, idxs[node_id])
             node_vals = vals[node_id]
             if tid in node_idxs:
                 pos = node_idxs.index(tid)
-                misc_tid['idxs'][node_id] = [tid]
-                misc_tid['vals'][node_id] = [node_vals[pos]]
+                if compact:
+                    misc_tid['vals'][node_id] = node_vals[pos]
+                else:
+                    misc_tid['idxs'][node_id] = [tid]
+                    misc_tid['vals'][node_id] = [node_vals[pos]]
 
                 # -- assert that tid occurs only once
                 assert tid not in node_idxs[pos+1:]
-            else:
+            elif not compact:
                 misc_tid['idxs'][node_id] = []
                 misc_tid['vals'][node_id] = []
     return miscs
 
 
+def compact_misc(misc):
+    """Return a copy of `misc` in the compact format
+
+    In the compact format misc['idxs'] is None, and misc['vals'] maps each
+    *active* node id to its value (not to a one-element list). The idxs are
+    implied by misc['tid']. Inactive nodes do not appear at all.
+
+    miscs_to_idxs_vals and miscs_update_idxs_vals understand both formats.
+    """
+    rval = dict(misc)
+    if misc['idxs'] is not None:
+        rval['idxs'] = None
+        rval['vals'] = dict([(node_id, node_vals[0])
+            for node_id, node_vals in misc['vals'].items()
+            if node_vals])
+    return rval
+
+
+def miscs_node_ids(miscs):
+    """Return the node ids that appear in the idxs/vals of `miscs`
+
+    For miscs in the full format, this is the keys of the first one's idxs.
+    Compact miscs only list active nodes, so they are all consulted.
+    """
+    if len(miscs) == 0:
+        raise ValueError('cannot infer keys from empty miscs')
+    if miscs[0]['idxs'] is not None:
+        return miscs[0]['idxs'].keys()
+    keys = set()
+    for misc in miscs:
+        if misc['idxs'] is not None:
+            keys.update(misc['idxs'])
+        elif misc['vals']:
+            keys.update(misc['vals'])
+    return list(keys)
+
+
 def miscs_to_idxs_vals(miscs, keys=None):
     if keys is None:
-        if len(miscs) == 0:
-            raise ValueError('cannot infer keys from empty miscs')
-        keys = miscs[0]['idxs'].keys()
+        keys = miscs_node_ids(miscs)
     idxs = dict([(k, []) for k in keys])
     vals = dict([(k, []) for k in keys])
     for misc in miscs:
+        if misc['idxs'] is None:
+            # -- compact format
+            tid = misc['tid']
+            for node_id, val in (misc['vals'] or {}).iteritems():
+                if node_id in idxs:
+                    idxs[node_id].append(tid)
+                    vals[node_id].append(val)
+            continue
         for node_id in idxs:
             t_idxs = misc['idxs'][node_id]
             t_vals = misc['vals'][node_id]
@@ -216,6 +314,269 @@ def miscs_to_idxs_vals(miscs, keys=None):
     return idxs, vals
 
 
+def _merged_dtype(dtype, values):
+    """Return a dtype that can represent both `dtype` and `values`"""
+    new = np.asarray(values).dtype
+    if dtype.kind == 'O' or new.kind not in 'biuf':
+        return np.dtype(object)
+    return np.promote_types(dtype, new)
+
+
+class TrialColumns(object):
+    """Dense, column-oriented view of the idxs/vals of a list of trials.
+
+    Attributes (all aligned with `tids`, i.e. one entry per trial):
+        tids   - array of trial ids
+        vals   - dictionary mapping node id -> array of values
+        active - dictionary mapping node id -> bool array, True where the
+                 node was active (had a value) in the corresponding trial.
+
+    Entries of vals[nid] where active[nid] is False are meaningless.
+
+    Integer-valued nodes (e.g. randint) get integer columns, other numeric
+    nodes get float columns.  Columns are grown in place with amortized
+    doubling, so `extend` costs O(len(miscs)).
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self._n = 0
+        self._tids = np.zeros(0, dtype='int64')
+        self._vals = dict([(k, np.zeros(0, dtype='int64'))
+            for k in self.keys])
+        self._active = dict([(k, np.zeros(0, dtype='bool'))
+            for k in self.keys])
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def tids(self):
+        return self._tids[:self._n]
+
+    @property
+    def vals(self):
+        return dict([(k, v[:self._n]) for k, v in self._vals.items()])
+
+    @property
+    def active(self):
+        return dict([(k, v[:self._n]) for k, v in self._active.items()])
+
+    def _reserve(self, n):
+        cap = len(self._tids)
+        if n <= cap:
+            return
+        cap = max(n, 2 * cap, 16)
+
+        def grow(arr):
+            rval = np.zeros(cap, dtype=arr.dtype)
+            rval[:self._n] = arr[:self._n]
+            return rval
+        self._tids = grow(self._tids)
+        for k in self.keys:
+            self._vals[k] = grow(self._vals[k])
+            self._active[k] = grow(self._active[k])
+
+    def _store(self, col, rows, values):
+        dtype = _merged_dtype(col.dtype, values)
+        if dtype != col.dtype:
+            col = col.astype(dtype)
+        if dtype.kind == 'O':
+            for row, value in zip(rows, values):
+                col[row] = value
+        else:
+            col[rows] = values
+        return col
+
+    def add_keys(self, keys):
+        """Add columns for node ids not already present (inactive in all
+        existing rows)"""
+        for k in keys:
+            if k not in self._vals:
+                self.keys.append(k)
+                self._vals[k] = np.zeros(len(self._tids), dtype='int64')
+                self._active[k] = np.zeros(len(self._tids), dtype='bool')
+
+    def extend(self, miscs):
+        """Append one row per misc document"""
+        n0 = self._n
+        n1 = n0 + len(miscs)
+        if n1 == n0:
+            return
+        self._reserve(n1)
+        self._tids = self._store(self._tids, range(n0, n1),
+                [misc['tid'] for misc in miscs])
+        for k in self.keys:
+            rows = []
+            values = []
+            for ii, misc in enumerate(miscs):
+                m_vals = misc['vals'] or {}
+                if misc['idxs'] is None:
+                    # -- compact format
+                    if k in m_vals:
+                        rows.append(n0 + ii)
+                        values.append(m_vals[k])
+                else:
+                    t_vals = m_vals.get(k)
+                    if t_vals:
+                        rows.append(n0 + ii)
+                        values.append(t_vals[0])
+            active = self._active[k]
+            active[n0:n1] = False
+            if rows:
+                active[rows] = True
+                self._vals[k] = self._store(self._vals[k], rows, values)
+        self._n = n1
+
+
+class LossColumns(object):
+    """Per-trial loss information, as arrays aligned with Trials.trials.
+
+    Attributes:
+        loss          - float array of bandit.loss, nan where it is None
+        has_loss      - bool array, False where bandit.loss is None
+        loss_variance - float array of bandit.loss_variance
+        true_loss     - float array of bandit.true_loss
+        status        - object array of bandit.status strings
+        final         - bool array, True for trials in JOB_STATE_DONE
+
+    loss_variance and true_loss are nan unless status is STATUS_OK.  Rows
+    of final trials are computed once; the others (NEW and RUNNING trials,
+    which are pending) are recomputed by `update`.  Like TrialColumns, the
+    arrays are grown in place with amortized doubling.
+    """
+    _fields = ('loss', 'has_loss', 'loss_variance', 'true_loss', 'status',
+            'final')
+    _dtypes = ('float', 'bool', 'float', 'float', 'object', 'bool')
+
+    def __init__(self):
+        self._n = 0
+        self._arrays = dict([(name, np.zeros(0, dtype=dtype))
+            for name, dtype in zip(self._fields, self._dtypes)])
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def loss(self):
+        return self._arrays['loss'][:self._n]
+
+    @property
+    def has_loss(self):
+        return self._arrays['has_loss'][:self._n]
+
+    @property
+    def loss_variance(self):
+        return self._arrays['loss_variance'][:self._n]
+
+    @property
+    def true_loss(self):
+        return self._arrays['true_loss'][:self._n]
+
+    @property
+    def status(self):
+        return self._arrays['status'][:self._n]
+
+    @property
+    def final(self):
+        return self._arrays['final'][:self._n]
+
+    def _reserve(self, n):
+        cap = len(self._arrays['loss'])
+        if n <= cap:
+            return
+        cap = max(n, 2 * cap, 16)
+        for name, arr in self._arrays.items():
+            rval = np.zeros(cap, dtype=arr.dtype)
+            rval[:self._n] = arr[:self._n]
+            self._arrays[name] = rval
+
+    @staticmethod
+    def _compute(docs, bandit):
+        results = [tt['result'] for tt in docs]
+        specs = [tt['spec'] for tt in docs]
+        nan = float('nan')
+        status = np.empty(len(docs), dtype='object')
+        status[:] = map(bandit.status, results, specs)
+        ok = status == STATUS_OK
+        if _bandit_uses_default(bandit, 'loss'):
+            losses = [r.get('loss') for r in results]
+        else:
+            losses = map(bandit.loss, results, specs)
+        has_loss = np.asarray([l is not None for l in losses], dtype='bool')
+        loss = np.asarray([nan if l is None else l for l in losses],
+                dtype='float')
+        if _bandit_uses_default(bandit, 'loss_variance'):
+            loss_variance = np.where(ok, 0.0, nan)
+        else:
+            loss_variance = np.asarray(
+                    [bandit.loss_variance(r, s) if o else nan
+                        for r, s, o in zip(results, specs, ok)],
+                    dtype='float')
+        if _bandit_uses_default(bandit, 'true_loss'):
+            true_loss = np.where(ok, loss, nan)
+        else:
+            true_loss = np.asarray(
+                    [bandit.true_loss(r, s) if o else nan
+                        for r, s, o in zip(results, specs, ok)],
+                    dtype='float')
+        final = np.asarray([tt['state'] == JOB_STATE_DONE for tt in docs],
+                dtype='bool')
+        return loss, has_loss, loss_variance, true_loss, status, final
+
+    def extend(self, docs, bandit):
+        """Append one row per trial document"""
+        if docs:
+            n = self._n + len(docs)
+            self._reserve(n)
+            for name, arr in zip(self._fields, self._compute(docs, bandit)):
+                self._arrays[name][self._n:n] = arr
+            self._n = n
+
+    def update(self, trials, bandit):
+        """Recompute the rows of non-final trials (of list `trials`)"""
+        rows = np.where(~self.final)[0]
+        if len(rows):
+            docs = [trials[ii] for ii in rows.tolist()]
+            for name, arr in zip(self._fields, self._compute(docs, bandit)):
+                getattr(self, name)[rows] = arr
+
+
+def _bandit_uses_default(bandit, name):
+    """Return True if bandit.<name> is the Bandit base class method
+
+    (Not if a subclass overrides it, nor if it is set on the instance.)
+    """
+    method = getattr(bandit, name)
+    return (getattr(method, 'im_func', None)
+            is getattr(Bandit, name).im_func)
+
+
+class ChangeSignal(object):
+    """Counts changes to a Trials object, so that threads can wait for them
+
+    Not pickled: unpickling makes a new ChangeSignal.
+    """
+    def __init__(self):
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def __reduce__(self):
+        return (ChangeSignal, ())
+
+    def notify(self):
+        with self.cond:
+            self.count += 1
+            self.cond.notify_all()
+
+    def wait(self, count, timeout):
+        """Wait at most `timeout` seconds for self.count to differ from
+        `count`, return True if it does"""
+        with self.cond:
+            if self.count == count:
+                self.cond.wait(timeout)
+            return self.count != count
+
+
 class InvalidTrial(Exception):
     pass
 
@@ -230,28 +591,110 @@ class Trials(object):
                     to either [] or [tid]
         - vals:  sub-document mapping stochastic node names
                     to either [] or [<val>]
+
+    Documents that have been inserted should be modified with
+    self.update_trial(), so that refresh() can keep self.trials up to date
+    incrementally.
     """
 
     async = False
 
+    # -- incremented whenever self._trials changes other than by appending
+    _trials_epoch = 0
+
+    # -- True if _insert_trial_docs encodes the docs itself, raising (before
+    #    inserting any) on docs that cannot be encoded; validation then
+    #    leaves the encoding to it
+    _insert_checks_encoding = False
+
+    # -- if not None, keep at most this many bytes of attachments in memory,
+    #    spilling the rest to files in attachments_spill_dir
+    #    (default: a temporary directory)
+    attachments_memory_budget = None
+    attachments_spill_dir = None
+
+    # -- FIFO of inserted trials that were in JOB_STATE_NEW when inserted
+    #    or last updated, for next_new_trial() (None for backends that
+    #    do not keep one)
+    _new_queue = None
+
+    # -- ChangeSignal notified of state changes made by update_trial
+    #    (None for backends that are updated by other processes)
+    _change_signal = None
+
+    # -- cache for self.tid_index()
+    _tid_index = None
+    _tid_index_epoch = None
+    _tid_index_len = 0
+
+    # -- cache for self.loss_columns()
+    _loss_columns = None
+    _loss_columns_epoch = None
+    _loss_columns_key = None
+
+    # -- cache for self.columns()
+    _columns = None
+    _columns_epoch = None
+
+    # -- cache for self.idxs and self.vals
+    _idxs_vals = None
+    _idxs_vals_epoch = None
+    _idxs_vals_len = 0
+
     def __init__(self, exp_key=None, refresh=True):
         self._ids = set()
         self._dynamic_trials = []
+        # -- (doc, old_state, new_state) for every state change of an
+        #    inserted document into or out of JOB_STATE_ERROR
+        self._error_log = []
+        # -- state -> count, and (exp_key, state) -> count, over all
+        #    inserted documents
+        self._state_counts = {}
+        self._new_queue = collections.deque()
+        self._change_signal = ChangeSignal()
         self._exp_key = exp_key
-        self.attachments = {}
+        self.attachments = self._new_attachments()
         if refresh:
             self.refresh()
 
+    def _new_attachments(self):
+        if self.attachments_memory_budget is None:
+            return {}
+        return SpillingAttachments(self.attachments_memory_budget,
+                self.attachments_spill_dir)
+
     def view(self, exp_key=None, refresh=True):
         rval = object.__new__(self.__class__)
         rval._exp_key = exp_key
         rval._ids = self._ids
         rval._dynamic_trials = self._dynamic_trials
+        rval._error_log = self._error_log
+        rval._state_counts = self._state_counts
+        rval._new_queue = self._new_queue
+        rval._change_signal = self._change_signal
         rval.attachments = self.attachments
         if refresh:
             rval.refresh()
         return rval
 
+    def snapshot(self):
+        """Return a Trials whose trials are those of self.trials now
+
+        For reading only (e.g. by a BanditAlgo in another thread): the list
+        is copied, but the documents are shared, so updates to them show
+        through. Costs no more than copying the list.
+        """
+        docs = list(self.trials)
+        rval = Trials(exp_key=self._exp_key, refresh=False)
+        rval._ids = set([tt['tid'] for tt in docs])
+        rval._dynamic_trials = docs
+        # -- as if refreshed
+        rval._synced_trials = docs
+        rval._synced_pos = len(docs)
+        rval._error_log_pos = 0
+        rval._set_trials(list(docs))
+        return rval
+
     def aname(self, trial, name):
         return 'ATTACH::%s::%s' % (trial['tid'], name)
 
@@ -295,17 +738,83 @@ class Trials(object):
         raise NotImplementedError('how to make it obvious whether'
                 ' indexing is by _trials position or by tid?')
 
+    def _set_trials(self, trials):
+        """Install `trials` as the new value of self._trials
+
+        Caches derived from self._trials (e.g. self.columns()) are extended
+        incrementally as long as each new list merely appends documents to
+        the previous one. Any other kind of change increments
+        self._trials_epoch, which tells the caches to start over.
+        """
+        old = getattr(self, '_trials', None)
+        if (old is None
+                or len(trials) < len(old)
+                or any(a is not b for a, b in itertools.izip(old, trials))):
+            self._trials_epoch += 1
+        self._trials = trials
+
     def refresh(self):
         # In MongoTrials, this method fetches from database
-        if self._exp_key is None:
-            self._trials = [tt for tt in self._dynamic_trials
-                if tt['state'] != JOB_STATE_ERROR]
+        #
+        # -- This implementation only looks at documents that were inserted
+        #    since the last refresh, and at the (rare) state changes into and
+        #    out of JOB_STATE_ERROR that were recorded by update_trial.
+        dynamic_trials = self._dynamic_trials
+        if getattr(self, '_synced_trials', None) is not dynamic_trials:
+            # -- first refresh, or _dynamic_trials has been replaced
+            self._synced_trials = dynamic_trials
+            self._synced_pos = 0
+            self._error_log_pos = len(self._error_log)
+            self._set_trials([])
+
+        exp_key = self._exp_key
+
+        def in_view(doc, state):
+            return (state != JOB_STATE_ERROR
+                    and (exp_key is None or doc['exp_key'] == exp_key))
+
+        n_synced = self._synced_pos
+        new_docs = dynamic_trials[n_synced:]
+        self._synced_pos = len(dynamic_trials)
+        appended = [tt for tt in new_docs if in_view(tt, tt['state'])]
+
+        removed = set()
+        readmitted = []
+        changes = self._error_log[self._error_log_pos:]
+        self._error_log_pos = len(self._error_log)
+        if changes:
+            new_doc_ids = set(map(id, new_docs))
+            order = []
+            first_state = {}
+            last_state = {}
+            for doc, old_state, new_state in changes:
+                if id(doc) in new_doc_ids:
+                    # -- already handled above, according to current state
+                    continue
+                if id(doc) not in first_state:
+                    order.append(doc)
+                    first_state[id(doc)] = old_state
+                last_state[id(doc)] = new_state
+            for doc in order:
+                was_in = in_view(doc, first_state[id(doc)])
+                is_in = in_view(doc, last_state[id(doc)])
+                if was_in and not is_in:
+                    removed.add(id(doc))
+                elif is_in and not was_in:
+                    readmitted.append(doc)
+
+        if removed or readmitted:
+            # -- re-admitted trials go back to their position in
+            #    _dynamic_trials, not to the end
+            keep = set(id(tt) for tt in self._trials
+                    if id(tt) not in removed)
+            keep.update(map(id, readmitted))
+            self._set_trials(
+                    [tt for tt in dynamic_trials[:n_synced] if id(tt) in keep]
+                    + appended)
         else:
-            self._trials = [tt for tt in self._dynamic_trials
-                if (tt['state'] != JOB_STATE_ERROR
-                    and tt['exp_key'] == self._exp_key
-                    )]
-        self._ids.update([tt['tid'] for tt in self._trials])
+            self._trials.extend(appended)
+        self._ids.update([tt['tid'] for tt in appended + readmitted])
 
     @property
     def trials(self):
@@ -315,6 +824,37 @@ class Trials(object):
     def tids(self):
         return [tt['tid'] for tt in self._trials]
 
+    def _tids_since(self, pos):
+        """Return the tids of self.trials[pos:]"""
+        return [tt['tid'] for tt in self._trials[pos:]]
+
+    def tid_index(self):
+        """Return a dict mapping each tid to its position in self.trials
+
+        A tid that occurs more than once maps to its first position. The
+        dict is cached (do not modify it) and extended incrementally when
+        trials have been appended since the last call.
+        """
+        index = self._tid_index
+        if index is None or self._tid_index_epoch != self._trials_epoch:
+            index = self._tid_index = {}
+            self._tid_index_epoch = self._trials_epoch
+            self._tid_index_len = 0
+        pos = self._tid_index_len
+        if pos < len(self._trials):
+            for tid in self._tids_since(pos):
+                index.setdefault(tid, pos)
+                pos += 1
+            self._tid_index_len = pos
+        return index
+
+    def trial_by_tid(self, tid):
+        """Return the trial document with tid `tid`
+
+        Raises KeyError if there is no such trial in self.trials.
+        """
+        return self._trials[self.tid_index()[tid]]
+
     @property
     def specs(self):
         return [tt['spec'] for tt in self._trials]
@@ -327,15 +867,72 @@ class Trials(object):
     def miscs(self):
         return [tt['misc'] for tt in self._trials]
 
+    def _cached_idxs_vals(self):
+        """Return miscs_to_idxs_vals(self.miscs), computed incrementally
+
+        The (idxs, vals) pair is cached and extended in place with the miscs
+        of trials appended by subsequent refreshes.
+        """
+        if (self._idxs_vals is None
+                or self._idxs_vals_len == 0
+                or self._idxs_vals_epoch != self._trials_epoch):
+            # -- raises ValueError if there are no trials yet
+            self._idxs_vals = miscs_to_idxs_vals(self.miscs)
+            self._idxs_vals_epoch = self._trials_epoch
+            self._idxs_vals_len = len(self._trials)
+        elif self._idxs_vals_len < len(self._trials):
+            idxs, vals = self._idxs_vals
+            new_miscs = [tt['misc']
+                    for tt in self._trials[self._idxs_vals_len:]]
+            for node_id in miscs_node_ids(new_miscs):
+                # -- compact miscs can introduce nodes not seen so far
+                if node_id not in idxs:
+                    idxs[node_id] = []
+                    vals[node_id] = []
+            new_idxs, new_vals = miscs_to_idxs_vals(new_miscs,
+                    keys=idxs.keys())
+            for node_id in idxs:
+                idxs[node_id].extend(new_idxs[node_id])
+                vals[node_id].extend(new_vals[node_id])
+            self._idxs_vals_len = len(self._trials)
+        return self._idxs_vals
+
     @property
     def idxs(self):
-        return miscs_to_idxs_vals(self.miscs)[0]
+        """Cached; do not modify the return value"""
+        return self._cached_idxs_vals()[0]
 
     @property
     def vals(self):
-        return miscs_to_idxs_vals(self.miscs)[1]
+        """Cached; do not modify the return value"""
+        return self._cached_idxs_vals()[1]
+
+    def columns(self):
+        """Return a TrialColumns instance describing self.trials
+
+        The result is cached, and brought up to date incrementally when
+        trials have been appended since the last call. Callers should treat
+        it as read-only.
+        """
+        cols = self._columns
+        if (cols is None
+                or len(cols) == 0
+                or self._columns_epoch != self._trials_epoch):
+            cols = self._columns = TrialColumns([])
+            self._columns_epoch = self._trials_epoch
+        if len(cols) < len(self._trials):
+            miscs = [tt['misc'] for tt in self._trials[len(cols):]]
+            cols.add_keys(miscs_node_ids(miscs))
+            cols.extend(miscs)
+        return cols
 
     def assert_valid_trial(self, trial):
+        self._assert_trial_keys(trial)
+        self._encode_trial(trial)
+        # XXX how to assert that tids are unique?
+        return trial
+
+    def _assert_trial_keys(self, trial):
         if not (hasattr(trial, 'keys') and hasattr(trial, 'values')):
             raise InvalidTrial('trial should be dict-like', trial)
         for key in TRIAL_KEYS:
@@ -347,6 +944,8 @@ class Trials(object):
         if trial['tid'] != trial['misc']['tid']:
             raise InvalidTrial('tid mismatch between root and misc',
                     (trial['tid'], trial['misc']['tid']))
+
+    def _encode_trial(self, trial):
         # -- check for SON-encodable
         try:
             bson.BSON.encode(trial)
@@ -356,33 +955,132 @@ class Trials(object):
             print "CANT ENCODE"
             print '-' * 80
             raise
-        # XXX how to assert that tids are unique?
-        return trial
+
+    def _prepare_trial_doc(self, doc, validate):
+        """Return `doc` SONified, and validated if `validate`
+
+        The BSON encoding check is left to _insert_trial_docs if it does
+        the encoding itself (see `_insert_checks_encoding`).
+        """
+        doc = SONify(doc)
+        if validate:
+            self._assert_trial_keys(doc)
+            if not self._insert_checks_encoding:
+                self._encode_trial(doc)
+        return doc
 
     def _insert_trial_docs(self, docs):
         """insert with no error checking
         """
         rval = [doc['tid'] for doc in docs]
         self._dynamic_trials.extend(docs)
+        for doc in docs:
+            self._count_state(doc, doc['state'], 1)
+        if self._new_queue is not None:
+            self._new_queue.extend([doc for doc in docs
+                if doc['state'] == JOB_STATE_NEW])
         return rval
 
+    def _count_state(self, doc, state, delta):
+        counts = self._state_counts
+        key = (doc.get('exp_key'), state)
+        counts[state] = counts.get(state, 0) + delta
+        counts[key] = counts.get(key, 0) + delta
+
+    def update_trial(self, trial, dct):
+        """Update inserted document `trial` with the contents of `dct`
+
+        Returns the updated `trial`. Like insertion, this does not refresh.
+        """
+        old_state = trial['state']
+        trial.update(dct)
+        new_state = trial['state']
+        if old_state != new_state:
+            self._count_state(trial, old_state, -1)
+            self._count_state(trial, new_state, 1)
+        if (old_state == JOB_STATE_ERROR) != (new_state == JOB_STATE_ERROR):
+            self._error_log.append((trial, old_state, new_state))
+        if (new_state == JOB_STATE_NEW and old_state != JOB_STATE_NEW
+                and self._new_queue is not None):
+            self._new_queue.append(trial)
+        if old_state != new_state and self._change_signal is not None:
+            self._change_signal.notify()
+        return trial
+
+    def next_new_trial(self):
+        """Return the earliest inserted trial still in JOB_STATE_NEW, or
+        None if there is none.
+
+        The trial stays NEW until the caller changes its state. This takes
+        amortized constant time: trials that have left JOB_STATE_NEW are
+        dropped from the front of a FIFO filled by insertion and
+        update_trial(). Backends without that FIFO search self.trials, as
+        of the last refresh().
+        """
+        queue = self._new_queue
+        if queue is None:
+            for trial in self._trials:
+                if trial['state'] == JOB_STATE_NEW:
+                    return trial
+            return None
+        while queue:
+            if queue[0]['state'] == JOB_STATE_NEW:
+                return queue[0]
+            queue.popleft()
+        return None
+
+    def cancel_new_trials(self, reason):
+        """Move the trials in JOB_STATE_NEW to JOB_STATE_ERROR, with error
+        ('cancelled', reason) in their misc, and return how many there
+        were"""
+        rval = 0
+        trial = self.next_new_trial()
+        while trial is not None:
+            trial['misc']['error'] = ('cancelled', reason)
+            self.update_trial(trial, {
+                'state': JOB_STATE_ERROR,
+                'misc': trial['misc']})
+            rval += 1
+            trial = self.next_new_trial()
+        return rval
+
+    def change_token(self):
+        """Return a token for the current state of the trials (see
+        wait_for_change)"""
+        if self._change_signal is None:
+            return None
+        return self._change_signal.count
+
+    def wait_for_change(self, token, timeout):
+        """Wait at most `timeout` seconds for a job to change state since
+        change_token() returned `token`.
+
+        Returns True if one did. Backends that cannot be notified just
+        sleep, and return False.
+        """
+        if self._change_signal is None:
+            time.sleep(timeout)
+            return False
+        return self._change_signal.wait(token, timeout)
+
     def insert_trial_doc(self, doc):
         """insert trial after error checking
 
         Does not refresh. Call self.refresh() for the trial to appear in
         self.specs, self.results, etc.
         """
-        doc = self.assert_valid_trial(SONify(doc))
-        return self._insert_trial_docs([doc])[0]
+        return self.insert_trial_docs([doc])[0]
         # refreshing could be done fast in this base implementation, but with
         # a real DB the steps should be separated.
 
-    def insert_trial_docs(self, docs):
+    def insert_trial_docs(self, docs, validate=True):
         """ trials - something like is returned by self.new_trial_docs()
+
+        Each doc is SONified and checked in one pass. validate=False skips
+        the checks, for trusted docs (e.g. those produced by a BanditAlgo).
         """
-        docs = [self.assert_valid_trial(SONify(doc))
-                for doc in docs]
-        return self._insert_trial_docs(docs)
+        return self._insert_trial_docs(
+                [self._prepare_trial_doc(doc, validate) for doc in docs])
 
     def new_trial_ids(self, N):
         aa = len(self._ids)
@@ -434,7 +1132,11 @@ class Trials(object):
 
     def delete_all(self):
         self._dynamic_trials = []
-        self.attachments = {}
+        self._error_log = []
+        self._state_counts = {}
+        if self._new_queue is not None:
+            self._new_queue.clear()
+        self.attachments.clear()
         self.refresh()
         
     def count_by_state_synced(self, arg, trials=None):
@@ -458,23 +1160,60 @@ class Trials(object):
         """
         Return trial counts that count_by_state_synced would return if we
         called refresh() first.
+
+        This is constant-time: it reads counters that are maintained by
+        insertion and update_trial().
         """
+        if arg in JOB_STATES:
+            states = [arg]
+        elif hasattr(arg, '__iter__'):
+            states = set(arg)
+            assert all([x in JOB_STATES for x in states])
+        else:
+            raise TypeError(arg)
+        counts = self._state_counts
         if self._exp_key is not None:
-            exp_trials = [tt for tt in self._dynamic_trials
-                if tt['exp_key'] == self._exp_key]
+            keys = [(self._exp_key, state) for state in states]
         else:
-            exp_trials = self._dynamic_trials
-        return self.count_by_state_synced(arg, trials=exp_trials)
+            keys = states
+        return sum([counts.get(key, 0) for key in keys])
 
-    def losses(self, bandit=None):
+    def loss_columns(self, bandit=None):
+        """Return a LossColumns instance describing self.trials
+
+        The result is cached, and brought up to date incrementally: rows
+        are added for appended trials, and recomputed for pending ones.
+        Bandits that do not override loss, loss_variance, true_loss and
+        status share one cache. Callers should treat it as read-only.
+        """
         if bandit is None:
             bandit = Bandit(None)
-        return map(bandit.loss, self.results, self.specs)
+        if all([_bandit_uses_default(bandit, name) for name in
+                ('loss', 'loss_variance', 'true_loss', 'status')]):
+            key = Bandit
+        else:
+            key = bandit
+        cols = self._loss_columns
+        if (cols is None
+                or self._loss_columns_epoch != self._trials_epoch
+                or self._loss_columns_key is not key):
+            cols = self._loss_columns = LossColumns()
+            self._loss_columns_epoch = self._trials_epoch
+            self._loss_columns_key = key
+        trials = self._trials
+        n = len(cols)
+        cols.update(trials, bandit)
+        if n < len(trials):
+            cols.extend(list(trials[n:]), bandit)
+        return cols
+
+    def losses(self, bandit=None):
+        cols = self.loss_columns(bandit)
+        return [l if h else None
+                for l, h in zip(cols.loss.tolist(), cols.has_loss.tolist())]
 
     def statuses(self, bandit=None):
-        if bandit is None:
-            bandit = Bandit(None)
-        return map(bandit.status, self.results, self.specs)
+        return self.loss_columns(bandit).status.tolist()
 
     def average_best_error(self, bandit=None):
         """Return the average best error of the experiment
@@ -485,40 +1224,29 @@ class Trials(object):
         For bandits with loss measurement variance of 0, this function simply
         returns the true_loss corresponding to the result with the lowest loss.
         """
-        if bandit is None:
-            bandit = Bandit(None)
+        cols = self.loss_columns(bandit)
+        ok = cols.status == STATUS_OK
 
-        def fmap(f):
-            rval = np.asarray([f(r, s)
-                    for (r, s) in zip(self.results, self.specs)
-                    if bandit.status(r) == STATUS_OK]).astype('float')
+        def fmap(arr):
+            rval = arr[ok]
             if not np.all(np.isfinite(rval)):
                 raise ValueError()
             return rval
-        loss = fmap(bandit.loss)
-        loss_v = fmap(bandit.loss_variance)
-        if bandit.true_loss is not Bandit.true_loss:
-            true_loss = fmap(bandit.true_loss)
-            loss3 = zip(loss, loss_v, true_loss)
+        loss = fmap(cols.loss)
+        loss_v = fmap(cols.loss_variance)
+        true_loss = fmap(cols.true_loss)
+        order = np.lexsort((true_loss, loss_v, loss))
+        loss = loss[order]
+        loss_v = loss_v[order]
+        true_loss = true_loss[order]
+        if np.all(loss_v == 0):
+            return true_loss[0]
         else:
-            loss3 = zip(loss, loss_v, loss)
-        loss3.sort()
-        loss3 = np.asarray(loss3)
-        if np.all(loss3[:, 1] == 0):
-            best_idx = np.argmin(loss3[:, 0])
-            return loss3[best_idx, 2]
-        else:
-            cutoff = 0
-            sigma = np.sqrt(loss3[0][1])
-            while (cutoff < len(loss3)
-                    and loss3[cutoff][0] < loss3[0][0] + 3 * sigma):
-                cutoff += 1
-            pmin = pmin_sampled(loss3[:cutoff, 0], loss3[:cutoff, 1])
-            #print pmin
-            #print loss3[:cutoff, 0]
-            #print loss3[:cutoff, 1]
-            #print loss3[:cutoff, 2]
-            avg_true_loss = (pmin * loss3[:cutoff, 2]).sum()
+            # -- the trials whose loss is within 3 sigma of the best one
+            sigma = np.sqrt(loss_v[0])
+            cutoff = max(1, loss.searchsorted(loss[0] + 3 * sigma))
+            pmin = pmin_analytic(loss[:cutoff], loss_v[:cutoff])
+            avg_true_loss = (pmin * true_loss[:cutoff]).sum()
             return avg_true_loss
 
 
@@ -703,8 +1431,18 @@ class BanditAlgo(object):
     :param cmd: a pair used by MongoWorker to know how to evaluate suggestions
     :param workdir: optional hint to MongoWorker where to store temp files.
 
+    Sub-graphs of the template that do not depend on any stochastic node
+    (e.g. literal dicts and lists of fixed layer configurations) are
+    evaluated once when the algorithm is constructed, and spliced into the
+    sampling graph as constants that are copied for each sample. Set
+    `fold_constants` to False to re-evaluate them for every sample instead.
+
     """
     seed = 123
+    fold_constants = True
+
+    # -- write suggested trials' misc in the compact format (see compact_misc)
+    compact_miscs = False
 
     def __init__(self, bandit, seed=seed, cmd=None, workdir=None):
         self.bandit = bandit
@@ -719,7 +1457,7 @@ class BanditAlgo(object):
         template = pyll.clone(self.bandit.template, self.template_clone_memo)
         vh = self.vh = VectorizeHelper(template, self.s_new_ids)
         vh.build_idxs()
-        vh.build_vals()
+        vh.build_vals(fold_constants=self.fold_constants)
         # the keys (nid) here are strings like 'node_5'
         idxs_by_nid = vh.idxs_by_id()
         vals_by_nid = vh.vals_by_id()
@@ -805,7 +1543,8 @@ class BanditAlgo(object):
             new_specs, idxs, vals = pyll.rec_eval(self.s_specs_idxs_vals)
             new_result = self.bandit.new_result()
             new_misc = dict(tid=new_id, cmd=self.cmd, workdir=self.workdir)
-            miscs_update_idxs_vals([new_misc], idxs, vals)
+            miscs_update_idxs_vals([new_misc], idxs, vals,
+                    compact=self.compact_miscs)
             rval.extend(trials.new_trial_docs([new_id],
                     new_specs, [new_result], [new_misc]))
         return rval
@@ -834,11 +1573,288 @@ class RandomStop(Random):
             return Random.suggest(self, new_ids, trials)
 
 
+class SuggestionPrefetcher(object):
+    """Computes suggestions of `algo` in a background thread
+
+    start(N) takes a snapshot of `trials` and begins computing N
+    suggestions from it. take(N) returns them, unless more than
+    `max_stale` trials have finished since the snapshot, in which case
+    the caller should suggest afresh.
+
+    The tids of suggestions that are not taken are not reused.
+    """
+    def __init__(self, trials, algo, max_stale=1):
+        self.trials = trials
+        self.algo = algo
+        self.max_stale = max_stale
+        self._thread = None
+        self._n_done = None
+        self._rval = None
+        self._exc = None
+
+    def start(self, N):
+        """Begin computing N suggestions, if none are being computed"""
+        if self._thread is not None:
+            return
+        trials = self.trials
+        trials.refresh()
+        snapshot = trials.snapshot()
+        self._n_done = trials.count_by_state_unsynced(JOB_STATE_DONE)
+        self._rval = self._exc = None
+        new_ids = trials.new_trial_ids(N)
+
+        def suggest():
+            try:
+                self._rval = self.algo.suggest(new_ids, snapshot)
+            except Exception, e:
+                self._exc = e
+        self._thread = threading.Thread(target=suggest)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def take(self, N):
+        """Return at most N prefetched suggestions (or StopExperiment), or
+        None if there are none that are fresh enough"""
+        thread = self._thread
+        if thread is None:
+            return None
+        # -- wait even for stale suggestions, so that the algo is never
+        #    called from two threads at once
+        thread.join()
+        self._thread = None
+        n_done = self.trials.count_by_state_unsynced(JOB_STATE_DONE)
+        if n_done - self._n_done > self.max_stale:
+            logger.debug('discarding prefetched suggestions: %i new results'
+                    % (n_done - self._n_done))
+            return None
+        if self._exc is not None:
+            logger.info('prefetched suggest failed: %s' % str(self._exc))
+            return None
+        rval = self._rval
+        if rval is StopExperiment:
+            return rval
+        return rval[:N]
+
+    def cancel(self):
+        """Wait for, and discard, suggestions being computed"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class QueueLengthController(object):
+    """Adapts Experiment.max_queue_len to the rate at which workers take jobs
+
+    update() estimates the number of workers and the duration of an
+    evaluation from the book_time and refresh_time of the last `window`
+    trials. It then sizes the queue to keep the workers busy, times
+    `margin`, while the queue is refilled: the driver wakes up, makes at
+    least one suggest call (timed by the driver, see record_suggest), and
+    the workers reserve the new jobs, which may take them `reserve_secs`.
+    It keeps the queue no longer than that, so that suggestions are made
+    from as many results as possible.
+
+    The queue length moves towards that target by at most `max_step`
+    times its current value per update, so one noisy measurement does not
+    swing it from one bound to the other.
+    """
+    def __init__(self, min_len=1, max_len=100, window=50, margin=1.5,
+            reserve_secs=0.0, max_step=0.5):
+        self.min_len = min_len
+        self.max_len = max_len
+        self.window = window
+        self.margin = margin
+        self.reserve_secs = reserve_secs
+        self.max_step = max_step
+        # -- seconds per suggest call (moving average)
+        self.call_secs = None
+
+    def record_suggest(self, n, secs):
+        """Record that a call suggesting n trials took `secs` seconds"""
+        if n <= 0:
+            return
+        if self.call_secs is None:
+            self.call_secs = secs
+        else:
+            self.call_secs = .8 * self.call_secs + .2 * secs
+
+    def measure(self, trials):
+        """Return (n_workers, secs per evaluation), or (None, None) if no
+        recent trial has been timed"""
+        owners = set()
+        durations = []
+        for trial in trials.trials[-self.window:]:
+            if trial.get('owner') is not None:
+                owners.add(repr(trial['owner']))
+            book_time = trial.get('book_time')
+            refresh_time = trial.get('refresh_time')
+            if (trial['state'] == JOB_STATE_DONE
+                    and book_time is not None and refresh_time is not None):
+                durations.append((refresh_time - book_time).total_seconds())
+        if not durations:
+            return None, None
+        n_workers = max(1, len(owners),
+                trials.count_by_state_unsynced(JOB_STATE_RUNNING))
+        return n_workers, float(np.median(durations))
+
+    def target(self, n_workers, eval_secs, wake_secs=0.0):
+        """Return the queue length that lasts while the queue is refilled
+        """
+        # -- jobs taken per second, with margin
+        rate = self.margin * n_workers / max(eval_secs, 1e-6)
+        refill_secs = wake_secs + (self.call_secs or 0.0) + self.reserve_secs
+        target = int(np.ceil(rate * refill_secs))
+        return min(max(target, self.min_len), self.max_len)
+
+    def update(self, current, trials, wake_secs=0.0):
+        """Return the queue length to use instead of `current`
+
+        wake_secs - how long the driver may take to notice that workers
+            have taken jobs
+        """
+        n_workers, eval_secs = self.measure(trials)
+        if n_workers is None:
+            return current
+        target = self.target(n_workers, eval_secs, wake_secs)
+        # -- a longer queue makes for longer suggest calls, so the target
+        #    is approached step by step as call_secs follows
+        step = max(1, int(np.ceil(self.max_step * current)))
+        rval = min(max(target, current - step), current + step)
+        if rval != current:
+            logger.info('queue length %i -> %i (target %i; %i workers,'
+                    ' %.3gs per evaluation, %.3gs per suggest call)' % (
+                        current, rval, target, n_workers, eval_secs,
+                        self.call_secs or 0.0))
+        return rval
+
+
+class RunBudget(object):
+    """Limits on Experiment.run, besides the number of trials
+
+    wall_secs - stop enqueuing trials this many seconds after run() starts
+    worker_secs - ... once evaluations have taken this many seconds in
+        total (DONE trials, and RUNNING trials so far), according to their
+        book_time and refresh_time
+    loss_target - ... once a trial's loss is at most this (e.g.
+        bandit.loss_target)
+    cancel_new - when the budget is exhausted, also cancel the trials that
+        are still queued (see Trials.cancel_new_trials)
+    """
+    def __init__(self, wall_secs=None, worker_secs=None, loss_target=None,
+            cancel_new=False):
+        self.wall_secs = wall_secs
+        self.worker_secs = worker_secs
+        self.loss_target = loss_target
+        self.cancel_new = cancel_new
+        self.start()
+
+    def start(self):
+        """Start the wall clock"""
+        self._t0 = time.time()
+        # -- worker seconds of the DONE trials among trials.trials[:_pos]
+        self._done_secs = 0.0
+        self._pos = 0
+        self._epoch = None
+        # -- positions < _pos of trials that were not DONE
+        self._unfinished = []
+        # -- like _pos and _unfinished, for the loss target
+        self._loss_pos = 0
+        self._loss_epoch = None
+        self._loss_pending = []
+        self._loss_target_reached = False
+
+    def worker_secs_used(self, trials):
+        """Return the seconds taken by evaluations so far
+
+        Computed incrementally: DONE trials are counted once.
+        """
+        docs = trials.trials
+        if self._epoch != trials._trials_epoch:
+            self._epoch = trials._trials_epoch
+            self._done_secs = 0.0
+            self._pos = 0
+            self._unfinished = []
+        now = datetime.datetime.utcnow()
+        running_secs = 0.0
+        unfinished = []
+        positions = self._unfinished + range(self._pos, len(docs))
+        for pos in positions:
+            trial = docs[pos]
+            book_time = trial.get('book_time')
+            if trial['state'] == JOB_STATE_DONE:
+                refresh_time = trial.get('refresh_time')
+                if book_time is not None and refresh_time is not None:
+                    self._done_secs += (
+                            refresh_time - book_time).total_seconds()
+            else:
+                unfinished.append(pos)
+                if trial['state'] == JOB_STATE_RUNNING and book_time:
+                    running_secs += (now - book_time).total_seconds()
+        self._unfinished = unfinished
+        self._pos = len(docs)
+        return self._done_secs + running_secs
+
+    def exhausted(self, trials, bandit):
+        """Return why the budget is exhausted, or None if it is not"""
+        if self.wall_secs is not None:
+            if time.time() - self._t0 >= self.wall_secs:
+                return 'wall time budget of %ss exhausted' % self.wall_secs
+        if self.worker_secs is not None:
+            if self.worker_secs_used(trials) >= self.worker_secs:
+                return ('worker time budget of %ss exhausted'
+                        % self.worker_secs)
+        if self.loss_target is not None:
+            if self.loss_target_reached(trials, bandit):
+                return 'loss target %s reached' % self.loss_target
+        return None
+
+    def loss_target_reached(self, trials, bandit):
+        """Return True if a trial's loss is at most self.loss_target
+
+        Computed incrementally: the rows of final trials are checked once.
+        """
+        cols = trials.loss_columns(bandit)
+        if self._loss_epoch != trials._trials_epoch:
+            self._loss_epoch = trials._trials_epoch
+            self._loss_pos = 0
+            self._loss_pending = []
+            self._loss_target_reached = False
+        if self._loss_target_reached:
+            return True
+        rows = np.asarray(self._loss_pending
+                + range(self._loss_pos, len(cols)), dtype='int')
+        ok = cols.has_loss[rows] & (cols.status[rows] == STATUS_OK)
+        reached = cols.loss[rows][ok] <= self.loss_target
+        if reached.any():
+            # -- final rows do not change, so the target stays reached
+            if cols.final[rows][ok][reached].any():
+                self._loss_target_reached = True
+            return True
+        self._loss_pending = rows[~cols.final[rows]].tolist()
+        self._loss_pos = len(cols)
+        return False
+
+
 class Experiment(object):
     """Object for conducting search experiments.
     """
     catch_bandit_exceptions = True
 
+    # -- set False to trust the bandit_algo to produce valid trial documents
+    validate_new_trials = True
+
+    # -- set True to compute the next suggestions in a background thread
+    #    while trials are evaluated (see SuggestionPrefetcher); they are
+    #    used if at most prefetch_max_stale trials finished meanwhile
+    prefetch_suggestions = False
+    prefetch_max_stale = 1
+
+    # -- a QueueLengthController to adapt max_queue_len as run() goes
+    queue_length_controller = None
+
+    # -- a RunBudget that can stop run() before N trials are enqueued
+    budget = None
+
     def __init__(self, trials, bandit_algo, async=None,
             max_queue_len=1,
             poll_interval_secs=1.0,
@@ -854,26 +1870,34 @@ class Experiment(object):
         self.max_queue_len = max_queue_len
 
     def serial_evaluate(self, N=-1):
-        for trial in self.trials._dynamic_trials:
-            if trial['state'] == JOB_STATE_NEW:
-                spec = copy.deepcopy(trial['spec'])
-                ctrl = Ctrl(self.trials, current_trial=trial)
-                try:
-                    result = self.bandit.evaluate(spec, ctrl)
-                except Exception, e:
-                    logger.info('job exception: %s' % str(e))
-                    trial['state'] = JOB_STATE_ERROR
-                    trial['misc']['error'] = (str(type(e)), str(e))
-                    if not self.catch_bandit_exceptions:
-                        raise
-                else:
-                    #logger.debug('job returned: %s' % str(result))
-                    trial['state'] = JOB_STATE_DONE
-                    trial['result'] = result
-
-                N -= 1
-                if N == 0:
-                    break
+        """Evaluate (at most N) NEW trials, in insertion order"""
+        while N != 0:
+            trial = self.trials.next_new_trial()
+            if trial is None:
+                break
+            spec = copy.deepcopy(trial['spec'])
+            ctrl = Ctrl(self.trials, current_trial=trial)
+            book_time = datetime.datetime.utcnow()
+            try:
+                result = self.bandit.evaluate(spec, ctrl)
+            except Exception, e:
+                logger.info('job exception: %s' % str(e))
+                trial['misc']['error'] = (str(type(e)), str(e))
+                self.trials.update_trial(trial, {
+                    'state': JOB_STATE_ERROR,
+                    'misc': trial['misc'],
+                    'book_time': book_time,
+                    'refresh_time': datetime.datetime.utcnow()})
+                if not self.catch_bandit_exceptions:
+                    raise
+            else:
+                #logger.debug('job returned: %s' % str(result))
+                self.trials.update_trial(trial, {
+                    'state': JOB_STATE_DONE,
+                    'result': result,
+                    'book_time': book_time,
+                    'refresh_time': datetime.datetime.utcnow()})
+            N -= 1
         self.trials.refresh()
 
     def block_until_done(self):
@@ -883,10 +1907,12 @@ class Experiment(object):
             def get_queue_len():
                 return self.trials.count_by_state_unsynced(unfinished_states)
 
+            token = self.trials.change_token()
             qlen = get_queue_len()
             while qlen > 0:
                 logger.info('Waiting for %d jobs to finish ...' % qlen)
-                time.sleep(self.poll_interval_secs)
+                self.trials.wait_for_change(token, self.poll_interval_secs)
+                token = self.trials.change_token()
                 qlen = get_queue_len()
             self.trials.refresh()
         else:
@@ -907,30 +1933,71 @@ class Experiment(object):
         def get_queue_len():
             return self.trials.count_by_state_unsynced(JOB_STATE_NEW)
 
+        if self.prefetch_suggestions:
+            prefetcher = SuggestionPrefetcher(trials, algo,
+                    max_stale=self.prefetch_max_stale)
+        else:
+            prefetcher = None
+
+        controller = self.queue_length_controller
+        budget = self.budget
+        if budget is not None:
+            budget.start()
+
         stopped = False
         while n_queued < N:
+            if budget is not None:
+                reason = budget.exhausted(trials, self.bandit)
+                if reason is not None:
+                    logger.info('Stopping run: %s' % reason)
+                    if budget.cancel_new:
+                        n_cancelled = trials.cancel_new_trials(reason)
+                        logger.info('Cancelled %i queued jobs' % n_cancelled)
+                    break
+            # -- (taken before counting, so no change is missed)
+            token = trials.change_token()
+            if controller is not None:
+                if token is None:
+                    wake_secs = self.poll_interval_secs
+                else:
+                    wake_secs = 0.0
+                self.max_queue_len = controller.update(self.max_queue_len,
+                        trials, wake_secs=wake_secs)
             qlen = get_queue_len()
             while qlen < self.max_queue_len and n_queued < N:
                 n_to_enqueue = min(self.max_queue_len - qlen, N - n_queued)
-                new_ids = trials.new_trial_ids(n_to_enqueue)
-                self.trials.refresh()
-                new_trials = algo.suggest(new_ids, trials)
+                new_trials = None
+                if prefetcher is not None:
+                    new_trials = prefetcher.take(n_to_enqueue)
+                if new_trials is None:
+                    new_ids = trials.new_trial_ids(n_to_enqueue)
+                    self.trials.refresh()
+                    t0 = time.time()
+                    new_trials = algo.suggest(new_ids, trials)
+                    if controller is not None:
+                        controller.record_suggest(len(new_ids),
+                                time.time() - t0)
+                    if new_trials is not StopExperiment:
+                        assert len(new_ids) >= len(new_trials)
                 if new_trials is StopExperiment:
                     stopped = True
                     break
                 else:
-                    assert len(new_ids) >= len(new_trials)
                     if len(new_trials):
-                        self.trials.insert_trial_docs(new_trials)
+                        self.trials.insert_trial_docs(new_trials,
+                                validate=self.validate_new_trials)
                         self.trials.refresh()
                         n_queued += len(new_trials)
                         qlen = get_queue_len()
                     else:
                         break
 
+            if prefetcher is not None and not stopped and n_queued < N:
+                prefetcher.start(min(self.max_queue_len, N - n_queued))
+
             if self.async:
-                # -- wait for workers to fill in the trials
-                time.sleep(self.poll_interval_secs)
+                # -- wait for workers to take or finish jobs
+                trials.wait_for_change(token, self.poll_interval_secs)
             else:
                 # -- loop over trials and do the jobs directly
                 self.serial_evaluate()
@@ -938,6 +2005,9 @@ class Experiment(object):
             if stopped:
                 break
 
+        if prefetcher is not None:
+            prefetcher.cancel()
+
         if block_until_done:
             self.block_until_done()
             self.trials.refresh()
@@ -0,0 +1,549 @@
+"""Memory-efficient in-memory Trials
+
+CompactTrials stores trial documents by column instead of as nested dicts:
+
+- tid and per-node hyperparameter values (misc['idxs'] / misc['vals']) live in
+  a TrialColumns instance, i.e. in typed numpy arrays.
+- state and exp_key live in small integer arrays.
+- spec and result are kept as-is, one object per trial.
+- everything else (owner, book_time, misc['cmd'], ...) is kept in per-trial
+  dictionaries that are shared between consecutive trials when they are
+  equal, which is the common case.
+
+Documents are exposed as dict-compatible views (CompactTrial, CompactMisc)
+that are created on demand and read from / write to the columns. Views can be
+pickled, copied, and compared with dicts, and they turn into dicts when
+deep-copied.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import collections
+import copy
+
+import numpy as np
+
+from .base import ChangeSignal
+from .base import JOB_STATE_ERROR
+from .base import JOB_STATE_NEW
+from .base import Trials
+from .base import TrialColumns
+
+# -- keys stored in dedicated columns, rather than in the per-trial extras
+COLUMN_KEYS = ('tid', 'spec', 'result', 'misc', 'state', 'exp_key')
+MISC_COLUMN_KEYS = ('tid', 'idxs', 'vals')
+
+
+def _py(obj):
+    """Return numpy scalars as the corresponding python scalars"""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _grow(arr, n):
+    """Return `arr` or a copy of it, with room for at least `n` elements"""
+    if n <= len(arr):
+        return arr
+    rval = np.zeros(max(n, 2 * len(arr), 16), dtype=arr.dtype)
+    rval[:len(arr)] = arr
+    return rval
+
+
+def _is_regular(tid, misc):
+    """True iff misc['idxs'] / misc['vals'] can be stored as one column
+    entry per node"""
+    if misc.get('tid') != tid:
+        return False
+    idxs = misc['idxs']
+    vals = misc['vals']
+    if idxs is None:
+        # -- compact format (see base.compact_misc)
+        return vals is not None
+    if set(idxs) != set(vals):
+        return False
+    for k, k_idxs in idxs.iteritems():
+        if k_idxs:
+            if k_idxs != [tid] or len(vals[k]) != 1:
+                return False
+        elif vals[k]:
+            return False
+    return True
+
+
+class TrialStore(object):
+    """Column-oriented storage for trial documents
+
+    Rows are numbered in order of insertion.
+    """
+    def __init__(self):
+        self.n = 0
+        self.columns = TrialColumns([])
+        self.state = np.zeros(0, dtype='int8')
+        # -- True where misc is in the compact format
+        self.compact = np.zeros(0, dtype='bool')
+        self.exp_key = np.zeros(0, dtype='int32')
+        self.exp_keys = []
+        self.specs = []
+        self.results = []
+        # -- per-row dicts of the remaining root and misc keys
+        self.extras = []
+        self.misc_extras = []
+        # -- row -> misc, for miscs that do not fit the columns
+        self.irregular = {}
+        # -- incremented whenever the misc of an existing row is replaced
+        self.misc_version = 0
+
+    def exp_key_code(self, exp_key, insert=False):
+        try:
+            return self.exp_keys.index(exp_key)
+        except ValueError:
+            if not insert:
+                return None
+            self.exp_keys.append(exp_key)
+            return len(self.exp_keys) - 1
+
+    def _shared(self, lst, dct):
+        """Return `dct`, or an equal dict already at the end of `lst`"""
+        if lst and lst[-1] == dct:
+            return lst[-1]
+        return dct
+
+    def append(self, docs):
+        """Append one row per document"""
+        n0 = self.n
+        n1 = n0 + len(docs)
+        self.state = _grow(self.state, n1)
+        self.compact = _grow(self.compact, n1)
+        self.exp_key = _grow(self.exp_key, n1)
+        col_miscs = []
+        for ii, doc in enumerate(docs):
+            row = n0 + ii
+            tid = doc['tid']
+            misc = doc['misc']
+            self.state[row] = doc['state']
+            self.exp_key[row] = self.exp_key_code(doc.get('exp_key'),
+                    insert=True)
+            self.specs.append(doc['spec'])
+            self.results.append(doc['result'])
+            self.extras.append(self._shared(self.extras,
+                dict([(k, v) for k, v in doc.iteritems()
+                    if k not in COLUMN_KEYS])))
+            if _is_regular(tid, misc):
+                self.misc_extras.append(self._shared(self.misc_extras,
+                    dict([(k, v) for k, v in misc.iteritems()
+                        if k not in MISC_COLUMN_KEYS])))
+                self.columns.add_keys(misc['vals'])
+                self.compact[row] = misc['idxs'] is None
+                col_miscs.append(misc)
+            else:
+                self.misc_extras.append(None)
+                self.compact[row] = False
+                self.irregular[row] = misc
+                col_miscs.append({'tid': tid, 'idxs': {}, 'vals': {}})
+        self.columns.extend(col_miscs)
+        self.n = n1
+
+    def tid(self, row):
+        return _py(self.columns._tids[row])
+
+    def keys(self, row):
+        return list(COLUMN_KEYS) + self.extras[row].keys()
+
+    def get(self, row, key):
+        if key == 'tid':
+            return self.tid(row)
+        elif key == 'spec':
+            return self.specs[row]
+        elif key == 'result':
+            return self.results[row]
+        elif key == 'misc':
+            if row in self.irregular:
+                return self.irregular[row]
+            return CompactMisc(self, row)
+        elif key == 'state':
+            return int(self.state[row])
+        elif key == 'exp_key':
+            return self.exp_keys[self.exp_key[row]]
+        else:
+            return self.extras[row][key]
+
+    def set(self, row, key, value):
+        if key == 'tid':
+            self.columns._tids = self.columns._store(self.columns._tids,
+                    [row], [value])
+        elif key == 'spec':
+            self.specs[row] = value
+        elif key == 'result':
+            self.results[row] = value
+        elif key == 'misc':
+            self.set_misc(row, value)
+        elif key == 'state':
+            self.state[row] = value
+        elif key == 'exp_key':
+            self.exp_key[row] = self.exp_key_code(value, insert=True)
+        else:
+            # -- copy on write: extras may be shared with other rows
+            extras = self.extras[row] = dict(self.extras[row])
+            extras[key] = value
+
+    def delete(self, row, key):
+        if key in COLUMN_KEYS:
+            raise TypeError('cannot delete key', key)
+        extras = self.extras[row] = dict(self.extras[row])
+        del extras[key]
+
+    def misc_keys(self, row):
+        return list(MISC_COLUMN_KEYS) + self.misc_extras[row].keys()
+
+    def misc_get(self, row, key):
+        columns = self.columns
+        if key == 'tid':
+            return self.tid(row)
+        elif key == 'idxs':
+            if self.compact[row]:
+                return None
+            tid = self.tid(row)
+            return dict([(k, [tid] if columns._active[k][row] else [])
+                for k in columns.keys])
+        elif key == 'vals':
+            if self.compact[row]:
+                return dict([(k, _py(columns._vals[k][row]))
+                    for k in columns.keys if columns._active[k][row]])
+            return dict([(k,
+                [_py(columns._vals[k][row])] if columns._active[k][row]
+                else [])
+                for k in columns.keys])
+        else:
+            return self.misc_extras[row][key]
+
+    def misc_set(self, row, key, value):
+        if key in MISC_COLUMN_KEYS:
+            misc = dict(CompactMisc(self, row))
+            misc[key] = value
+            self.set_misc(row, misc)
+        else:
+            extras = self.misc_extras[row] = dict(self.misc_extras[row])
+            extras[key] = value
+
+    def misc_delete(self, row, key):
+        if key in MISC_COLUMN_KEYS:
+            raise TypeError('cannot delete misc key', key)
+        extras = self.misc_extras[row] = dict(self.misc_extras[row])
+        del extras[key]
+
+    def set_misc(self, row, misc):
+        if (isinstance(misc, CompactMisc)
+                and misc._store is self and misc._row == row):
+            return
+        self.misc_version += 1
+        columns = self.columns
+        for k in columns.keys:
+            columns._active[k][row] = False
+        self.irregular.pop(row, None)
+        if _is_regular(self.tid(row), misc):
+            self.misc_extras[row] = dict([(k, v)
+                for k, v in misc.iteritems() if k not in MISC_COLUMN_KEYS])
+            columns.add_keys(misc['vals'])
+            compact = self.compact[row] = misc['idxs'] is None
+            for k, k_vals in misc['vals'].iteritems():
+                if compact:
+                    k_vals = [k_vals]
+                if k_vals:
+                    columns._vals[k] = columns._store(columns._vals[k],
+                            [row], k_vals)
+                    columns._active[k][row] = True
+        else:
+            self.compact[row] = False
+            self.misc_extras[row] = None
+            self.irregular[row] = misc
+
+    def misc_doc(self, row):
+        if row in self.irregular:
+            return self.irregular[row]
+        rval = dict(self.misc_extras[row])
+        for k in MISC_COLUMN_KEYS:
+            rval[k] = self.misc_get(row, k)
+        return rval
+
+    def doc(self, row):
+        """Return row as a new dict (sharing spec, result, etc.)"""
+        rval = dict(self.extras[row])
+        for k in COLUMN_KEYS:
+            rval[k] = self.get(row, k)
+        rval['misc'] = self.misc_doc(row)
+        return rval
+
+
+class _RowView(collections.MutableMapping):
+    """Base class of dict-compatible views of a row of a TrialStore"""
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def as_dict(self):
+        raise NotImplementedError('override-me')
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __copy__(self):
+        return self.as_dict()
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.as_dict(), memo)
+
+    def __reduce__(self):
+        return (dict, (self.as_dict(),))
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class CompactMisc(_RowView):
+    """dict-compatible view of a trial's misc sub-document"""
+
+    def keys(self):
+        return self._store.misc_keys(self._row)
+
+    def __getitem__(self, key):
+        return self._store.misc_get(self._row, key)
+
+    def __setitem__(self, key, value):
+        self._store.misc_set(self._row, key, value)
+
+    def __delitem__(self, key):
+        self._store.misc_delete(self._row, key)
+
+    def as_dict(self):
+        return self._store.misc_doc(self._row)
+
+
+class CompactTrial(_RowView):
+    """dict-compatible view of a trial document"""
+
+    def keys(self):
+        return self._store.keys(self._row)
+
+    def __getitem__(self, key):
+        return self._store.get(self._row, key)
+
+    def __setitem__(self, key, value):
+        self._store.set(self._row, key, value)
+
+    def __delitem__(self, key):
+        self._store.delete(self._row, key)
+
+    def as_dict(self):
+        return self._store.doc(self._row)
+
+
+class CompactRecords(object):
+    """Read-only sequence of CompactTrial views of some rows of a TrialStore
+
+    rows=None means all rows.
+    """
+    def __init__(self, store, rows=None):
+        self._store = store
+        self._rows = rows
+
+    def __len__(self):
+        if self._rows is None:
+            return self._store.n
+        return len(self._rows)
+
+    def _row(self, ii):
+        if self._rows is None:
+            if ii < 0:
+                ii += self._store.n
+            if not 0 <= ii < self._store.n:
+                raise IndexError(ii)
+            return ii
+        return int(self._rows[ii])
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            if self._rows is None:
+                rows = np.arange(self._store.n)[ii]
+            else:
+                rows = self._rows[ii]
+            return CompactRecords(self._store, rows)
+        return CompactTrial(self._store, self._row(ii))
+
+    def __iter__(self):
+        store = self._store
+        if self._rows is None:
+            rows = xrange(store.n)
+        else:
+            rows = self._rows.tolist()
+        for row in rows:
+            yield CompactTrial(store, row)
+
+
+class CompactTrials(Trials):
+    """In-memory Trials that keep documents in a TrialStore
+
+    The trial documents in self.trials, self.miscs, self._dynamic_trials,
+    etc. are views, so they stay up to date when the store is modified (e.g.
+    by update_trial()). Use dict(trial) or copy.deepcopy(trial) to get a
+    detached copy.
+    """
+
+    # -- number of rows whose tids have been added to self._ids
+    _synced_n = 0
+
+    # -- store.misc_version as of the last refresh
+    _misc_version = 0
+
+    def __init__(self, exp_key=None, refresh=True):
+        self._store = TrialStore()
+        self._ids = set()
+        self._error_log = []
+        self._state_counts = {}
+        self._new_queue = collections.deque()
+        self._change_signal = ChangeSignal()
+        self._exp_key = exp_key
+        self.attachments = self._new_attachments()
+        if refresh:
+            self.refresh()
+
+    def view(self, exp_key=None, refresh=True):
+        rval = object.__new__(self.__class__)
+        rval._exp_key = exp_key
+        rval._store = self._store
+        rval._ids = self._ids
+        rval._error_log = self._error_log
+        rval._state_counts = self._state_counts
+        rval._new_queue = self._new_queue
+        rval._change_signal = self._change_signal
+        rval.attachments = self.attachments
+        if refresh:
+            rval.refresh()
+        return rval
+
+    @property
+    def _dynamic_trials(self):
+        return CompactRecords(self._store)
+
+    def refresh(self):
+        store = self._store
+        n = store.n
+        keep = store.state[:n] != JOB_STATE_ERROR
+        if self._exp_key is not None:
+            code = store.exp_key_code(self._exp_key)
+            if code is None:
+                keep[:] = False
+            else:
+                keep &= store.exp_key[:n] == code
+        rows = np.where(keep)[0]
+        old = getattr(self, '_rows', None)
+        if (old is None
+                or len(rows) < len(old)
+                or not np.all(rows[:len(old)] == old)
+                or self._misc_version != store.misc_version):
+            self._trials_epoch += 1
+            self._misc_version = store.misc_version
+        self._rows = rows
+        self._trials = CompactRecords(store, rows)
+        if self._synced_n < n:
+            self._ids.update(store.columns.tids[self._synced_n:n].tolist())
+            self._synced_n = n
+
+    @property
+    def tids(self):
+        return self._store.columns._tids[self._rows].tolist()
+
+    def _tids_since(self, pos):
+        return self._store.columns._tids[self._rows[pos:]].tolist()
+
+    @property
+    def specs(self):
+        specs = self._store.specs
+        return [specs[row] for row in self._rows.tolist()]
+
+    @property
+    def results(self):
+        results = self._store.results
+        return [results[row] for row in self._rows.tolist()]
+
+    def _column_rows(self):
+        """Return True iff the idxs/vals of self.trials are all in the
+        columns of the store"""
+        irregular = self._store.irregular
+        return not (irregular
+                and np.any(np.in1d(self._rows, irregular.keys())))
+
+    def columns(self):
+        if not self._column_rows():
+            return Trials.columns(self)
+        cols = self._columns
+        if (cols is None
+                or len(cols) != len(self._rows)
+                or self._columns_epoch != self._trials_epoch):
+            store_cols = self._store.columns
+            rows = self._rows
+            cols = TrialColumns(store_cols.keys)
+            cols._n = len(rows)
+            cols._tids = store_cols._tids[rows]
+            for k in cols.keys:
+                cols._vals[k] = store_cols._vals[k][rows]
+                cols._active[k] = store_cols._active[k][rows]
+            self._columns = cols
+            self._columns_epoch = self._trials_epoch
+        return cols
+
+    def _cached_idxs_vals(self):
+        if not len(self._rows) or not self._column_rows():
+            return Trials._cached_idxs_vals(self)
+        if (self._idxs_vals is None
+                or self._idxs_vals_len != len(self._rows)
+                or self._idxs_vals_epoch != self._trials_epoch):
+            cols = self.columns()
+            idxs = {}
+            vals = {}
+            for k in cols.keys:
+                active = cols.active[k]
+                idxs[k] = cols.tids[active].tolist()
+                vals[k] = cols.vals[k][active].tolist()
+            self._idxs_vals = idxs, vals
+            self._idxs_vals_epoch = self._trials_epoch
+            self._idxs_vals_len = len(self._rows)
+        return self._idxs_vals
+
+    def _insert_trial_docs(self, docs):
+        store = self._store
+        row = store.n
+        store.append(docs)
+        for doc in docs:
+            self._count_state(doc, doc['state'], 1)
+            if doc['state'] == JOB_STATE_NEW:
+                self._new_queue.append(CompactTrial(store, row))
+            row += 1
+        return [doc['tid'] for doc in docs]
+
+    def update_trial(self, trial, dct):
+        old_state = trial['state']
+        trial.update(dct)
+        new_state = trial['state']
+        if old_state != new_state:
+            self._count_state(trial, old_state, -1)
+            self._count_state(trial, new_state, 1)
+            if new_state == JOB_STATE_NEW:
+                self._new_queue.append(trial)
+            self._change_signal.notify()
+        return trial
+
+    def delete_all(self):
+        self._store = TrialStore()
+        self._state_counts = {}
+        self._new_queue.clear()
+        self._synced_n = 0
+        self._misc_version = 0
+        self.attachments.clear()
+        self.refresh()
@@ -0,0 +1,371 @@
+"""Coroutine-based Experiment driver
+
+Python 2 has no asyncio, so this module provides the little that a driver
+needs: generator-based coroutines, run cooperatively by an EventLoop.
+
+A coroutine is a generator that yields what it waits for:
+
+    yield 0.5              # -- sleep for 0.5 seconds
+    yield None             # -- let other coroutines run
+    rc = yield popen       # -- wait for a subprocess.Popen to exit
+    val = yield async_res  # -- wait for anything with ready() and get(),
+                           #    e.g. a multiprocessing AsyncResult or a Task
+    val = yield generator  # -- run another coroutine, wait for its value
+
+and returns a value with `raise Return(value)`.
+
+CoroutineExperiment is an Experiment whose bandit's evaluate() may be such
+a coroutine (a generator function); many evaluations are then in flight
+at once in one thread, and the experiment suggests new trials while they
+run. Several experiments can share one EventLoop (see run_experiments).
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import copy
+import datetime
+import logging
+import sys
+import time
+import types
+
+from .base import Ctrl
+from .base import Experiment
+from .base import JOB_STATE_RUNNING
+from .base import JOB_STATE_DONE
+from .base import JOB_STATE_ERROR
+from .base import StopExperiment
+
+logger = logging.getLogger(__name__)
+
+
+class Return(Exception):
+    """Raised by a coroutine to return `value`"""
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Cancelled(Exception):
+    """Raised by get() of a Task stopped by EventLoop.cancel"""
+
+
+class Task(object):
+    """A coroutine scheduled on an EventLoop
+
+    Task has the ready()/get() interface of a multiprocessing AsyncResult,
+    so coroutines can wait for each other.
+    """
+    def __init__(self, gen):
+        self.gen = gen
+        # -- the Task running the generator that gen last yielded, if any
+        self.sub = None
+        self.done = False
+        self.value = None
+        self.exc_info = None
+
+    def ready(self):
+        return self.done
+
+    def get(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def finish(self, value=None, exc_info=None):
+        self.done = True
+        self.value = value
+        self.exc_info = exc_info
+
+
+class WaitAny(object):
+    """Waitable that is ready when any of `waitables` is"""
+    def __init__(self, waitables):
+        self.waitables = list(waitables)
+
+    def ready(self):
+        return any([w.ready() for w in self.waitables])
+
+    def get(self):
+        return [w for w in self.waitables if w.ready()]
+
+
+class EventLoop(object):
+    """Runs Tasks cooperatively, in the calling thread
+
+    When no task can run, the loop sleeps until the earliest timer. Only
+    while some task waits for something outside the loop (a subprocess,
+    an AsyncResult, ...) does it wake every poll_interval to check on it.
+    """
+    # -- seconds between checks of waitables that cannot signal the loop
+    #    (subprocesses, AsyncResults, ...)
+    poll_interval = 0.01
+
+    def __init__(self):
+        # -- task -> what it waits for: None (runnable), a deadline
+        #    (float), or a waitable
+        self._waiting = {}
+
+    def spawn(self, gen):
+        """Schedule generator `gen`, return its Task"""
+        task = Task(gen)
+        self._waiting[task] = None
+        return task
+
+    def _step(self, task, value=None, exc_info=None):
+        """Advance `task` to its next yield"""
+        try:
+            if exc_info is not None:
+                waitable = task.gen.throw(*exc_info)
+            else:
+                waitable = task.gen.send(value)
+        except Return, e:
+            task.finish(value=e.value)
+        except StopIteration:
+            task.finish()
+        except Exception:
+            task.finish(exc_info=sys.exc_info())
+        else:
+            if isinstance(waitable, (int, float)):
+                waitable = time.time() + waitable
+            elif isinstance(waitable, types.GeneratorType):
+                waitable = task.sub = self.spawn(waitable)
+            self._waiting[task] = waitable
+            return
+        del self._waiting[task]
+
+    def cancel(self, task):
+        """Stop `task`, and the coroutine it runs for what it waits for
+        (if any): their generators are closed, and they finish with
+        Cancelled"""
+        if task.done:
+            return
+        if task.sub is not None:
+            self.cancel(task.sub)
+        self._waiting.pop(task, None)
+        try:
+            task.gen.close()
+        except Exception, e:
+            logger.warn('exception closing a cancelled task: %s' % str(e))
+        task.finish(exc_info=(Cancelled, Cancelled(), None))
+
+    def _poll(self, task, now):
+        """Resume `task` if what it waits for has happened"""
+        waitable = self._waiting[task]
+        if waitable is None:
+            self._step(task)
+        elif isinstance(waitable, float):
+            if now < waitable:
+                return False
+            self._step(task)
+        elif hasattr(waitable, 'poll'):
+            # -- subprocess.Popen
+            returncode = waitable.poll()
+            if returncode is None:
+                return False
+            self._step(task, returncode)
+        elif waitable.ready():
+            try:
+                value = waitable.get()
+            except Exception:
+                self._step(task, exc_info=sys.exc_info())
+            else:
+                self._step(task, value)
+        else:
+            return False
+        return True
+
+    def run_until_complete(self, *tasks):
+        """Run the loop until all of `tasks` (Tasks or generators) finish,
+        return their values"""
+        tasks = [t if isinstance(t, Task) else self.spawn(t) for t in tasks]
+        while not all([t.done for t in tasks]):
+            now = time.time()
+            progress = False
+            for task in self._waiting.keys():
+                if task in self._waiting and self._poll(task, now):
+                    progress = True
+            if not progress:
+                self._idle(now)
+        return [t.get() for t in tasks]
+
+    def _idle(self, now):
+        """Sleep until a waiting task may be able to run"""
+        waits = []
+        for waitable in self._waiting.values():
+            if isinstance(waitable, float):
+                waits.append(waitable - now)
+            elif not _in_loop(waitable):
+                waits.append(self.poll_interval)
+        if not waits:
+            # -- every task waits for another: nothing can ever run
+            raise RuntimeError('deadlock: all tasks wait for each other')
+        time.sleep(max(0, min(waits)))
+
+
+def _in_loop(waitable):
+    """Return True if `waitable` can only become ready by the loop
+    running a task"""
+    if isinstance(waitable, Task):
+        return True
+    if isinstance(waitable, WaitAny):
+        return all([_in_loop(w) for w in waitable.waitables])
+    return False
+
+
+class CoroutineExperiment(Experiment):
+    """Experiment whose evaluations run as coroutines on an EventLoop
+
+    If bandit.evaluate is a generator function, each call starts a
+    coroutine; up to max_in_flight of them run at once. Otherwise
+    evaluate() is called directly, as in Experiment.
+
+    run_coroutine(N) is the driver itself, as a coroutine, for running
+    several experiments in one EventLoop.
+    """
+
+    def __init__(self, trials, bandit_algo, max_in_flight=100,
+            max_queue_len=1,
+            ):
+        Experiment.__init__(self, trials, bandit_algo, async=False,
+                max_queue_len=max_queue_len)
+        self.max_in_flight = max_in_flight
+
+    def _start(self, trial, loop):
+        """Start evaluating `trial`, return a Task for the result"""
+        now = datetime.datetime.utcnow()
+        self.trials.update_trial(trial, {
+            'state': JOB_STATE_RUNNING,
+            'book_time': now,
+            'refresh_time': now})
+        spec = copy.deepcopy(trial['spec'])
+        ctrl = Ctrl(self.trials, current_trial=trial)
+        try:
+            rval = self.bandit.evaluate(spec, ctrl)
+        except Exception:
+            task = Task(None)
+            task.finish(exc_info=sys.exc_info())
+            return task
+        if isinstance(rval, types.GeneratorType):
+            return loop.spawn(rval)
+        task = Task(None)
+        task.finish(value=rval)
+        return task
+
+    def _record(self, trial, task):
+        try:
+            result = task.get()
+        except Exception, e:
+            logger.info('job exception: %s' % str(e))
+            trial['misc']['error'] = (str(type(e)), str(e))
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_ERROR,
+                'misc': trial['misc'],
+                'refresh_time': datetime.datetime.utcnow()})
+            if not self.catch_bandit_exceptions:
+                raise
+        else:
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_DONE,
+                'result': result,
+                'refresh_time': datetime.datetime.utcnow()})
+
+    def _abandon(self, running, loop):
+        """Cancel the evaluations of `running` (task -> trial), and mark
+        their trials JOB_STATE_ERROR"""
+        for task, trial in running.items():
+            if task.done:
+                try:
+                    self._record(trial, task)
+                except Exception:
+                    # -- (recorded; the caller is raising another error)
+                    pass
+                continue
+            loop.cancel(task)
+            trial['misc']['error'] = ('cancelled',
+                    'the experiment stopped on an error')
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_ERROR,
+                'misc': trial['misc'],
+                'refresh_time': datetime.datetime.utcnow()})
+        running.clear()
+
+    def run_coroutine(self, N, loop):
+        """Coroutine that suggests and evaluates N trials on `loop`
+
+        It finishes when all of the trials it started are evaluated. If it
+        raises (e.g. an evaluation fails and not catch_bandit_exceptions),
+        the evaluations still running are cancelled and marked
+        JOB_STATE_ERROR.
+        """
+        # -- task -> trial
+        running = {}
+        try:
+            for waitable in self._run_coroutine(N, loop, running):
+                yield waitable
+        except:
+            exc_info = sys.exc_info()
+            self._abandon(running, loop)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _run_coroutine(self, N, loop, running):
+        trials = self.trials
+        algo = self.bandit_algo
+        n_queued = 0
+        stopped = False
+        while True:
+            # -- record every finished task before raising the first error
+            exc_info = None
+            for task in [t for t in running if t.done]:
+                try:
+                    self._record(running.pop(task), task)
+                except Exception:
+                    if exc_info is None:
+                        exc_info = sys.exc_info()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            n_to_enqueue = min(self.max_queue_len,
+                    self.max_in_flight - len(running), N - n_queued)
+            if not stopped and n_to_enqueue > 0:
+                new_ids = trials.new_trial_ids(n_to_enqueue)
+                trials.refresh()
+                new_trials = algo.suggest(new_ids, trials)
+                if new_trials is StopExperiment or not len(new_trials):
+                    stopped = True
+                else:
+                    assert len(new_ids) >= len(new_trials)
+                    trials.insert_trial_docs(new_trials,
+                            validate=self.validate_new_trials)
+                    trials.refresh()
+                    for doc in new_trials:
+                        trial = trials.trial_by_tid(doc['tid'])
+                        running[self._start(trial, loop)] = trial
+                    n_queued += len(new_trials)
+                    # -- let the new evaluations start
+                    yield None
+                    continue
+            elif n_queued >= N:
+                stopped = True
+            if not running:
+                break
+            if stopped or len(running) >= self.max_in_flight:
+                yield WaitAny(running)
+            else:
+                yield None
+        trials.refresh()
+
+    def run(self, N, block_until_done=True):
+        """Suggest and evaluate N trials (block_until_done is ignored:
+        run returns when they are all evaluated)"""
+        loop = EventLoop()
+        loop.run_until_complete(self.run_coroutine(N, loop))
+
+
+def run_experiments(experiments, N):
+    """Run N trials of each CoroutineExperiment, concurrently, in one loop
+    """
+    loop = EventLoop()
+    loop.run_until_complete(*[exp.run_coroutine(N, loop)
+        for exp in experiments])
@@ -0,0 +1,270 @@
+"""Trials backed by an append-only log file on local disk
+
+The log is a sequence of BSON documents (each one is length-prefixed), one
+per operation:
+
+    {'op': 'insert', 'doc': <trial document>}
+    {'op': 'update', 'tid': <tid>, 'set': <dict of new values>}
+    {'op': 'ids', 'stop': <first tid not yet allocated>}
+    {'op': 'attach', 'name': <name>, 'value': <binary string>}
+    {'op': 'detach', 'name': <name>}
+    {'op': 'delete_all'}
+
+Writers hold an exclusive flock on the file while appending. Readers do not
+lock: they decode the complete records that follow the position they have
+read up to, and ignore an incomplete record at the end of the file (a write
+in progress, or a writer that crashed). A writer truncates such a crashed
+write before appending.
+
+So several processes on one host (e.g. a driver and evaluation workers, or
+a plotting script) can share a FileTrials log, and reloading the trials of a
+finished experiment is one sequential read of the file.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import fcntl
+import logging
+import os
+import struct
+
+import bson
+from bson.binary import Binary
+
+from .base import SONify
+from .base import Trials
+
+logger = logging.getLogger(__name__)
+
+
+class TrialLog(object):
+    """In-memory state of a log file, shared by the views of a FileTrials
+    """
+    def __init__(self, path):
+        self.path = path
+        # -- file position up to which records have been applied
+        self.offset = 0
+        self.reset()
+
+    def reset(self):
+        self.dynamic_trials = []
+        self.by_tid = {}
+        self.error_log = []
+        self.state_counts = {}
+        self.attachments = {}
+        self.next_tid = 0
+
+
+class FileAttachments(object):
+    """dict-like interface to the attachments stored in a FileTrials log
+    """
+    def __init__(self, trials):
+        self.trials = trials
+
+    def __contains__(self, name):
+        return name in self.trials._log.attachments
+
+    def __getitem__(self, name):
+        return self.trials._log.attachments[name]
+
+    def __setitem__(self, name, value):
+        self.trials._append([{'op': 'attach', 'name': name,
+            'value': Binary(value)}])
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.trials._append([{'op': 'detach', 'name': name}])
+
+    def __iter__(self):
+        return iter(self.trials._log.attachments)
+
+    def __len__(self):
+        return len(self.trials._log.attachments)
+
+    def keys(self):
+        return self.trials._log.attachments.keys()
+
+
+class FileTrials(Trials):
+    """Trials that are persisted to (and shared through) the file at `path`
+
+    Inserts and updates (see update_trial) are appended to the log
+    immediately; changes made by other processes are picked up by
+    refresh().
+
+    Pickling a FileTrials stores only the path and the exp_key.
+    """
+
+    # -- fsync the log after each append (slower, but survives power loss)
+    fsync = False
+
+    # -- bytes to read from the log at a time
+    read_chunk_size = 32 * 1024 * 1024
+
+    def __init__(self, path, exp_key=None, refresh=True):
+        # -- create the log if necessary
+        open(path, 'ab').close()
+        self._log = TrialLog(path)
+        self._ids = set()
+        self._exp_key = exp_key
+        self.attachments = FileAttachments(self)
+        if refresh:
+            self.refresh()
+
+    def view(self, exp_key=None, refresh=True):
+        rval = object.__new__(self.__class__)
+        rval._log = self._log
+        rval._ids = self._ids
+        rval._exp_key = exp_key
+        rval.attachments = FileAttachments(rval)
+        if refresh:
+            rval.refresh()
+        return rval
+
+    def __getstate__(self):
+        return {'path': self._log.path, 'exp_key': self._exp_key}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['path'], exp_key=dct['exp_key'])
+
+    @property
+    def path(self):
+        return self._log.path
+
+    @property
+    def _dynamic_trials(self):
+        return self._log.dynamic_trials
+
+    @property
+    def _error_log(self):
+        return self._log.error_log
+
+    @property
+    def _state_counts(self):
+        return self._log.state_counts
+
+    def _read(self, fh):
+        """Return the complete records after self._log.offset"""
+        log = self._log
+        size = os.fstat(fh.fileno()).st_size
+        if size < log.offset:
+            # -- the file was replaced or truncated: start over
+            logger.warn('log %s shrank, reloading' % log.path)
+            log.offset = 0
+            log.reset()
+        fh.seek(log.offset)
+        records = []
+        leftover = ''
+        while True:
+            chunk = fh.read(self.read_chunk_size)
+            if not chunk:
+                break
+            data = leftover + chunk
+            end = 0
+            while end + 4 <= len(data):
+                rec_len, = struct.unpack('<i', data[end:end + 4])
+                if end + rec_len > len(data):
+                    break
+                end += rec_len
+            records.extend(bson.decode_all(data[:end]))
+            log.offset += end
+            leftover = data[end:]
+        return records
+
+    def _apply(self, records):
+        log = self._log
+        for rec in records:
+            op = rec['op']
+            if op == 'insert':
+                doc = rec['doc']
+                log.dynamic_trials.append(doc)
+                log.by_tid[doc['tid']] = doc
+                self._count_state(doc, doc['state'], 1)
+                if isinstance(doc['tid'], (int, long)):
+                    log.next_tid = max(log.next_tid, doc['tid'] + 1)
+            elif op == 'update':
+                doc = log.by_tid.get(rec['tid'])
+                if doc is not None:
+                    # -- (it is None if deleted since the update was read)
+                    Trials.update_trial(self, doc, rec['set'])
+            elif op == 'ids':
+                log.next_tid = max(log.next_tid, rec['stop'])
+            elif op == 'attach':
+                log.attachments[rec['name']] = str(rec['value'])
+            elif op == 'detach':
+                log.attachments.pop(rec['name'], None)
+            elif op == 'delete_all':
+                log.reset()
+            else:
+                raise ValueError('unrecognized log record', rec)
+
+    def _sync(self):
+        fh = open(self._log.path, 'rb')
+        try:
+            self._apply(self._read(fh))
+        finally:
+            fh.close()
+
+    def _append(self, records, before_write=None):
+        """Append `records` to the log, and apply them.
+
+        before_write(), if given, is called with the lock held, after all
+        other records have been applied, and can add to `records`.
+        """
+        log = self._log
+        fh = open(log.path, 'r+b')
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            self._apply(self._read(fh))
+            if before_write is not None:
+                before_write(records)
+            if os.fstat(fh.fileno()).st_size > log.offset:
+                # -- left behind by a writer that crashed
+                logger.warn('truncating incomplete record in %s' % log.path)
+                fh.truncate(log.offset)
+            data = ''.join([bson.BSON.encode(rec) for rec in records])
+            fh.seek(log.offset)
+            fh.write(data)
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+            # -- apply the decoded records, so that this process sees
+            #    exactly what other readers of the log see
+            self._apply(bson.decode_all(data))
+            log.offset += len(data)
+        finally:
+            fh.close()  # -- releases the lock
+
+    def refresh(self):
+        self._sync()
+        Trials.refresh(self)
+
+    def _insert_trial_docs(self, docs):
+        self._append([{'op': 'insert', 'doc': doc} for doc in docs])
+        return [doc['tid'] for doc in docs]
+
+    def update_trial(self, trial, dct):
+        tid = trial['tid']
+        self._append([{'op': 'update', 'tid': tid, 'set': SONify(dct)}])
+        rval = self._log.by_tid[tid]
+        if rval is not trial:
+            trial.update(rval)
+        return rval
+
+    def new_trial_ids(self, N):
+        rval = []
+
+        def allocate(records):
+            start = self._log.next_tid
+            rval.extend(range(start, start + N))
+            records.append({'op': 'ids', 'stop': start + N})
+        self._append([], before_write=allocate)
+        self._ids.update(rval)
+        return rval
+
+    def delete_all(self):
+        self._append([{'op': 'delete_all'}])
+        self.refresh()
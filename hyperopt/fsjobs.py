@@ -0,0 +1,625 @@
+"""Jobs database in a directory tree, for clusters that share only a
+POSIX filesystem
+
+Each job is one BSON file, named by its _id, in a directory given by its
+state:
+
+    <root>/new/<exp_key>/<_id>
+    <root>/running/<owner>/<_id>
+    <root>/done/<_id>
+    <root>/error/<_id>
+
+FSJobs.reserve claims a job by renaming it from new/ to running/<owner>/;
+rename is atomic, so exactly one of the workers racing for a job succeeds,
+and no lock server is needed. Likewise every update first renames the
+job file out of the tree (into <root>/tmp/) to gain exclusive access,
+checks the version, and then renames the new version into place.
+
+Attachments are files under <root>/attachments/<_id>/, and trial ids are
+allocated from the counter file <root>/ids under flock.
+
+FSTrials and FSWorker (bin/hyperopt-fs-worker) correspond to MongoTrials
+and MongoWorker.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import copy
+import errno
+import fcntl
+import logging
+import optparse
+import os
+import shutil
+import sys
+import time
+import urllib
+import uuid
+
+import bson
+
+from .base import JOB_STATES
+from .base import JOB_STATE_NEW
+from .base import JOB_STATE_RUNNING
+from .base import JOB_STATE_DONE
+from .base import JOB_STATE_ERROR
+from .base import Trials
+from .mongoexp import MongoWorker
+from .mongoexp import OperationFailure
+from .mongoexp import cancel_new_jobs
+from .mongoexp import coarse_utcnow
+from .mongoexp import worker_subprocess_loop
+
+logger = logging.getLogger(__name__)
+
+STATE_DIRS = {
+    JOB_STATE_NEW: 'new',
+    JOB_STATE_RUNNING: 'running',
+    JOB_STATE_DONE: 'done',
+    JOB_STATE_ERROR: 'error',
+    }
+
+# -- _id under which trials-level (not per-job) attachments are stored
+TRIALS_ATTACHMENTS_ID = '_trials'
+
+
+def _quote(name):
+    """Return a directory name for `name` (an exp_key or an owner)"""
+    if name is None:
+        return '%none'  # -- quote() would escape the '%'
+    if isinstance(name, (list, tuple)):
+        # -- e.g. a (host, pid) owner, which comes back from BSON as a list
+        name = ':'.join(map(str, name))
+    return urllib.quote(str(name), safe='')
+
+
+def _ignore_missing(fn, *args):
+    """Call fn(*args), return False if it failed for lack of a file"""
+    try:
+        fn(*args)
+        return True
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class FSJobs(object):
+    """
+    Interface to a jobs database in the directory `root`
+    """
+    def __init__(self, root):
+        self.root = root
+        for dirname in STATE_DIRS.values() + ['tmp', 'attachments']:
+            _makedirs(os.path.join(root, dirname))
+
+    def __getstate__(self):
+        return {'root': self.root}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['root'])
+
+    def __len__(self):
+        return len(self._scan())
+
+    def _path(self, doc):
+        dirname = STATE_DIRS[doc['state']]
+        if doc['state'] == JOB_STATE_NEW:
+            dirname = os.path.join(dirname, _quote(doc.get('exp_key')))
+        elif doc['state'] == JOB_STATE_RUNNING:
+            dirname = os.path.join(dirname, _quote(doc.get('owner')))
+        return os.path.join(self.root, dirname, doc['_id'])
+
+    def _tmp_path(self, _id):
+        return os.path.join(self.root, 'tmp',
+                '%s.%i.%s' % (_id, os.getpid(), uuid.uuid4().hex))
+
+    def _read(self, path):
+        fh = open(path, 'rb')
+        try:
+            return bson.BSON(fh.read()).decode()
+        finally:
+            fh.close()
+
+    def _write(self, doc):
+        """Atomically (re)place `doc` at its path"""
+        path = self._path(doc)
+        tmp = self._tmp_path(doc['_id'])
+        fh = open(tmp, 'wb')
+        try:
+            fh.write(bson.BSON.encode(doc))
+        finally:
+            fh.close()
+        try:
+            os.rename(tmp, path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # -- first job for this exp_key or owner
+            _makedirs(os.path.dirname(path))
+            os.rename(tmp, path)
+
+    def _scan(self):
+        """Return the paths of all jobs"""
+        rval = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if dirpath == self.root:
+                dirnames[:] = [d for d in dirnames
+                        if d in STATE_DIRS.values()]
+            rval.extend([os.path.join(dirpath, f) for f in filenames])
+        return rval
+
+    def insert_docs(self, docs):
+        """Insert copies of `docs`, return the copies (which have an _id)"""
+        rval = []
+        for doc in docs:
+            cpy = copy.deepcopy(doc)
+            cpy.setdefault('version', 0)
+            # -- _ids sort (roughly) in insertion order
+            cpy['_id'] = '%016x%s' % (int(time.time() * 1e6),
+                    uuid.uuid4().hex[:8])
+            self._write(cpy)
+            rval.append(cpy)
+        return rval
+
+    def insert(self, job):
+        """Return a job dictionary by inserting the job dict into the database"""
+        return self.insert_docs([job])[0]
+
+    def find(self, exp_key=None, cache=None):
+        """Return the jobs (of `exp_key`, if not None)
+
+        cache, if given, is a dict path -> (stat key, doc) that is used to
+        avoid re-reading unchanged files, and is updated.
+        """
+        if cache is None:
+            cache = {}
+        rval = []
+        seen = set()
+        for path, doc in self._read_paths(self._scan(), cache):
+            seen.add(path)
+            if exp_key is None or doc.get('exp_key') == exp_key:
+                rval.append(doc)
+        for path in set(cache) - seen:
+            del cache[path]
+        return rval
+
+    def _read_paths(self, paths, cache):
+        """Return (path, doc) for each of `paths` that still exists,
+        reading only the files that changed since they were cached"""
+        rval = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue  # -- moved since the scan
+            key = (st.st_ino, st.st_mtime, st.st_size)
+            if path in cache and cache[path][0] == key:
+                doc = cache[path][1]
+            else:
+                try:
+                    doc = self._read(path)
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                cache[path] = (key, doc)
+            rval.append((path, doc))
+        return rval
+
+    def count(self, states, exp_key=None, cache=None):
+        """Return the number of jobs (of `exp_key`, if not None) in
+        `states`
+
+        New jobs are filed by exp_key, so they are counted without reading
+        any file. Jobs in other states are read, unless they are in
+        `cache` (see find) and unchanged.
+        """
+        if cache is None:
+            cache = {}
+        rval = 0
+        paths = []
+        for state in states:
+            if exp_key is None:
+                rval += len(self._scan_state(state))
+            elif state == JOB_STATE_NEW:
+                try:
+                    rval += len(os.listdir(os.path.join(self.root,
+                        STATE_DIRS[state], _quote(exp_key))))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            else:
+                paths.extend(self._scan_state(state))
+        for path, doc in self._read_paths(paths, cache):
+            if doc.get('exp_key') == exp_key:
+                rval += 1
+        return rval
+
+    def in_flight(self):
+        """Return the _ids of jobs that are being updated"""
+        return set([f.split('.')[0]
+            for f in os.listdir(os.path.join(self.root, 'tmp'))])
+
+    def _scan_state(self, state):
+        top = os.path.join(self.root, STATE_DIRS[state])
+        rval = []
+        for dirpath, dirnames, filenames in os.walk(top):
+            rval.extend([os.path.join(dirpath, f) for f in filenames])
+        return rval
+
+    def reserve(self, host_id, cond=None, exp_key=None):
+        """Claim a new job for `host_id`, or return None"""
+        if cond:
+            cond = dict(cond)
+            if 'exp_key' in cond:
+                exp_key = cond.pop('exp_key')
+            if cond.get('owner') is not None:
+                raise ValueError('refusing to reserve owned job')
+            cond.pop('owner', None)
+            if cond:
+                raise NotImplementedError('reserve condition', cond)
+        new_dir = os.path.join(self.root, STATE_DIRS[JOB_STATE_NEW])
+        if exp_key is None:
+            key_dirs = os.listdir(new_dir)
+        else:
+            key_dirs = [_quote(exp_key)]
+        candidates = []
+        for key_dir in key_dirs:
+            try:
+                filenames = os.listdir(os.path.join(new_dir, key_dir))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            candidates.extend([(f, key_dir) for f in filenames])
+        candidates.sort()
+
+        claim_dir = os.path.join(self.root, STATE_DIRS[JOB_STATE_RUNNING],
+                _quote(host_id))
+        _makedirs(claim_dir)
+        for _id, key_dir in candidates:
+            claim = os.path.join(claim_dir, _id)
+            if not _ignore_missing(os.rename,
+                    os.path.join(new_dir, key_dir, _id), claim):
+                continue  # -- another worker got it first
+            now = coarse_utcnow()
+            doc = self._read(claim)
+            doc.update({
+                'owner': host_id,
+                'book_time': now,
+                'state': JOB_STATE_RUNNING,
+                'refresh_time': now,
+                'version': doc['version'] + 1})
+            self._write(doc)
+            return doc
+        return None
+
+    def refresh(self, doc, safe=False):
+        self.update(doc, dict(refresh_time=coarse_utcnow()), safe=False)
+
+    def update(self, doc, dct, safe=True):
+        """Return union of doc and dct, after making sure that dct has been
+        added to doc in the database.
+
+        Like MongoJobs.update, `doc` is updated in place, and its version is
+        incremented. If the stored job has a different version, the stored
+        job is not modified, and (if safe) OperationFailure is raised.
+        """
+        dct = copy.deepcopy(dct)
+        if '_id' in dct:
+            raise ValueError('cannot update the _id field')
+        if 'version' in dct:
+            raise ValueError('cannot update the version field')
+        if '_id' not in doc:
+            raise ValueError('doc must have an "_id" key to be updated')
+
+        path = self._path(doc)
+        claim = self._tmp_path(doc['_id'])
+        ok = _ignore_missing(os.rename, path, claim)
+        if ok:
+            server_doc = self._read(claim)
+            if server_doc['version'] != doc.get('version', 0):
+                os.rename(claim, path)
+                ok = False
+        if ok:
+            server_doc.update(dct)
+            server_doc['version'] += 1
+            self._write(server_doc)
+            os.unlink(claim)
+            doc.update(dct)
+            doc['version'] = doc.get('version', 0) + 1
+        elif safe:
+            raise OperationFailure('updated doc not found : %s' % str(doc))
+        return doc
+
+    def delete_all(self, cond={}):
+        """Delete all jobs (matching `cond`) and their attachments"""
+        cond = dict(cond)
+        exp_key = cond.pop('exp_key', None)
+        states = [cond.pop('state')] if 'state' in cond else JOB_STATES
+        if cond:
+            raise NotImplementedError('delete condition', cond)
+        for state in states:
+            for path in self._scan_state(state):
+                if exp_key is not None:
+                    try:
+                        if self._read(path).get('exp_key') != exp_key:
+                            continue
+                    except IOError:
+                        continue
+                if _ignore_missing(os.unlink, path):
+                    shutil.rmtree(self._attachment_dir(
+                        {'_id': os.path.basename(path)}), ignore_errors=True)
+
+    def delete_all_error_jobs(self):
+        return self.delete_all(cond={'state': JOB_STATE_ERROR})
+
+    def new_trial_ids(self, N):
+        fh = open(os.path.join(self.root, 'ids'), 'a+b')
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            fh.seek(0)
+            start = int(fh.read() or 0)
+            fh.truncate(0)
+            fh.write(str(start + N))
+            fh.flush()
+        finally:
+            fh.close()  # -- releases the lock
+        return range(start, start + N)
+
+    def _attachment_dir(self, doc):
+        return os.path.join(self.root, 'attachments', doc['_id'])
+
+    def attachment_names(self, doc):
+        try:
+            filenames = os.listdir(self._attachment_dir(doc))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return [urllib.unquote(f) for f in filenames]
+
+    def set_attachment(self, doc, blob, name):
+        """Attach data string `blob` to `doc` by name `name`"""
+        dirname = self._attachment_dir(doc)
+        _makedirs(dirname)
+        tmp = self._tmp_path(doc['_id'])
+        fh = open(tmp, 'wb')
+        try:
+            fh.write(blob)
+        finally:
+            fh.close()
+        os.rename(tmp, os.path.join(dirname, urllib.quote(name, safe='')))
+
+    def get_attachment(self, doc, name):
+        """Retrieve data attached to `doc` by `set_attachment`.
+
+        Raises OperationFailure if `name` does not correspond to an attached blob.
+
+        Returns the blob as a string.
+        """
+        path = os.path.join(self._attachment_dir(doc),
+                urllib.quote(name, safe=''))
+        try:
+            fh = open(path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise OperationFailure('Attachment not found: %s' % name)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def delete_attachment(self, doc, name):
+        path = os.path.join(self._attachment_dir(doc),
+                urllib.quote(name, safe=''))
+        if not _ignore_missing(os.unlink, path):
+            raise OperationFailure('Attachment not found: %s' % name)
+
+
+class FSTrials(Trials):
+    """Trials stored in a directory tree (see FSJobs)
+
+    arg is either a FSJobs instance, or the root directory.
+    """
+    async = True
+
+    def __init__(self, arg, exp_key=None, cmd=None, workdir=None,
+            refresh=True):
+        if isinstance(arg, FSJobs):
+            self.handle = arg
+        else:
+            self.handle = FSJobs(arg)
+        self._exp_key = exp_key
+        self.cmd = cmd
+        self.workdir = workdir
+        self._file_cache = {}
+        if refresh:
+            self.refresh()
+
+    def view(self, exp_key=None, cmd=None, workdir=None, refresh=True):
+        rval = self.__class__(self.handle,
+                exp_key=self._exp_key if exp_key is None else exp_key,
+                cmd=self.cmd if cmd is None else cmd,
+                workdir=self.workdir if workdir is None else workdir,
+                refresh=refresh)
+        return rval
+
+    def refresh(self):
+        # -- a job that is being updated is briefly absent from the tree;
+        #    keep the copy from the previous refresh until it reappears
+        docs = getattr(self, '_docs_by_id', {})
+        found = self.handle.find(self._exp_key, cache=self._file_cache)
+        by_id = {}
+        for doc in found:
+            if (doc['_id'] not in by_id
+                    or by_id[doc['_id']]['version'] < doc['version']):
+                by_id[doc['_id']] = doc
+        in_flight = self.handle.in_flight()
+        for _id, doc in docs.items():
+            if _id not in by_id and _id in in_flight:
+                by_id[_id] = doc
+        self._docs_by_id = by_id
+        self._set_trials([by_id[_id] for _id in sorted(by_id)
+            if by_id[_id]['state'] != JOB_STATE_ERROR])
+
+    def _insert_trial_docs(self, docs):
+        return [doc['_id'] for doc in self.handle.insert_docs(docs)]
+
+    def update_trial(self, trial, dct):
+        return self.handle.update(trial, dct)
+
+    def cancel_new_trials(self, reason):
+        return cancel_new_jobs(self.handle, self._exp_key, reason)
+
+    def count_by_state_unsynced(self, arg):
+        if arg in JOB_STATES:
+            states = [arg]
+        else:
+            assert hasattr(arg, '__iter__')
+            states = list(arg)
+            assert all([x in JOB_STATES for x in states])
+        return self.handle.count(states, exp_key=self._exp_key,
+                cache=self._file_cache)
+
+    def delete_all(self):
+        if self._exp_key:
+            cond = {'exp_key': self._exp_key}
+        else:
+            cond = {}
+        self.handle.delete_all(cond)
+        shutil.rmtree(self.handle._attachment_dir(
+            {'_id': TRIALS_ATTACHMENTS_ID}), ignore_errors=True)
+        self._docs_by_id = {}
+        self.refresh()
+
+    def new_trial_ids(self, N):
+        # -- unique across the database, as in MongoTrials
+        return self.handle.new_trial_ids(N)
+
+    def trial_attachments(self, trial):
+        """
+        Support syntax for load:  self.attachments[name]
+        Support syntax for store: self.attachments[name] = value
+        """
+        handle = self.handle
+
+        # don't offer more here than in MongoCtrl
+        class Attachments(object):
+            def __contains__(_self, name):
+                return name in handle.attachment_names(doc=trial)
+
+            def __getitem__(_self, name):
+                try:
+                    return handle.get_attachment(doc=trial, name=name)
+                except OperationFailure:
+                    raise KeyError(name)
+
+            def __setitem__(_self, name, value):
+                handle.set_attachment(doc=trial, blob=value, name=name)
+
+            def __delitem__(_self, name):
+                try:
+                    handle.delete_attachment(doc=trial, name=name)
+                except OperationFailure:
+                    raise KeyError(name)
+
+        return Attachments()
+
+    @property
+    def attachments(self):
+        """
+        Support syntax for load:  self.attachments[name]
+        Support syntax for store: self.attachments[name] = value
+        NB THIS IS TRIALS-LEVEL ATTACHMENTS, NOT DOCUMENT-LEVEL ATTACHMENTS!!!
+        """
+        return self.trial_attachments({'_id': TRIALS_ATTACHMENTS_ID})
+
+
+class FSWorker(MongoWorker):
+    """MongoWorker that takes its jobs from a FSJobs directory"""
+    trials_cls = FSTrials
+
+
+def main_worker_helper(options, args):
+    N = int(options.max_jobs)
+
+    if N > 1:
+        sub_argv = [sys.argv[0],
+                '--poll-interval=%s' % options.poll_interval,
+                '--max-jobs=1',
+                '--root=%s' % options.root]
+        if options.workdir is not None:
+            sub_argv.append('--workdir=%s' % options.workdir)
+        if options.exp_key is not None:
+            sub_argv.append('--exp-key=%s' % options.exp_key)
+        return worker_subprocess_loop(N, options, sub_argv)
+    elif N == 1:
+        worker = FSWorker(FSJobs(options.root),
+                float(options.poll_interval),
+                workdir=options.workdir,
+                exp_key=options.exp_key)
+        worker.run_one(reserve_timeout=float(options.reserve_timeout))
+    else:
+        return -1
+
+
+def main_worker():
+    parser = optparse.OptionParser(usage="%prog [options]")
+
+    parser.add_option("--max-consecutive-failures",
+            dest="max_consecutive_failures",
+            metavar='N',
+            default=4,
+            help="stop if N consecutive jobs fail (default: 4)",
+            )
+    parser.add_option("--exp-key",
+            dest='exp_key',
+            default = None,
+            metavar='str',
+            help="identifier for this workers's jobs")
+    parser.add_option("--poll-interval",
+            dest='poll_interval',
+            metavar='N',
+            default=5,
+            help="check work queue every 1 < T < N seconds (default: 5")
+    parser.add_option("--max-jobs",
+            dest='max_jobs',
+            default=sys.maxint,
+            help="stop after running this many jobs (default: inf)")
+    parser.add_option("--root",
+            dest='root',
+            default='hyperopt_jobs',
+            help="root directory of the jobs database")
+    parser.add_option("--reserve-timeout",
+            dest='reserve_timeout',
+            metavar='T',
+            default=120.0,
+            help="poll database for up to T seconds to reserve a job")
+    parser.add_option("--workdir",
+            dest="workdir",
+            default=None,
+            help="root workdir (default: load from the job's misc)",
+            metavar="DIR")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help()
+        return -1
+
+    return main_worker_helper(options, args)
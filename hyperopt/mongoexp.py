@@ -152,6 +152,11 @@ import numpy
 import pymongo
 import gridfs
 from bson import SON
+try:
+    from pymongo import CursorType
+except ImportError:
+    # -- pymongo < 3.0
+    CursorType = None
 
 
 logger = logging.getLogger(__name__)
@@ -160,11 +165,14 @@ from .base import JOB_STATES
 from .base import (JOB_STATE_NEW, JOB_STATE_RUNNING, JOB_STATE_DONE,
         JOB_STATE_ERROR)
 from .base import Experiment
+from .base import QueueLengthController
+from .base import RunBudget
 from .base import Trials
 from .base import trials_from_docs
 from .base import InvalidTrial
 from .base import Ctrl
 from .base import SONify
+from .base import compact_misc
 from .utils import fast_isin
 from .utils import get_most_recent_inds
 from .utils import json_call
@@ -316,6 +324,26 @@ def coarse_utcnow():
     return datetime.datetime(now.year, now.month, now.day, now.hour, now.minute, now.second, microsec)
 
 
+def cancel_new_jobs(handle, exp_key, reason):
+    """Move the NEW jobs of `exp_key` (all of them, if None) in `handle`
+    to JOB_STATE_ERROR, with error ('cancelled', reason), and return how
+    many there were.
+
+    Each job is reserved first, so a job that a worker has taken is left
+    alone. handle can be a MongoJobs, or any jobs interface with its
+    reserve and update methods.
+    """
+    owner = 'cancelled:%s:%i' % (socket.gethostname(), os.getpid())
+    rval = 0
+    job = handle.reserve(owner, exp_key=exp_key)
+    while job is not None:
+        handle.update(job, {'state': JOB_STATE_ERROR,
+                            'error': ('cancelled', reason)})
+        rval += 1
+        job = handle.reserve(owner, exp_key=exp_key)
+    return rval
+
+
 class MongoJobs(object):
     """
     # Interface to a Jobs database structured like this
@@ -328,7 +356,14 @@ class MongoJobs(object):
     #
     # db.gfs - file storage via gridFS for all collections
     #
+    # db.job_events - capped collection of {'exp_key', 'tid', 'state'}
+    #    logged whenever a job changes state, which drivers tail to wake
+    #    up when jobs are reserved or finish
+    #
     """
+    events_coll = 'job_events'
+    events_size = 2 ** 20  # -- bytes
+
     def __init__(self, db, jobs, gfs, conn, tunnel, config_name):
         self.db = db
         self.jobs = jobs
@@ -439,6 +474,30 @@ class MongoJobs(object):
     def delete_all_error_jobs(self, safe=True):
         return self.delete_all(cond={'state': JOB_STATE_ERROR}, safe=safe)
 
+    def compact_miscs(self, cond={}, safe=True):
+        """Rewrite the misc of jobs matching `cond` in the compact format
+
+        See base.compact_misc. The information content of each job is
+        unchanged, so job versions are not incremented.
+
+        Returns the number of jobs rewritten.
+        """
+        query = dict(cond)
+        query['misc.idxs'] = {'$ne': None}
+        rval = 0
+        try:
+            for d in self.jobs.find(spec=query, fields=['_id', 'misc']):
+                misc = compact_misc(d['misc'])
+                self.jobs.update({'_id': d['_id']},
+                        {'$set': {'misc.idxs': None,
+                                  'misc.vals': misc['vals']}},
+                        safe=safe, upsert=False, multi=False)
+                rval += 1
+        except pymongo.errors.OperationFailure, e:
+            raise OperationFailure(e)
+        logger.info('compacted the misc of %i jobs' % rval)
+        return rval
+
     def reserve(self, host_id, cond=None, exp_key=None):
         now = coarse_utcnow()
         if cond is None:
@@ -473,6 +532,8 @@ class MongoJobs(object):
         except pymongo.errors.OperationFailure, e:
             logger.error('Error during reserve_job: %s'%str(e))
             rval = None
+        if rval is not None:
+            self.signal(rval)
         return rval
 
     def refresh(self, doc, safe=False):
@@ -519,6 +580,8 @@ class MongoJobs(object):
 
         # update doc in-place to match what happened on the server side
         doc.update(dct)
+        if 'state' in dct and collection is self.coll:
+            self.signal(doc)
 
         if safe:
             server_doc = collection.find_one(
@@ -545,6 +608,98 @@ class MongoJobs(object):
                             repr((doc, server_doc, mismatching_keys)))
         return doc
 
+    def _events(self):
+        """Return the capped collection of job events, creating it if
+        necessary"""
+        events = self.db[self.events_coll]
+        if not getattr(self, '_events_created', False):
+            try:
+                self.db.create_collection(self.events_coll, capped=True,
+                        size=self.events_size)
+                # -- a tailable cursor on an empty collection dies at once
+                events.insert({'exp_key': None, 'tid': None, 'state': None},
+                        safe=True)
+            except pymongo.errors.CollectionInvalid:
+                pass  # -- it exists already
+            self._events_created = True
+        return events
+
+    def signal(self, doc):
+        """Log a state change of job `doc` for drivers to wake up on"""
+        try:
+            self._events().insert({
+                'exp_key': doc.get('exp_key'),
+                'tid': doc.get('tid'),
+                'state': doc.get('state')}, safe=False)
+        except pymongo.errors.PyMongoError, e:
+            logger.warn('failed to log job event: %s' % str(e))
+
+    def last_signal(self):
+        """Return the _id of the latest job event, or None"""
+        try:
+            docs = list(self._events().find().sort('$natural', -1).limit(1))
+        except pymongo.errors.PyMongoError, e:
+            logger.warn('failed to read job events: %s' % str(e))
+            return None
+        if docs:
+            return docs[0]['_id']
+
+    def wait_for_signal(self, after, exp_key=None, timeout=1.0):
+        """Wait at most `timeout` seconds for a job event (about a job of
+        `exp_key`, if not None) newer than event id `after`.
+
+        Returns True if one came. If the events cannot be tailed, this
+        sleeps for `timeout` seconds and returns False.
+
+        N.B. events are ordered by _id, so an event logged by a host whose
+        clock lags may be missed; the caller then wakes up at the timeout.
+        """
+        deadline = time.time() + timeout
+        try:
+            events = self._events()
+            cursor = None
+            while time.time() < deadline:
+                if cursor is not None and not cursor.alive:
+                    # -- don't spin if the server keeps killing the cursor
+                    time.sleep(min(0.1, max(0, deadline - time.time())))
+                if cursor is None or not cursor.alive:
+                    # -- a tailable cursor whose first batch is empty dies
+                    #    at once, so tail from event `after` itself, which
+                    #    is skipped below. exp_key is matched here rather
+                    #    than in the query for the same reason.
+                    query = {}
+                    if after is not None:
+                        query['_id'] = {'$gte': after}
+                    cursor = self._tail(events, query, deadline)
+                # -- each pass awaits data on the server for a while
+                for doc in cursor:
+                    if doc['_id'] == after:
+                        continue
+                    if exp_key is None or doc.get('exp_key') == exp_key:
+                        return True
+                    after = doc['_id']
+                    if time.time() >= deadline:
+                        break
+        except pymongo.errors.PyMongoError, e:
+            logger.debug('failed to tail job events: %s' % str(e))
+        remaining = deadline - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return False
+
+    def _tail(self, events, query, deadline):
+        """Return a tailable, awaiting cursor over `query` in `events`"""
+        if CursorType is not None:
+            cursor = events.find(query,
+                    cursor_type=CursorType.TAILABLE_AWAIT)
+        else:
+            cursor = events.find(query, tailable=True, await_data=True)
+        if hasattr(cursor, 'max_await_time_ms'):
+            # -- pymongo >= 3.2: don't await data past the deadline
+            wait_ms = int(1000 * (deadline - time.time()))
+            cursor.max_await_time_ms(max(1, min(wait_ms, 1000)))
+        return cursor
+
     def attachment_names(self, doc):
         return [a[0] for a in doc.get('_attachments', [])]
 
@@ -632,6 +787,10 @@ class MongoTrials(Trials):
     """
     async = True
 
+    # -- pymongo has no way to insert pre-encoded documents, but it encodes
+    #    (and so checks) each doc exactly once on insert
+    _insert_checks_encoding = True
+
     def __init__(self, arg, exp_key=None, cmd=None, workdir=None,
             refresh=True):
         if isinstance(arg, MongoJobs):
@@ -738,16 +897,30 @@ class MongoTrials(Trials):
         jarray = numpy.array([j['_id'] for j in _trials])
         jobsort = jarray.argsort()
   
-        self._trials = [_trials[_idx] for _idx in jobsort]
+        self._set_trials([_trials[_idx] for _idx in jobsort])
         self._specs = [_trials[_idx]['spec'] for _idx in jobsort]
         self._results = [_trials[_idx]['result'] for _idx in jobsort]
         self._miscs = [_trials[_idx]['misc'] for _idx in jobsort]
 
     def _insert_trial_docs(self, docs):
-        rval = []
-        for doc in docs:
-            rval.append(self.handle.jobs.insert(doc, safe=True))
-        return rval
+        if not docs:
+            return []
+        # -- one call: pymongo encodes the docs of each (up to 48MB) insert
+        #    message before sending it, so an unencodable doc means none
+        #    of a normal-sized batch of trials is inserted
+        return self.handle.jobs.insert(list(docs), safe=True)
+
+    def update_trial(self, trial, dct):
+        return self.handle.update(trial, dct)
+
+    def cancel_new_trials(self, reason):
+        return cancel_new_jobs(self.handle, self._exp_key, reason)
+
+    def change_token(self):
+        return self.handle.last_signal()
+
+    def wait_for_change(self, token, timeout):
+        return self.handle.wait_for_signal(token, self._exp_key, timeout)
 
     def count_by_state_unsynced(self, arg):
         exp_key = self._exp_key
@@ -873,6 +1046,11 @@ class MongoWorker(object):
     poll_interval = 3.0  # -- seconds
     workdir = None
 
+    # -- Trials subclass wrapping `mj`, for the Ctrl passed to jobs. Any jobs
+    #    interface with the reserve/update/refresh/attachment methods of
+    #    MongoJobs can be used, together with a matching Trials class.
+    trials_cls = None
+
     def __init__(self, mj,
             poll_interval=poll_interval,
             workdir=workdir,
@@ -911,8 +1089,11 @@ class MongoWorker(object):
         # -- don't let the cmd mess up our trial object
         spec = copy.deepcopy(job['spec'])
 
+        trials_cls = self.trials_cls
+        if trials_cls is None:
+            trials_cls = MongoTrials
         ctrl = MongoCtrl(
-                trials=MongoTrials(mj, exp_key=job['exp_key'], refresh=False),
+                trials=trials_cls(mj, exp_key=job['exp_key'], refresh=False),
                 read_only=False,
                 current_trial=job)
         if self.workdir is None:
@@ -1038,53 +1219,62 @@ def as_mongo_str(s):
         return 'mongo://%s' % s
 
 
+def worker_subprocess_loop(N, options, sub_argv):
+    """Run `sub_argv` (a worker command that runs one job) N times
+
+    Stops early after options.max_consecutive_failures consecutive failures,
+    or when this process is told to shut down.
+    """
+    def sighandler_shutdown(signum, frame):
+        logger.info('Caught signal %i, shutting down.' % signum)
+        raise Shutdown(signum)
+    signal.signal(signal.SIGINT, sighandler_shutdown)
+    signal.signal(signal.SIGHUP, sighandler_shutdown)
+    signal.signal(signal.SIGTERM, sighandler_shutdown)
+    proc = None
+    cons_errs = 0
+    while N and cons_errs < int(options.max_consecutive_failures):
+        try:
+            # recursive Popen, dropping N from the argv
+            # By using another process to run this job
+            # we protect ourselves from memory leaks, bad cleanup
+            # and other annoying details.
+            # The tradeoff is that a large dataset must be reloaded once for
+            # each subprocess.
+            proc = subprocess.Popen(sub_argv)
+            retcode = proc.wait()
+            proc = None
+        except Shutdown, e:
+            #this is the normal way to stop the infinite loop (if originally N=-1)
+            if proc:
+                #proc.terminate() is only available as of 2.6
+                os.kill(proc.pid, signal.SIGTERM)
+                return proc.wait()
+            else:
+                return 0
+
+        if retcode != 0:
+            cons_errs += 1
+        else:
+            cons_errs = 0
+        N -= 1
+    logger.info("exiting with N=%i after %i consecutive exceptions" %(
+        N, cons_errs))
+
+
 def main_worker_helper(options, args):
     N = int(options.max_jobs)
 
     if N > 1:
-        def sighandler_shutdown(signum, frame):
-            logger.info('Caught signal %i, shutting down.' % signum)
-            raise Shutdown(signum)
-        signal.signal(signal.SIGINT, sighandler_shutdown)
-        signal.signal(signal.SIGHUP, sighandler_shutdown)
-        signal.signal(signal.SIGTERM, sighandler_shutdown)
-        proc = None
-        cons_errs = 0
-        while N and cons_errs < int(options.max_consecutive_failures):
-            try:
-                # recursive Popen, dropping N from the argv
-                # By using another process to run this job
-                # we protect ourselves from memory leaks, bad cleanup
-                # and other annoying details.
-                # The tradeoff is that a large dataset must be reloaded once for
-                # each subprocess.
-                sub_argv = [sys.argv[0],
-                        '--poll-interval=%s' % options.poll_interval,
-                        '--max-jobs=1',
-                        '--mongo=%s' % options.mongo]
-                if options.workdir is not None:
-                    sub_argv.append('--workdir=%s' % options.workdir)
-                if options.exp_key is not None:
-                    sub_argv.append('--exp-key=%s' % options.exp_key)
-                proc = subprocess.Popen(sub_argv)
-                retcode = proc.wait()
-                proc = None
-            except Shutdown, e:
-                #this is the normal way to stop the infinite loop (if originally N=-1)
-                if proc:
-                    #proc.terminate() is only available as of 2.6
-                    os.kill(proc.pid, signal.SIGTERM)
-                    return proc.wait()
-                else:
-                    return 0
-
-            if retcode != 0:
-                cons_errs += 1
-            else:
-                cons_errs = 0
-            N -= 1
-        logger.info("exiting with N=%i after %i consecutive exceptions" %(
-            N, cons_errs))
+        sub_argv = [sys.argv[0],
+                '--poll-interval=%s' % options.poll_interval,
+                '--max-jobs=1',
+                '--mongo=%s' % options.mongo]
+        if options.workdir is not None:
+            sub_argv.append('--workdir=%s' % options.workdir)
+        if options.exp_key is not None:
+            sub_argv.append('--exp-key=%s' % options.exp_key)
+        return worker_subprocess_loop(N, options, sub_argv)
     elif N == 1:
         # XXX: the name of the jobs collection is a parameter elsewhere,
         #      so '/jobs' should not be hard-coded here
@@ -1208,6 +1398,26 @@ def expkey_from_options(options, bandit_stuff, algo_stuff):
     return exp_key
 
 
+def budget_from_options(options, bandit):
+    """Return a RunBudget for the budget options, or None if none are set
+    """
+    loss_target = options.loss_target
+    if loss_target == 'bandit':
+        loss_target = bandit.loss_target
+    elif loss_target is not None:
+        loss_target = float(loss_target)
+    if (options.wall_budget is None and options.worker_budget is None
+            and loss_target is None):
+        return None
+    return RunBudget(
+            wall_secs=(float(options.wall_budget)
+                if options.wall_budget is not None else None),
+            worker_secs=(float(options.worker_budget)
+                if options.worker_budget is not None else None),
+            loss_target=loss_target,
+            cancel_new=options.cancel_queued)
+
+
 def main_search_helper(options, args, input=input, cmd_type=None):
     """
     input is an argument so that unittest can replace stdin
@@ -1260,11 +1470,23 @@ def main_search_helper(options, args, input=input, cmd_type=None):
     algo.cmd = worker_cmd
     algo.workdir=options.workdir
 
+    if options.max_queue_len == 'auto':
+        max_queue_len = 1
+        # -- an idle MongoWorker sleeps 1 to poll_interval seconds between
+        #    attempts to reserve a job
+        queue_length_controller = QueueLengthController(
+                reserve_secs=(1 + MongoWorker.poll_interval) / 2.0)
+    else:
+        max_queue_len = int(options.max_queue_len)
+        queue_length_controller = None
+
     self = Experiment(trials,
         bandit_algo=algo,
         poll_interval_secs=(int(options.poll_interval))
             if options.poll_interval else 5,
-        max_queue_len=options.max_queue_len)
+        max_queue_len=max_queue_len)
+    self.queue_length_controller = queue_length_controller
+    self.budget = budget_from_options(options, bandit)
 
     self.run(options.steps, block_until_done=options.block)
 
@@ -1335,7 +1557,29 @@ def main_search():
     parser.add_option("--max-queue-len",
             dest="max_queue_len",
             default=1,
-            help="maximum number of jobs to allow in queue")
+            help="maximum number of jobs to allow in queue, or 'auto' to"
+                 " adapt it to the number and speed of workers")
+    parser.add_option("--wall-budget",
+            dest="wall_budget",
+            metavar="SECS",
+            default=None,
+            help="stop queuing jobs after SECS seconds")
+    parser.add_option("--worker-budget",
+            dest="worker_budget",
+            metavar="SECS",
+            default=None,
+            help="stop queuing jobs once they have taken SECS seconds of"
+                 " worker time in total")
+    parser.add_option("--loss-target",
+            dest="loss_target",
+            default=None,
+            help="stop queuing jobs once one reaches this loss ('bandit'"
+                 " for the bandit's loss_target)")
+    parser.add_option("--cancel-queued",
+            dest="cancel_queued",
+            action="store_true",
+            default=False,
+            help="cancel the queued jobs when a budget is exhausted")
 
     (options, args) = parser.parse_args()
 
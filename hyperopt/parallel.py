@@ -0,0 +1,591 @@
+"""Experiments that evaluate trials in a local pool of processes or threads
+
+ParallelExperiment is a drop-in replacement for Experiment (with in-memory
+Trials) that uses the cores of one machine without a database: NEW trials
+are dispatched to a multiprocessing.Pool as processes become idle, and
+results are recorded in self.trials as they arrive.
+
+ThreadPoolExperiment does the same with threads, for bandits whose
+evaluate() mostly waits (on subprocesses, remote jobs, ...), so that one
+driver can keep many evaluations in flight.
+
+SupervisedExperiment evaluates each trial in a process of its own, which
+is killed if the trial runs too long or uses too much memory.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import copy
+import cPickle
+import datetime
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+
+from .base import Ctrl
+from .base import Experiment
+from .base import JOB_STATE_RUNNING
+from .base import JOB_STATE_DONE
+from .base import JOB_STATE_ERROR
+
+logger = logging.getLogger(__name__)
+
+
+class ChildCtrl(Ctrl):
+    """Ctrl for a trial evaluated in a pool process
+
+    Attachments and injected results are recorded in the child, and
+    replayed on the parent's trials when the evaluation returns.
+    """
+    def __init__(self, current_trial):
+        Ctrl.__init__(self, None, current_trial=current_trial)
+        self.injected = []
+
+    def inject_results(self, specs, results, miscs, new_tids=None):
+        self.injected.append((specs, results, miscs, new_tids))
+
+
+class LockingCtrl(Ctrl):
+    """Ctrl for a trial evaluated in a thread of the driver's process
+
+    Access to the trials goes through `lock`, which the driver holds
+    whenever it is not waiting for evaluations to finish.
+    """
+    def __init__(self, trials, current_trial, lock):
+        Ctrl.__init__(self, trials, current_trial=current_trial)
+        self.lock = lock
+
+    @property
+    def attachments(self):
+        """
+        Support syntax for load:  self.attachments[name]
+        Support syntax for store: self.attachments[name] = value
+        """
+        lock = self.lock
+        attachments = Ctrl.attachments.fget(self)
+
+        class LockedAttachments(object):
+            def __contains__(_self, name):
+                with lock:
+                    return name in attachments
+
+            def __getitem__(_self, name):
+                with lock:
+                    return attachments[name]
+
+            def __setitem__(_self, name, value):
+                with lock:
+                    attachments[name] = value
+
+            def __delitem__(_self, name):
+                with lock:
+                    del attachments[name]
+
+        return LockedAttachments()
+
+    def inject_results(self, specs, results, miscs, new_tids=None):
+        with self.lock:
+            return Ctrl.inject_results(self, specs, results, miscs,
+                    new_tids=new_tids)
+
+
+class TrialTimeout(Exception):
+    """A trial's evaluation ran longer than its time limit"""
+
+
+class TrialMemoryLimit(Exception):
+    """A trial's evaluation used more memory than its limit"""
+
+
+class TrialDied(Exception):
+    """A trial's evaluation process exited without returning a result"""
+
+
+# -- the bandit of this pool process (set by _init_child)
+_child_bandit = None
+
+# -- queue on which this pool process announces (tid, pid) when it starts
+#    an evaluation, or None
+_child_started = None
+
+
+def _init_child(bandit, started=None):
+    global _child_bandit, _child_started
+    _child_bandit = bandit
+    _child_started = started
+
+
+def _evaluate_in_child(trial):
+    """Return (result, error, exception, attachments, injected)
+
+    Exceptions raised by the bandit (even SystemExit and the like) are
+    returned rather than raised, so that the pool calls the completion
+    callback. Only exceptions that can be pickled are returned as such.
+    """
+    if _child_started is not None:
+        _child_started.put((trial['tid'], os.getpid()))
+    ctrl = ChildCtrl(trial)
+    result = error = exc = None
+    try:
+        result = _child_bandit.evaluate(copy.deepcopy(trial['spec']), ctrl)
+    except BaseException, e:
+        error = (str(type(e)), str(e))
+        if isinstance(e, Exception):
+            try:
+                cPickle.dumps(e)
+                exc = e
+            except Exception:
+                pass
+    return result, error, exc, ctrl.trials.attachments, ctrl.injected
+
+
+def _private_bytes(pid):
+    """Return the memory used by process `pid` alone, or None if unknown
+
+    This is the sum of the Private_* fields of /proc/<pid>/smaps: pages
+    that a forked child still shares with its parent are not counted, so
+    the figure does not depend on the size of the parent process.
+    """
+    for fname in ('smaps_rollup', 'smaps'):
+        try:
+            fh = open('/proc/%i/%s' % (pid, fname))
+        except IOError:
+            continue
+        total = 0
+        try:
+            for line in fh:
+                if line.startswith('Private_'):
+                    total += int(line.split()[1]) * 1024
+        except IOError:
+            # -- the process exited while we were reading
+            return None
+        finally:
+            fh.close()
+        return total
+    return None
+
+
+def _evaluate_supervised(bandit, trial, conn):
+    _init_child(bandit)
+    conn.send(_evaluate_in_child(trial))
+    conn.close()
+
+
+def _failure(exc):
+    """Return the evaluation outcome of a trial that failed with `exc`"""
+    return None, (str(type(exc)), str(exc)), exc, {}, []
+
+
+class _Supervisor(object):
+    """Evaluates each trial in a new process, and kills the processes of
+    trials that exceed `timeout` seconds or `max_rss` bytes
+
+    A thread checks on the processes every `poll_secs`, and calls the
+    callback of each trial with its outcome. Has the close() and join()
+    methods of multiprocessing.Pool.
+    """
+    def __init__(self, bandit, timeout, max_rss, poll_secs):
+        self.bandit = bandit
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.poll_secs = poll_secs
+        self.closed = False
+        # -- [process, connection, start time, callback] per trial
+        self._children = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, trial, callback):
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=_evaluate_supervised,
+                args=(self.bandit, trial, child_conn))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        with self._lock:
+            self._children.append([proc, conn, time.time(), callback])
+
+    def close(self):
+        self.closed = True
+
+    def join(self):
+        self._thread.join()
+
+    def _kill(self, proc):
+        proc.terminate()
+        proc.join(1.0)
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+
+    def _check(self, proc, conn, t0):
+        """Return the outcome of the trial evaluated by `proc`, or None if
+        it is still running within its limits"""
+        if conn.poll():
+            try:
+                outcome = conn.recv()
+            except EOFError:
+                outcome = _failure(TrialDied(
+                    'evaluation process exited with code %s'
+                    % proc.exitcode))
+            conn.close()
+            proc.join()
+            return outcome
+        if self.timeout is not None and time.time() - t0 > self.timeout:
+            self._kill(proc)
+            conn.close()
+            return _failure(TrialTimeout(
+                'evaluation exceeded the time limit of %ss' % self.timeout))
+        if self.max_rss is not None:
+            rss = _private_bytes(proc.pid)
+            if rss is not None and rss > self.max_rss:
+                self._kill(proc)
+                conn.close()
+                return _failure(TrialMemoryLimit(
+                    'evaluation used %i bytes, over the limit of %i'
+                    % (rss, self.max_rss)))
+        return None
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                children = list(self._children)
+            if self.closed and not children:
+                break
+            for child in children:
+                proc, conn, t0, callback = child
+                outcome = self._check(proc, conn, t0)
+                if outcome is not None:
+                    with self._lock:
+                        self._children.remove(child)
+                    callback(outcome)
+            time.sleep(self.poll_secs)
+
+
+class ParallelExperiment(Experiment):
+    """Experiment that evaluates trials in a multiprocessing.Pool
+
+    n_procs - number of pool processes (default: the number of cores)
+
+    maxtasksperchild - replace each pool process after it has evaluated
+        this many trials (default: never); useful for bandits that leak.
+
+    At most n_procs trials are RUNNING at a time; up to max_queue_len more
+    wait in JOB_STATE_NEW, as they would for mongo workers.
+
+    The bandit is sent to each pool process once, when the process starts.
+    Call close() to shut down the pool.
+
+    A trial whose outcome cannot be returned (it does not pickle, or the
+    pool process dies) is marked JOB_STATE_ERROR rather than waited for.
+    """
+
+    # -- seconds between checks for evaluations that will not call back
+    check_secs = 1.0
+
+    # -- seconds to wait for the outcome of a trial whose pool process
+    #    has exited, before deciding that it died
+    lost_grace_secs = 1.0
+
+    def __init__(self, trials, bandit_algo, n_procs=None,
+            max_queue_len=1,
+            maxtasksperchild=None,
+            ):
+        Experiment.__init__(self, trials, bandit_algo, async=False,
+                max_queue_len=max_queue_len)
+        if n_procs is None:
+            n_procs = multiprocessing.cpu_count()
+        self.n_procs = n_procs
+        self.maxtasksperchild = maxtasksperchild
+        self.pool = None
+        # -- tid -> trial document, for trials being evaluated
+        self._pending = {}
+        # -- (tid, evaluation outcome) pairs, appended by the pool's
+        #    callbacks, which notify self._finished_cond
+        self._finished = []
+        self.lock = threading.RLock()
+        self._finished_cond = threading.Condition(self.lock)
+        # -- tid -> AsyncResult, for evaluations submitted to the pool
+        self._async_results = {}
+        # -- queue of (tid, pid) sent by pool processes as they start
+        #    evaluations (see _init_child), and what it told so far
+        self._started = None
+        self._worker_pids = {}
+        # -- tid -> time at which its worker was first seen dead
+        self._dead_since = {}
+        # -- True once a pool process has died with a job
+        self._pool_lost_jobs = False
+
+    def _make_pool(self):
+        self._started = SimpleQueue()
+        return multiprocessing.Pool(self.n_procs,
+                initializer=_init_child,
+                initargs=(self.bandit, self._started),
+                maxtasksperchild=self.maxtasksperchild)
+
+    def _submit(self, trial, callback):
+        """Start evaluating `trial`; `callback` gets the outcome.
+
+        Returns an AsyncResult (or None), which _check_lost uses to find
+        evaluations that will never call back.
+        """
+        return self.pool.apply_async(_evaluate_in_child, (trial,),
+                callback=callback)
+
+    def _check_lost(self):
+        """Record failures for evaluations whose callback will not come
+
+        The pool calls back only on success: not if the outcome could not
+        be pickled, nor if the pool process died during the evaluation.
+        """
+        lost = []
+        for tid, async_result in self._async_results.items():
+            if async_result.ready():
+                del self._async_results[tid]
+                if not async_result.successful():
+                    try:
+                        async_result.get()
+                    except Exception, e:
+                        lost.append((tid, _failure(e)))
+        if self._started is not None and self._async_results:
+            while not self._started.empty():
+                tid, pid = self._started.get()
+                self._worker_pids[tid] = pid
+            # -- (Pool keeps no public list of its processes)
+            alive = set([proc.pid for proc in self.pool._pool
+                if proc.exitcode is None])
+            now = time.time()
+            for tid in self._async_results.keys():
+                if self._worker_pids.get(tid, None) in alive:
+                    continue
+                if tid not in self._worker_pids:
+                    continue
+                # -- the outcome of a process that returned and then
+                #    exited (maxtasksperchild) may still be on its way
+                t0 = self._dead_since.setdefault(tid, now)
+                if now - t0 >= self.lost_grace_secs:
+                    del self._async_results[tid]
+                    self._pool_lost_jobs = True
+                    lost.append((tid, _failure(TrialDied(
+                        'pool process %i died during the evaluation'
+                        % self._worker_pids[tid]))))
+        if lost:
+            with self._finished_cond:
+                self._finished.extend(lost)
+                self._finished_cond.notify_all()
+
+    def close(self):
+        """Shut down the pool, after pending evaluations finish"""
+        if self.pool is not None:
+            if self._pool_lost_jobs:
+                # -- the pool would wait forever for the jobs it lost
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self._pool_lost_jobs = False
+
+    def _dispatch(self, N=-1):
+        """Start evaluating (at most N) NEW trials on idle pool processes,
+        return how many were started"""
+        if self.pool is None:
+            self.pool = self._make_pool()
+        n_started = 0
+        while len(self._pending) < self.n_procs and n_started != N:
+            trial = self.trials.next_new_trial()
+            if trial is None:
+                break
+            now = datetime.datetime.utcnow()
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_RUNNING,
+                'owner': ('localhost', os.getpid()),
+                'book_time': now,
+                'refresh_time': now})
+            tid = trial['tid']
+            self._pending[tid] = trial
+
+            def callback(outcome, tid=tid):
+                with self._finished_cond:
+                    self._finished.append((tid, outcome))
+                    self._finished_cond.notify_all()
+            async_result = self._submit(trial, callback)
+            if async_result is not None:
+                self._async_results[tid] = async_result
+            n_started += 1
+        return n_started
+
+    def _collect(self, block):
+        """Record the outcomes of finished evaluations
+
+        If block, wait for at least one (if any are pending).
+        """
+        self._check_lost()
+        with self._finished_cond:
+            while block and self._pending and not self._finished:
+                # -- (the timeout also keeps KeyboardInterrupt working)
+                self._finished_cond.wait(self.check_secs)
+                self._check_lost()
+            finished = self._finished
+            self._finished = []
+        # -- record every outcome before raising the first error (with
+        #    catch_bandit_exceptions False), so that no finished trial is
+        #    left pending
+        exc_info = None
+        for tid, outcome in finished:
+            self._async_results.pop(tid, None)
+            self._worker_pids.pop(tid, None)
+            self._dead_since.pop(tid, None)
+            try:
+                self._record(self._pending.pop(tid), outcome)
+            except Exception:
+                if exc_info is None:
+                    exc_info = sys.exc_info()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _record(self, trial, outcome):
+        result, error, exc, attachments, injected = outcome
+        # -- item by item: not every Trials.attachments has update()
+        for name, blob in attachments.items():
+            self.trials.attachments[name] = blob
+        ctrl = Ctrl(self.trials, current_trial=trial)
+        for args in injected:
+            ctrl.inject_results(*args)
+        if error is not None:
+            logger.info('job exception: %s' % str(error[1]))
+            trial['misc']['error'] = error
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_ERROR,
+                'misc': trial['misc'],
+                'refresh_time': datetime.datetime.utcnow()})
+            if not self.catch_bandit_exceptions:
+                if exc is not None:
+                    raise exc
+                raise RuntimeError(*error)
+        else:
+            self.trials.update_trial(trial, {
+                'state': JOB_STATE_DONE,
+                'result': result,
+                'refresh_time': datetime.datetime.utcnow()})
+
+    def serial_evaluate(self, N=-1):
+        """Dispatch (at most N) NEW trials, and record finished ones
+
+        Waits for an evaluation to finish if all processes are busy.
+        """
+        self._collect(block=False)
+        n_started = self._dispatch(N)
+        if len(self._pending) >= self.n_procs:
+            self._collect(block=True)
+            if N < 0 or n_started < N:
+                self._dispatch(N - n_started if N > 0 else N)
+        self.trials.refresh()
+
+    def block_until_done(self):
+        self._dispatch()
+        while self._pending:
+            self._collect(block=True)
+            self._dispatch()
+        self.trials.refresh()
+
+
+class ThreadPoolExperiment(ParallelExperiment):
+    """Experiment that evaluates trials in a pool of threads
+
+    n_threads - number of trials to evaluate at once
+
+    bandit.evaluate() is called with a LockingCtrl, in one of the threads;
+    it must be safe to call concurrently. The driver holds self.lock while
+    it works on self.trials, and releases it while waiting for evaluations
+    to finish.
+    """
+
+    def __init__(self, trials, bandit_algo, n_threads=10,
+            max_queue_len=1,
+            ):
+        ParallelExperiment.__init__(self, trials, bandit_algo,
+                n_procs=n_threads,
+                max_queue_len=max_queue_len)
+
+    def _make_pool(self):
+        return ThreadPool(self.n_procs)
+
+    def _submit(self, trial, callback):
+        return self.pool.apply_async(self._evaluate_in_thread, (trial,),
+                callback=callback)
+
+    def _evaluate_in_thread(self, trial):
+        ctrl = LockingCtrl(self.trials, trial, self.lock)
+        result = error = exc = None
+        try:
+            result = self.bandit.evaluate(copy.deepcopy(trial['spec']), ctrl)
+        except BaseException, e:
+            # -- e.g. SystemExit would end the pool's thread, and with it
+            #    the callback
+            error = (str(type(e)), str(e))
+            if isinstance(e, Exception):
+                exc = e
+        return result, error, exc, {}, []
+
+    def run(self, N, block_until_done=True):
+        with self.lock:
+            return ParallelExperiment.run(self, N,
+                    block_until_done=block_until_done)
+
+    def block_until_done(self):
+        with self.lock:
+            return ParallelExperiment.block_until_done(self)
+
+
+class SupervisedExperiment(ParallelExperiment):
+    """Experiment that evaluates each trial in a process of its own, under
+    time and memory limits
+
+    timeout - seconds; the process of a trial still running after this
+        long is killed
+    max_rss - bytes; the process of a trial whose private memory grows
+        larger than this is killed (needs /proc, i.e. Linux; pages shared
+        with the driver process, and the memory of the process's own
+        children, are not counted)
+    n_procs - number of trials to evaluate at once (default 1, like
+        Experiment.serial_evaluate)
+
+    Trials whose processes are killed are marked JOB_STATE_ERROR, with a
+    TrialTimeout or TrialMemoryLimit error in misc['error']; a process
+    that dies by itself (e.g. of a segfault) gives a TrialDied error.
+    With catch_bandit_exceptions False, these errors are raised, like the
+    bandit's own exceptions.
+    """
+
+    # -- seconds between checks on the evaluation processes
+    poll_secs = 0.05
+
+    def __init__(self, trials, bandit_algo, timeout=None, max_rss=None,
+            n_procs=1,
+            max_queue_len=1,
+            ):
+        ParallelExperiment.__init__(self, trials, bandit_algo,
+                n_procs=n_procs,
+                max_queue_len=max_queue_len)
+        self.timeout = timeout
+        self.max_rss = max_rss
+        if max_rss is not None and _private_bytes(os.getpid()) is None:
+            logger.warn('cannot measure memory use: max_rss is ignored')
+
+    def _make_pool(self):
+        return _Supervisor(self.bandit, self.timeout, self.max_rss,
+                self.poll_secs)
+
+    def _submit(self, trial, callback):
+        self.pool.submit(trial, callback)
@@ -19,7 +19,6 @@ import pyll
 import numpy as np
 from .base import Bandit
 from .base import BanditAlgo
-from .base import miscs_to_idxs_vals
 
 def algo_as_str(algo):
     if isinstance(algo, basestring):
@@ -105,12 +104,11 @@ def main_plot_vars(trials, bandit=None, algo=None, do_show=True, fontsize=10):
 
     BA = BanditAlgo(bandit)
 
-    idxs, vals = miscs_to_idxs_vals(trials.miscs)
+    cols = trials.columns()
 
-    loss_min = min([y for y in trials.losses() if y is not None])
-    loss_max = max([y for y in trials.losses() if y is not None])
-
-    loss_by_tid = dict(zip(trials.tids, trials.losses()))
+    losses = trials.losses()
+    loss_min = min([y for y in losses if y is not None])
+    loss_max = max([y for y in losses if y is not None])
 
     def color_fn(lossval):
         if lossval is None:
@@ -132,7 +130,7 @@ def main_plot_vars(trials, bandit=None, algo=None, do_show=True, fontsize=10):
             t = (lossval - loss_min) / (loss_max - loss_min + .0001)
             return (t, t, t)
 
-    all_nids = list(idxs.keys())
+    all_nids = list(cols.keys)
     titles = ['%s (%s)' % (BA.doc_coords[nid], BA.name_by_nid[nid])
             for nid in all_nids]
     order = np.argsort(titles)
@@ -152,14 +150,15 @@ def main_plot_vars(trials, bandit=None, algo=None, do_show=True, fontsize=10):
         plt.xticks(ticks_num, ['' for i in xrange(len(ticks_num))])
 
         dist_name = BA.name_by_nid[nid]
-        x = idxs[nid]
+        rows = np.where(cols.active[nid])[0]
+        x = cols.tids[rows]
         if 'log' in dist_name:
-            y = np.log(vals[nid])
+            y = np.log(cols.vals[nid][rows])
         else:
-            y = vals[nid]
+            y = cols.vals[nid][rows]
         plt.title(titles[varnum], fontsize=fontsize)
         plt.scatter(x, y,
-                c=map(color_fn_bw, [loss_by_tid[ii] for ii in idxs[nid]]))
+                c=map(color_fn_bw, [losses[ii] for ii in rows]))
 
     if do_show:
         plt.show()
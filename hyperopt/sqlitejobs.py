@@ -0,0 +1,507 @@
+"""SQLite-based jobs database, Trials, and worker
+
+This is a drop-in replacement for the mongo-based components in mongoexp.py,
+for experiments whose driver and workers all run on one host (or share a
+filesystem on which SQLite locking works): no database server is needed.
+
+- SQLiteJobs implements the job-queue contract of MongoJobs: insert,
+  reserve, update (with version checking), refresh, and attachments.
+  `reserve` is atomic: it runs in a `BEGIN IMMEDIATE` transaction.
+  The database is put in WAL mode so that readers (e.g. the driver's
+  refresh) do not block, and are not blocked by, a writer.
+
+- SQLiteTrials is the corresponding Trials subclass (like MongoTrials).
+  refresh() only downloads the jobs changed since the previous refresh.
+
+- SQLiteWorker and main_worker (bin/hyperopt-sqlite-worker) mirror
+  MongoWorker and hyperopt-mongo-worker.
+
+Job documents are stored BSON-encoded, along with copies of the fields that
+queries need (exp_key, state, owner, version) in columns.
+"""
+
+__authors__   = "James Bergstra"
+__license__   = "3-clause BSD License"
+__contact__   = "github.com/jaberg/hyperopt"
+
+import copy
+import logging
+import optparse
+import sqlite3
+import sys
+
+import bson
+
+from .base import JOB_STATES
+from .base import JOB_STATE_NEW
+from .base import JOB_STATE_RUNNING
+from .base import JOB_STATE_ERROR
+from .base import Trials
+from .mongoexp import MongoWorker
+from .mongoexp import OperationFailure
+from .mongoexp import cancel_new_jobs
+from .mongoexp import coarse_utcnow
+from .mongoexp import worker_subprocess_loop
+
+logger = logging.getLogger(__name__)
+
+# -- job_id under which trials-level (not per-job) attachments are stored
+TRIALS_ATTACHMENTS_ID = 0
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs (
+        _id INTEGER PRIMARY KEY AUTOINCREMENT,
+        seq INTEGER NOT NULL,
+        exp_key TEXT,
+        state INTEGER NOT NULL,
+        owner TEXT,
+        version INTEGER NOT NULL,
+        doc BLOB NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS jobs_queue
+        ON jobs (state, exp_key, _id)''',
+    '''CREATE INDEX IF NOT EXISTS jobs_seq ON jobs (seq)''',
+    '''CREATE TABLE IF NOT EXISTS attachments (
+        job_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        blob BLOB NOT NULL,
+        PRIMARY KEY (job_id, name))''',
+    '''CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL)''',
+    '''INSERT OR IGNORE INTO counters VALUES ('seq', 0)''',
+    '''INSERT OR IGNORE INTO counters VALUES ('last_id', 0)''',
+    ]
+
+
+def _encode(doc):
+    return buffer(bson.BSON.encode(doc))
+
+
+def _decode(blob):
+    return bson.BSON(str(blob)).decode()
+
+
+class SQLiteJobs(object):
+    """
+    Interface to a jobs database in the SQLite file `path`
+    """
+    # -- seconds to wait for another process's write transaction
+    timeout = 60.0
+
+    def __init__(self, path, timeout=timeout):
+        self.path = path
+        self.timeout = timeout
+        self.conn = sqlite3.connect(path, timeout=timeout,
+                isolation_level=None)  # -- transactions are explicit
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+
+    def __getstate__(self):
+        return {'path': self.path, 'timeout': self.timeout}
+
+    def __setstate__(self, dct):
+        self.__init__(dct['path'], timeout=dct['timeout'])
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def _begin(self):
+        """Start a transaction that holds the database write lock"""
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def _next_seq(self):
+        self.conn.execute(
+                "UPDATE counters SET value = value + 1 WHERE name = 'seq'")
+        return self.conn.execute(
+                "SELECT value FROM counters WHERE name = 'seq'").fetchone()[0]
+
+    def _transaction(self, fn, *args):
+        self._begin()
+        try:
+            rval = fn(*args)
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        return rval
+
+    def insert_docs(self, docs):
+        """Insert copies of `docs` in one transaction, return the copies
+        (which have an _id field)"""
+        def insert():
+            seq = self._next_seq()
+            rval = []
+            for doc in docs:
+                cpy = copy.deepcopy(doc)
+                cpy.setdefault('version', 0)
+                cur = self.conn.execute(
+                    'INSERT INTO jobs (seq, exp_key, state, owner, version,'
+                    ' doc) VALUES (?, ?, ?, ?, ?, ?)',
+                    (seq, cpy.get('exp_key'), cpy['state'], cpy.get('owner'),
+                        cpy['version'], buffer('')))
+                cpy['_id'] = cur.lastrowid
+                self.conn.execute('UPDATE jobs SET doc = ? WHERE _id = ?',
+                        (_encode(cpy), cpy['_id']))
+                rval.append(cpy)
+            return rval
+        return self._transaction(insert)
+
+    def insert(self, job):
+        """Return a job dictionary by inserting the job dict into the database"""
+        return self.insert_docs([job])[0]
+
+    def find(self, exp_key=None, min_seq=0, states=None):
+        """Return [(seq, doc)] for jobs changed since `min_seq`
+        """
+        query = 'SELECT seq, doc FROM jobs WHERE seq > ?'
+        params = [min_seq]
+        if exp_key is not None:
+            query += ' AND exp_key = ?'
+            params.append(exp_key)
+        if states is not None:
+            query += ' AND state IN (%s)' % ','.join(['?'] * len(states))
+            params.extend(states)
+        return [(seq, _decode(blob))
+                for seq, blob in self.conn.execute(query, params)]
+
+    def count(self, states, exp_key=None):
+        query = 'SELECT COUNT(*) FROM jobs WHERE state IN (%s)' % (
+                ','.join(['?'] * len(states)))
+        params = list(states)
+        if exp_key is not None:
+            query += ' AND exp_key = ?'
+            params.append(exp_key)
+        return self.conn.execute(query, params).fetchone()[0]
+
+    def reserve(self, host_id, cond=None, exp_key=None):
+        """Atomically claim a new job for `host_id`, or return None"""
+        if cond:
+            cond = dict(cond)
+            if 'exp_key' in cond:
+                exp_key = cond.pop('exp_key')
+            if cond.get('owner') is not None:
+                raise ValueError('refusing to reserve owned job')
+            cond.pop('owner', None)
+            if cond:
+                raise NotImplementedError('reserve condition', cond)
+        now = coarse_utcnow()
+
+        def reserve():
+            query = ('SELECT doc FROM jobs WHERE state = ?'
+                    ' AND owner IS NULL')
+            params = [JOB_STATE_NEW]
+            if exp_key is not None:
+                query += ' AND exp_key = ?'
+                params.append(exp_key)
+            row = self.conn.execute(query + ' ORDER BY _id LIMIT 1',
+                    params).fetchone()
+            if row is None:
+                return None
+            doc = _decode(row[0])
+            doc.update({
+                'owner': host_id,
+                'book_time': now,
+                'state': JOB_STATE_RUNNING,
+                'refresh_time': now,
+                'version': doc['version'] + 1})
+            self._write(doc)
+            return doc
+        return self._transaction(reserve)
+
+    def _write(self, doc):
+        self.conn.execute(
+                'UPDATE jobs SET seq = ?, exp_key = ?, state = ?, owner = ?,'
+                ' version = ?, doc = ? WHERE _id = ?',
+                (self._next_seq(), doc.get('exp_key'), doc['state'],
+                    doc.get('owner'), doc['version'], _encode(doc),
+                    doc['_id']))
+
+    def refresh(self, doc, safe=False):
+        self.update(doc, dict(refresh_time=coarse_utcnow()), safe=False)
+
+    def update(self, doc, dct, safe=True):
+        """Return union of doc and dct, after making sure that dct has been
+        added to doc in the database.
+
+        Like MongoJobs.update, `doc` is updated in place, and its version is
+        incremented. If the stored job has a different version, the stored
+        job is not modified, and (if safe) OperationFailure is raised.
+        """
+        dct = copy.deepcopy(dct)
+        if '_id' in dct:
+            raise ValueError('cannot update the _id field')
+        if 'version' in dct:
+            raise ValueError('cannot update the version field')
+        if '_id' not in doc:
+            raise ValueError('doc must have an "_id" key to be updated')
+
+        def update():
+            row = self.conn.execute(
+                    'SELECT doc FROM jobs WHERE _id = ? AND version = ?',
+                    (doc['_id'], doc.get('version', 0))).fetchone()
+            if row is None:
+                return False
+            server_doc = _decode(row[0])
+            server_doc.update(dct)
+            server_doc['version'] += 1
+            self._write(server_doc)
+            return True
+        if self._transaction(update):
+            doc.update(dct)
+            doc['version'] = doc.get('version', 0) + 1
+        elif safe:
+            raise OperationFailure('updated doc not found : %s' % str(doc))
+        return doc
+
+    def delete_all(self, cond={}):
+        """Delete all jobs (matching `cond`) and their attachments"""
+        cond = dict(cond)
+        where = ''
+        params = []
+        for key in ('exp_key', 'state'):
+            if key in cond:
+                where += ' AND %s = ?' % key
+                params.append(cond.pop(key))
+        if cond:
+            raise NotImplementedError('delete condition', cond)
+
+        def delete():
+            self.conn.execute('DELETE FROM attachments WHERE job_id IN'
+                    ' (SELECT _id FROM jobs WHERE 1' + where + ')', params)
+            self.conn.execute('DELETE FROM jobs WHERE 1' + where, params)
+        self._transaction(delete)
+
+    def delete_all_error_jobs(self):
+        return self.delete_all(cond={'state': JOB_STATE_ERROR})
+
+    def new_trial_ids(self, N):
+        def allocate():
+            self.conn.execute('UPDATE counters SET value = value + ?'
+                    " WHERE name = 'last_id'", (N,))
+            return self.conn.execute("SELECT value FROM counters"
+                    " WHERE name = 'last_id'").fetchone()[0]
+        last_id = self._transaction(allocate)
+        return range(last_id - N, last_id)
+
+    def attachment_names(self, doc):
+        return [name for name, in self.conn.execute(
+            'SELECT name FROM attachments WHERE job_id = ?', (doc['_id'],))]
+
+    def set_attachment(self, doc, blob, name):
+        """Attach data string `blob` to `doc` by name `name`"""
+        self.conn.execute(
+                'INSERT OR REPLACE INTO attachments VALUES (?, ?, ?)',
+                (doc['_id'], name, buffer(blob)))
+
+    def get_attachment(self, doc, name):
+        """Retrieve data attached to `doc` by `set_attachment`.
+
+        Raises OperationFailure if `name` does not correspond to an attached blob.
+
+        Returns the blob as a string.
+        """
+        row = self.conn.execute(
+                'SELECT blob FROM attachments WHERE job_id = ? AND name = ?',
+                (doc['_id'], name)).fetchone()
+        if row is None:
+            raise OperationFailure('Attachment not found: %s' % name)
+        return str(row[0])
+
+    def delete_attachment(self, doc, name):
+        cur = self.conn.execute(
+                'DELETE FROM attachments WHERE job_id = ? AND name = ?',
+                (doc['_id'], name))
+        if cur.rowcount == 0:
+            raise OperationFailure('Attachment not found: %s' % name)
+
+
+class SQLiteTrials(Trials):
+    """Trials stored in an SQLite database (see SQLiteJobs)
+
+    arg is either a SQLiteJobs instance, or the path of the database.
+    """
+    async = True
+
+    def __init__(self, arg, exp_key=None, cmd=None, workdir=None,
+            refresh=True):
+        if isinstance(arg, SQLiteJobs):
+            self.handle = arg
+        else:
+            self.handle = SQLiteJobs(arg)
+        self._exp_key = exp_key
+        self.cmd = cmd
+        self.workdir = workdir
+        if refresh:
+            self.refresh()
+
+    def view(self, exp_key=None, cmd=None, workdir=None, refresh=True):
+        rval = self.__class__(self.handle,
+                exp_key=self._exp_key if exp_key is None else exp_key,
+                cmd=self.cmd if cmd is None else cmd,
+                workdir=self.workdir if workdir is None else workdir,
+                refresh=refresh)
+        return rval
+
+    def refresh(self):
+        # -- download only the jobs that changed since the last refresh
+        docs_by_id = getattr(self, '_docs_by_id', None)
+        if docs_by_id is None:
+            docs_by_id = self._docs_by_id = {}
+            self._seq = 0
+        changed = self.handle.find(exp_key=self._exp_key, min_seq=self._seq)
+        if changed or not hasattr(self, '_trials'):
+            for seq, doc in changed:
+                self._seq = max(self._seq, seq)
+                docs_by_id[doc['_id']] = doc
+            self._set_trials([docs_by_id[_id]
+                for _id in sorted(docs_by_id)
+                if docs_by_id[_id]['state'] != JOB_STATE_ERROR])
+        logger.debug('refresh downloaded %i jobs' % len(changed))
+
+    def _insert_trial_docs(self, docs):
+        return [doc['_id'] for doc in self.handle.insert_docs(docs)]
+
+    def update_trial(self, trial, dct):
+        return self.handle.update(trial, dct)
+
+    def cancel_new_trials(self, reason):
+        return cancel_new_jobs(self.handle, self._exp_key, reason)
+
+    def count_by_state_unsynced(self, arg):
+        if arg in JOB_STATES:
+            states = [arg]
+        else:
+            assert hasattr(arg, '__iter__')
+            states = list(arg)
+            assert all([x in JOB_STATES for x in states])
+        return self.handle.count(states, exp_key=self._exp_key)
+
+    def delete_all(self):
+        if self._exp_key:
+            cond = {'exp_key': self._exp_key}
+        else:
+            cond = {}
+        self.handle.delete_all(cond)
+        self.handle.conn.execute('DELETE FROM attachments WHERE job_id = ?',
+                (TRIALS_ATTACHMENTS_ID,))
+        self._docs_by_id = None
+        self.refresh()
+
+    def new_trial_ids(self, N):
+        # -- unique across the database, as in MongoTrials
+        return self.handle.new_trial_ids(N)
+
+    def trial_attachments(self, trial):
+        """
+        Support syntax for load:  self.attachments[name]
+        Support syntax for store: self.attachments[name] = value
+        """
+        handle = self.handle
+
+        # don't offer more here than in MongoCtrl
+        class Attachments(object):
+            def __contains__(_self, name):
+                return name in handle.attachment_names(doc=trial)
+
+            def __getitem__(_self, name):
+                try:
+                    return handle.get_attachment(doc=trial, name=name)
+                except OperationFailure:
+                    raise KeyError(name)
+
+            def __setitem__(_self, name, value):
+                handle.set_attachment(doc=trial, blob=value, name=name)
+
+            def __delitem__(_self, name):
+                try:
+                    handle.delete_attachment(doc=trial, name=name)
+                except OperationFailure:
+                    raise KeyError(name)
+
+        return Attachments()
+
+    @property
+    def attachments(self):
+        """
+        Support syntax for load:  self.attachments[name]
+        Support syntax for store: self.attachments[name] = value
+        NB THIS IS TRIALS-LEVEL ATTACHMENTS, NOT DOCUMENT-LEVEL ATTACHMENTS!!!
+        """
+        return self.trial_attachments({'_id': TRIALS_ATTACHMENTS_ID})
+
+
+class SQLiteWorker(MongoWorker):
+    """MongoWorker that takes its jobs from a SQLiteJobs database"""
+    trials_cls = SQLiteTrials
+
+
+def main_worker_helper(options, args):
+    N = int(options.max_jobs)
+
+    if N > 1:
+        sub_argv = [sys.argv[0],
+                '--poll-interval=%s' % options.poll_interval,
+                '--max-jobs=1',
+                '--db=%s' % options.db]
+        if options.workdir is not None:
+            sub_argv.append('--workdir=%s' % options.workdir)
+        if options.exp_key is not None:
+            sub_argv.append('--exp-key=%s' % options.exp_key)
+        return worker_subprocess_loop(N, options, sub_argv)
+    elif N == 1:
+        worker = SQLiteWorker(SQLiteJobs(options.db),
+                float(options.poll_interval),
+                workdir=options.workdir,
+                exp_key=options.exp_key)
+        worker.run_one(reserve_timeout=float(options.reserve_timeout))
+    else:
+        return -1
+
+
+def main_worker():
+    parser = optparse.OptionParser(usage="%prog [options]")
+
+    parser.add_option("--max-consecutive-failures",
+            dest="max_consecutive_failures",
+            metavar='N',
+            default=4,
+            help="stop if N consecutive jobs fail (default: 4)",
+            )
+    parser.add_option("--exp-key",
+            dest='exp_key',
+            default = None,
+            metavar='str',
+            help="identifier for this workers's jobs")
+    parser.add_option("--poll-interval",
+            dest='poll_interval',
+            metavar='N',
+            default=5,
+            help="check work queue every 1 < T < N seconds (default: 5")
+    parser.add_option("--max-jobs",
+            dest='max_jobs',
+            default=sys.maxint,
+            help="stop after running this many jobs (default: inf)")
+    parser.add_option("--db",
+            dest='db',
+            default='hyperopt.sqlite',
+            help="path of the SQLite jobs database")
+    parser.add_option("--reserve-timeout",
+            dest='reserve_timeout',
+            metavar='T',
+            default=120.0,
+            help="poll database for up to T seconds to reserve a job")
+    parser.add_option("--workdir",
+            dest="workdir",
+            default=None,
+            help="root workdir (default: load from the job's misc)",
+            metavar="DIR")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help()
+        return -1
+
+    return main_worker_helper(options, args)
@@ -0,0 +1,105 @@
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+from hyperopt.attachments import SpillingAttachments
+from hyperopt.base import Trials
+
+import hyperopt.tests.test_base
+from hyperopt.tests.test_base import ok_trial
+
+
+class TestSpillingAttachments(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.att = SpillingAttachments(10, os.path.join(self.spill_dir, 's'))
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def spilled(self):
+        return sorted(os.listdir(self.att.spill_dir))
+
+    def test_lru(self):
+        att = self.att
+        att['a'] = 'aaaa'
+        att['b'] = 'bbbb'
+        assert att.memory_bytes == 8
+        assert att['a'] == 'aaaa'  # -- 'b' is now least recently used
+        att['c'] = 'cccc'
+        assert att.memory_bytes == 8
+        assert att.mmap('b')[:] == 'bbbb'
+        assert att.mmap('a') is None
+        assert len(self.spilled()) == 1
+        # -- reading a spilled blob leaves it on disk
+        assert att['b'] == 'bbbb'
+        assert att.memory_bytes == 8
+        assert att.mmap('b')[:] == 'bbbb'
+        assert att['a'] == 'aaaa' and att['c'] == 'cccc'
+        assert len(self.spilled()) == 1
+        assert sorted(att) == ['a', 'b', 'c']
+        assert dict(att) == {'a': 'aaaa', 'b': 'bbbb', 'c': 'cccc'}
+
+    def test_large(self):
+        att = self.att
+        att['big'] = 'x' * 100
+        att['empty'] = ''
+        assert att.memory_bytes == 0
+        assert att['big'] == 'x' * 100
+        assert att.memory_bytes == 0
+        att['big'] = 'y'
+        assert att['big'] == 'y'
+        assert self.spilled() == []
+        att['obj'] = [1, 2]
+        assert att['obj'] == [1, 2]
+
+    def test_del_clear(self):
+        att = self.att
+        for name in 'abcd':
+            att[name] = name * 4
+        assert len(self.spilled()) == 2
+        del att['a']
+        assert 'a' not in att
+        self.assertRaises(KeyError, att.__getitem__, 'a')
+        self.assertRaises(KeyError, att.__delitem__, 'a')
+        assert len(self.spilled()) == 1
+        att.clear()
+        assert len(att) == 0
+        assert att.memory_bytes == 0
+        assert self.spilled() == []
+
+    def test_pickle(self):
+        att = self.att
+        for name in 'abcd':
+            att[name] = name * 4
+        att2 = cPickle.loads(cPickle.dumps(att))
+        assert dict(att2) == dict(att)
+        assert att2.memory_bytes <= 10
+
+
+class SpillingTrials(Trials):
+    attachments_memory_budget = 10
+
+
+class TestSpillingTrials(hyperopt.tests.test_base.TestTrials):
+    def setUp(self):
+        self.trials = SpillingTrials()
+
+    def test_trial_attachments(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        for trial in trials:
+            trials.trial_attachments(trial)['snapshot'] = 'x' * 8
+        assert isinstance(trials.attachments, SpillingAttachments)
+        assert trials.attachments.memory_bytes == 8
+        assert trials.trial_attachments(trials.trials[0])['snapshot'] \
+                == 'x' * 8
+        spill_dir = trials.attachments.spill_dir
+        # -- the blob read back is not brought back into memory
+        assert trials.attachments.memory_bytes == 8
+        assert len(os.listdir(spill_dir)) == 2
+        trials.delete_all()
+        assert os.listdir(spill_dir) == []
@@ -2,9 +2,11 @@
 Verify that the sample bandits in bandits.py run, and and that a random
 experiment proceeds as expected
 """
+import time
 import unittest
 
 from hyperopt import Random, Experiment, Trials
+from hyperopt.base import JOB_STATE_DONE
 import hyperopt.bandits
 
 class BanditExperimentMixin(object):
@@ -38,3 +40,28 @@ DistractorTester = BanditExperimentMixin.make(hyperopt.bandits.Distractor)
 GaussWaveTester = BanditExperimentMixin.make(hyperopt.bandits.GaussWave)
 GaussWave2Tester = BanditExperimentMixin.make(hyperopt.bandits.GaussWave2,
         n_steps=5000)
+
+
+def benchmark_serial_run(n, max_queue_len=100):
+    """Return the time to run n random trials of Quadratic1 serially
+    """
+    bandit = hyperopt.bandits.Quadratic1()
+    trials = Trials()
+    experiment = Experiment(trials, Random(bandit), async=False,
+            max_queue_len=max_queue_len)
+    experiment.validate_new_trials = False
+    t0 = time.time()
+    experiment.run(n)
+    t1 = time.time()
+    assert trials.count_by_state_synced(JOB_STATE_DONE) == n
+    return t1 - t0
+
+
+def test_serial_run():
+    benchmark_serial_run(100, max_queue_len=10)
+
+
+if __name__ == '__main__':
+    # -- the benchmark itself is too slow for the test suite
+    print 'serial run of 100k Quadratic1 trials: %f seconds' % (
+            benchmark_serial_run(100000))
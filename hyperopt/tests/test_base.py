@@ -1,5 +1,9 @@
 import copy
+import cPickle
+import datetime
 import sys
+import threading
+import time
 import unittest
 import numpy as np
 import nose
@@ -13,6 +17,8 @@ one_of = scope.one_of
 from hyperopt import STATUS_STRINGS
 from hyperopt import STATUS_OK
 from hyperopt.base import JOB_STATE_NEW
+from hyperopt.base import JOB_STATE_RUNNING
+from hyperopt.base import JOB_STATE_DONE
 from hyperopt.base import JOB_STATE_ERROR
 from hyperopt.base import TRIAL_KEYS
 from hyperopt.base import TRIAL_MISC_KEYS
@@ -23,9 +29,13 @@ from hyperopt.base import CoinFlipInjector
 from hyperopt.base import Ctrl
 from hyperopt.base import Experiment
 from hyperopt.base import InvalidTrial
+from hyperopt.base import compact_misc
 from hyperopt.base import miscs_to_idxs_vals
+from hyperopt.base import miscs_update_idxs_vals
+from hyperopt.base import QueueLengthController
 from hyperopt.base import Random
 from hyperopt.base import RandomStop
+from hyperopt.base import RunBudget
 from hyperopt.base import SONify
 from hyperopt.base import Trials
 from hyperopt.base import trials_from_docs
@@ -116,6 +126,474 @@ class TestTrials(unittest.TestCase):
         assert len(trials) == len(trials.results)
         assert len(trials) == len(trials.miscs)
 
+    def test_columns(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=4), ok_trial(tid=9)])
+        trials.refresh()
+        cols = trials.columns()
+        assert cols.keys == ['z']
+        assert list(cols.tids) == [4, 9]
+        assert list(cols.vals['z']) == [1, 1]
+        assert list(cols.active['z']) == [True, True]
+
+        # -- add a trial in which 'z' is inactive
+        doc = ok_trial(tid=11)
+        doc['misc']['idxs']['z'] = []
+        doc['misc']['vals']['z'] = []
+        trials.insert_trial_doc(doc)
+        assert len(trials.columns()) == 2
+        trials.refresh()
+        cols = trials.columns()
+        assert list(cols.tids) == [4, 9, 11]
+        assert list(cols.active['z']) == [True, True, False]
+        assert cols.vals['z'].dtype.kind == 'i'
+
+    def test_idxs_vals_cache(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=4), ok_trial(tid=9)])
+        trials.refresh()
+        idxs = trials.idxs
+        assert idxs is trials.idxs
+        assert idxs == {'z': [4, 9]}
+        assert trials.vals == {'z': [1, 1]}
+
+        trials.insert_trial_doc(ok_trial(tid=11))
+        assert trials.idxs == {'z': [4, 9]}
+        trials.refresh()
+        assert trials.idxs == {'z': [4, 9, 11]}
+        assert trials.vals == {'z': [1, 1, 1]}
+        assert (trials.idxs, trials.vals) == miscs_to_idxs_vals(trials.miscs)
+
+    def test_refresh_incremental(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=4), ok_trial(tid=9)])
+        trials.refresh()
+        assert trials.tids == [4, 9]
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_ERROR})
+        trials.insert_trial_doc(ok_trial(tid=11))
+        assert trials.tids == [4, 9]
+        trials.refresh()
+        assert trials.tids == [9, 11]
+        trials.refresh()
+        assert trials.tids == [9, 11]
+
+    def test_trial_by_tid(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=4), ok_trial(tid=9)])
+        trials.refresh()
+        assert trials.trial_by_tid(9)['tid'] == 9
+        self.assertRaises(KeyError, trials.trial_by_tid, 11)
+        trials.insert_trial_doc(ok_trial(tid=11))
+        trials.refresh()
+        assert trials.trial_by_tid(11)['tid'] == 11
+        trials.update_trial(trials.trial_by_tid(4), {'state': JOB_STATE_ERROR})
+        trials.refresh()
+        assert trials.tid_index() == {9: 0, 11: 1}
+        self.assertRaises(KeyError, trials.trial_by_tid, 4)
+
+    def test_loss_columns(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        assert trials.losses() == [None, None, None]
+        cols = trials.loss_columns()
+        assert not np.any(cols.final)
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_DONE,
+            'result': {'status': STATUS_OK, 'loss': 2.5}})
+        assert trials.loss_columns() is cols
+        assert trials.losses() == [None, 2.5, None]
+        assert trials.statuses() == ['algo, ok', STATUS_OK, 'algo, ok']
+        assert list(cols.final) == [False, True, False]
+        assert list(cols.loss_variance[1:2]) == [0]
+        assert trials.average_best_error() == 2.5
+        trials.insert_trial_doc(dict(ok_trial(tid=3), state=JOB_STATE_DONE,
+            result={'status': STATUS_OK, 'loss': 1.0}))
+        trials.refresh()
+        assert trials.losses() == [None, 2.5, None, 1.0]
+        assert trials.average_best_error() == 1.0
+
+        class NoisyBandit(Bandit):
+            def loss_variance(self, result, config=None):
+                return 1.0
+        cols2 = trials.loss_columns(NoisyBandit(None))
+        assert cols2 is not cols
+        assert list(cols2.loss_variance[[1, 3]]) == [1.0, 1.0]
+        # -- P(N(2.5, 1) < N(1, 1)) is about 0.1444
+        err = trials.average_best_error(NoisyBandit(None))
+        assert abs(err - (1.0 + 0.1444 * 1.5)) < 0.005, err
+
+        # -- nor does a bandit whose instance has its own loss_variance
+        bandit = Bandit(None)
+        bandit.loss_variance = lambda result, config=None: 1.0
+        cols3 = trials.loss_columns(bandit)
+        assert cols3 is not cols
+        assert list(cols3.loss_variance[[1, 3]]) == [1.0, 1.0]
+
+    def test_snapshot(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        trials.refresh()
+        snap = trials.snapshot()
+        trials.insert_trial_doc(ok_trial(tid=2))
+        trials.refresh()
+        snap.refresh()
+        assert snap.tids == [0, 1]
+        assert snap.losses() == [None, None]
+        assert len(trials) == 3
+
+    def test_loss_columns_growth(self):
+        trials = self.trials
+        cols = trials.loss_columns()
+        for ii in range(100):
+            trials.insert_trial_doc(dict(ok_trial(tid=ii),
+                state=JOB_STATE_DONE,
+                result={'status': STATUS_OK, 'loss': float(ii)}))
+            trials.refresh()
+            assert trials.loss_columns() is cols
+            assert len(cols) == ii + 1
+        assert trials.losses() == map(float, range(100))
+        # -- rows are appended in place, not by copying every column
+        assert len(cols._arrays['loss']) < 2 * 100
+
+    def test_count_by_state(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        assert trials.count_by_state_unsynced(JOB_STATE_NEW) == 3
+        trials.refresh()
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_DONE})
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_ERROR})
+        assert trials.count_by_state_unsynced(JOB_STATE_NEW) == 1
+        assert trials.count_by_state_unsynced(
+                [JOB_STATE_NEW, JOB_STATE_DONE]) == 2
+        assert trials.count_by_state_unsynced(JOB_STATE_ERROR) == 1
+        other = trials.view(exp_key='other_experiment')
+        assert other.count_by_state_unsynced(JOB_STATE_NEW) == 0
+        trials.refresh()
+        assert trials.count_by_state_synced(JOB_STATE_ERROR) == 0
+        assert trials.count_by_state_synced(JOB_STATE_DONE) == 1
+
+    def test_next_new_trial(self):
+        trials = self.trials
+        assert trials.next_new_trial() is None
+        docs = [ok_trial(tid=ii) for ii in range(3)]
+        docs[1]['state'] = JOB_STATE_DONE
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+        assert trials.next_new_trial()['tid'] == 0
+        assert trials.next_new_trial()['tid'] == 0
+        trials.update_trial(trials.next_new_trial(),
+                {'state': JOB_STATE_RUNNING})
+        assert trials.next_new_trial()['tid'] == 2
+        trials.update_trial(trials.next_new_trial(),
+                {'state': JOB_STATE_DONE})
+        assert trials.next_new_trial() is None
+        trials.refresh()
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_NEW})
+        trials.refresh()
+        assert trials.next_new_trial()['tid'] == 0
+
+    def test_cancel_new_trials(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_RUNNING})
+        assert trials.cancel_new_trials('test') == 2
+        assert trials.count_by_state_unsynced(JOB_STATE_NEW) == 0
+        assert trials.count_by_state_unsynced(JOB_STATE_ERROR) == 2
+        assert trials.count_by_state_unsynced(JOB_STATE_RUNNING) == 1
+        assert trials.cancel_new_trials('test') == 0
+
+    def test_insert_without_validation(self):
+        trials = self.trials
+        doc = ok_trial(tid=3)
+        doc['misc']['tid'] = 4
+        doc['spec']['a'] = np.arange(2)
+        self.assertRaises(InvalidTrial, trials.insert_trial_docs, [doc])
+        trials.insert_trial_docs([doc], validate=False)
+        trials.refresh()
+        assert trials.tids == [3]
+        assert trials.specs[0]['a'] == [0, 1]
+
+    def test_insert_unencodable(self):
+        trials = self.trials
+        bad = ok_trial(tid=1)
+        bad['spec']['a'] = {1: 'non-string key'}
+        self.assertRaises(bson.errors.InvalidDocument,
+                trials.insert_trial_docs, [ok_trial(tid=0), bad])
+        trials.refresh()
+        assert len(trials) == 0
+
+    def test_compact_misc(self):
+        trials = self.trials
+        docs = [ok_trial(tid=ii) for ii in range(4)]
+        docs[1]['misc']['idxs']['z'] = []
+        docs[1]['misc']['vals']['z'] = []
+        docs[2]['misc']['vals']['z'] = [2.5]
+        trials.insert_trial_docs(docs[:2])
+        trials.insert_trial_docs([compact_misc_trial(doc)
+            for doc in docs[2:]])
+        trials.refresh()
+        assert trials.miscs[2]['idxs'] is None
+        assert trials.miscs[2]['vals'] == {'z': 2.5}
+        assert trials.idxs == {'z': [0, 2, 3]}
+        assert trials.vals == {'z': [1, 2.5, 1]}
+        cols = trials.columns()
+        assert list(cols.active['z']) == [True, False, True, True]
+
+
+class NoAlgo(object):
+    """Suggests no trials"""
+    def __init__(self, bandit):
+        self.bandit = bandit
+
+    def suggest(self, new_ids, trials):
+        return []
+
+
+class TestWaitForChange(unittest.TestCase):
+    def setUp(self):
+        self.trials = Trials()
+
+    def test_wait_for_change(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        trials.refresh()
+        token = trials.change_token()
+        assert not trials.wait_for_change(token, 0.01)
+
+        def finish():
+            time.sleep(0.1)
+            trials.view().update_trial(trials.trials[0],
+                    {'state': JOB_STATE_DONE})
+        thread = threading.Thread(target=finish)
+        thread.start()
+        t0 = time.time()
+        assert trials.wait_for_change(token, 10)
+        assert time.time() - t0 < 5
+        thread.join()
+        # -- a change made before waiting is not missed
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_DONE})
+        assert trials.wait_for_change(token, 10)
+
+        trials2 = cPickle.loads(cPickle.dumps(trials))
+        token = trials2.change_token()
+        trials2.update_trial(trials2.trials[0], {'state': JOB_STATE_NEW})
+        assert trials2.wait_for_change(token, 0)
+        assert trials.trials[0]['state'] == JOB_STATE_DONE
+
+    def test_block_until_done_wakes(self):
+        trials = self.trials
+        algo = NoAlgo(Bandit(None))
+        exp = Experiment(trials, algo, async=True, poll_interval_secs=30)
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+
+        def work():
+            for trial in list(trials._dynamic_trials):
+                time.sleep(0.05)
+                trials.update_trial(trial, {'state': JOB_STATE_DONE})
+        thread = threading.Thread(target=work)
+        thread.start()
+        t0 = time.time()
+        exp.block_until_done()
+        assert time.time() - t0 < 5
+        thread.join()
+        assert trials.count_by_state_synced(JOB_STATE_DONE) == 3
+
+
+class SlowAlgo(object):
+    """Suggests ok_trial docs after `delay` seconds, and records how many
+    DONE trials each call saw"""
+    def __init__(self, bandit, delay):
+        self.bandit = bandit
+        self.delay = delay
+        self.seen = []
+
+    def suggest(self, new_ids, trials):
+        self.seen.append(trials.count_by_state_synced(JOB_STATE_DONE))
+        time.sleep(self.delay)
+        rval = []
+        for tid in new_ids:
+            doc = ok_trial(tid)
+            doc['result'] = self.bandit.new_result()
+            rval.append(doc)
+        return rval
+
+
+class SleepBandit(Bandit):
+    def __init__(self, delay):
+        Bandit.__init__(self, None)
+        self.delay = delay
+
+    def evaluate(self, config, ctrl):
+        time.sleep(self.delay)
+        return {'status': STATUS_OK, 'loss': 1.0}
+
+
+class TestSuggestionPrefetcher(unittest.TestCase):
+    def run_exp(self, max_stale):
+        self.trials = Trials()
+        self.algo = SlowAlgo(SleepBandit(0.2), 0.2)
+        exp = Experiment(self.trials, self.algo, async=False)
+        exp.prefetch_suggestions = True
+        exp.prefetch_max_stale = max_stale
+        t0 = time.time()
+        exp.run(5)
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 5
+        assert len(set(self.trials.tids)) == 5
+        return time.time() - t0
+
+    def test_overlap(self):
+        secs = self.run_exp(max_stale=1)
+        # -- suggestions are computed while the previous trial evaluates
+        assert secs < 0.2 * 5 * 2 * 0.8
+        assert self.algo.seen == [0, 0, 1, 2, 3]
+
+    def test_stale(self):
+        secs = self.run_exp(max_stale=0)
+        assert secs >= 0.2 * 5 * 2
+        # -- the prefetched suggestions were discarded, and made afresh
+        #    from the full history
+        fresh = [self.algo.seen[ii] for ii in range(0, 9, 2)]
+        assert fresh == [0, 1, 2, 3, 4]
+
+
+class TestQueueLengthController(unittest.TestCase):
+    def timed_trials(self, n_workers, secs, n=20):
+        trials = Trials()
+        t0 = datetime.datetime(2012, 1, 1)
+        docs = []
+        for ii in range(n):
+            doc = ok_trial(tid=ii)
+            doc['state'] = JOB_STATE_DONE
+            doc['owner'] = ['host', ii % n_workers]
+            doc['book_time'] = t0
+            doc['refresh_time'] = t0 + datetime.timedelta(seconds=secs)
+            docs.append(doc)
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+        return trials
+
+    def test_measure(self):
+        controller = QueueLengthController()
+        assert controller.measure(Trials()) == (None, None)
+        assert controller.update(7, Trials()) == 7
+        trials = self.timed_trials(10, 2.0)
+        assert controller.measure(trials) == (10, 2.0)
+
+    def test_update(self):
+        trials = self.timed_trials(10, 1.0)
+        controller = QueueLengthController(margin=1.5, max_len=100,
+                reserve_secs=0.25)
+        controller.record_suggest(10, 0.5)
+        # -- 15 jobs/s for 0.5s (wake) + 0.5s (suggest) + 0.25s (reserve),
+        #    reached in steps of at most half the queue length
+        qlens = [1]
+        for ii in range(10):
+            qlens.append(controller.update(qlens[-1], trials,
+                wake_secs=0.5))
+        assert qlens == [1, 2, 3, 5, 8, 12, 18, 19, 19, 19, 19]
+        # -- waking at once still leaves a suggest call and a reservation
+        assert controller.update(19, trials, wake_secs=0.0) == 12
+        # -- slower suggestions call for a longer queue, but gradually
+        controller.record_suggest(1, 10.0)
+        assert controller.target(10, 1.0, wake_secs=0.5) == 48
+        assert controller.update(19, trials, wake_secs=0.5) == 29
+
+    def test_serial_run(self):
+        trials = Trials()
+        exp = Experiment(trials, SlowAlgo(SleepBandit(0.01), 0.0),
+                async=False)
+        exp.queue_length_controller = QueueLengthController()
+        exp.run(5)
+        assert trials.count_by_state_synced(JOB_STATE_DONE) == 5
+        for trial in trials:
+            assert trial['refresh_time'] > trial['book_time']
+        assert exp.max_queue_len == 1
+
+
+class TestRunBudget(unittest.TestCase):
+    def run_exp(self, budget, delay=0.05, N=100):
+        self.trials = Trials()
+        exp = Experiment(self.trials, SlowAlgo(SleepBandit(delay), 0.0),
+                async=False)
+        exp.budget = budget
+        exp.run(N)
+        return self.trials.count_by_state_synced(JOB_STATE_DONE)
+
+    def test_wall_secs(self):
+        t0 = time.time()
+        n_done = self.run_exp(RunBudget(wall_secs=0.3))
+        assert 3 <= n_done <= 7, n_done
+        assert time.time() - t0 < 1.0
+
+    def test_worker_secs(self):
+        n_done = self.run_exp(RunBudget(worker_secs=0.2))
+        assert 3 <= n_done <= 5, n_done
+
+    def test_loss_target(self):
+        # -- SleepBandit's loss is 1.0
+        assert self.run_exp(RunBudget(loss_target=0.5), delay=0, N=5) == 5
+        assert self.run_exp(RunBudget(loss_target=1.0), delay=0) == 1
+
+    def test_loss_target_reached(self):
+        trials = Trials()
+        bandit = Bandit(None)
+        budget = RunBudget(loss_target=1.0)
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        trials.refresh()
+        assert not budget.loss_target_reached(trials, bandit)
+        # -- a pending trial's loss counts for as long as it lasts
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_RUNNING,
+            'result': {'status': STATUS_OK, 'loss': 0.5}})
+        assert budget.loss_target_reached(trials, bandit)
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_DONE,
+            'result': {'status': STATUS_OK, 'loss': 2.0}})
+        assert not budget.loss_target_reached(trials, bandit)
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_DONE,
+            'result': {'status': STATUS_OK, 'loss': 1.0}})
+        assert budget.loss_target_reached(trials, bandit)
+        assert budget._loss_target_reached
+
+    def test_cancel_new(self):
+        trials = Trials()
+        exp = Experiment(trials, SlowAlgo(SleepBandit(0), 0.0), async=True,
+                max_queue_len=3)
+        exp.budget = RunBudget(wall_secs=0.1, cancel_new=True)
+        exp.run(10, block_until_done=False)
+        assert trials.count_by_state_unsynced(JOB_STATE_NEW) == 0
+        assert trials.count_by_state_unsynced(JOB_STATE_ERROR) == 3
+        for trial in trials._dynamic_trials:
+            assert trial['misc']['error'][0] == 'cancelled'
+
+
+def compact_misc_trial(doc):
+    rval = dict(doc)
+    rval['misc'] = compact_misc(doc['misc'])
+    return rval
+
+
+def test_compact_misc():
+    idxs = {'a': [0, 2], 'b': [1], 'c': []}
+    vals = {'a': [0.5, 1.5], 'b': ['x'], 'c': []}
+    full = [dict(tid=ii) for ii in range(3)]
+    compact = [dict(tid=ii) for ii in range(3)]
+    miscs_update_idxs_vals(full, idxs, vals)
+    miscs_update_idxs_vals(compact, idxs, vals, compact=True)
+    assert full[0]['idxs'] == {'a': [0], 'b': [], 'c': []}
+    assert compact[0] == {'tid': 0, 'idxs': None, 'vals': {'a': 0.5}}
+    assert compact == [compact_misc(misc) for misc in full]
+    keys = idxs.keys()
+    assert miscs_to_idxs_vals(full) == (idxs, vals)
+    assert miscs_to_idxs_vals(compact, keys=keys) == (idxs, vals)
+    # -- without keys, only nodes that are active somewhere are found
+    assert miscs_to_idxs_vals(compact) == (
+            {'a': [0, 2], 'b': [1]},
+            {'a': [0.5, 1.5], 'b': ['x']})
+    # -- the formats can be mixed
+    assert miscs_to_idxs_vals(compact[:1] + full[1:], keys=keys) == (
+            idxs, vals)
+
 
 class BanditMixin(object):
     def test_dry_run(self):
@@ -395,6 +873,102 @@ class TestConfigs(unittest.TestCase):
         self.foo()
 
 
+class TestConstantFolding(unittest.TestCase):
+    def setUp(self):
+        self.expr = as_apply(dict(
+            p0=uniform(0, 1),
+            p1=one_of(0, 1),
+            log_lr=scope.log(0.01),
+            layers=[
+                dict(n_units=10, act='tanh'),
+                dict(n_units=20, act='relu')]))
+        self.bandit = ZeroBandit(self.expr)
+
+        class NoFold(Random):
+            fold_constants = False
+        self.folded = Random(self.bandit)
+        self.unfolded = NoFold(self.bandit)
+
+    def test_constant_nodes(self):
+        consts = self.folded.vh.constant_nodes()
+        names = set(node.name for node in consts)
+        assert 'uniform' not in names
+        assert 'one_of' not in names
+        assert 'dict' in names
+        assert 'log' in names
+        # -- the root depends on p0 and p1
+        assert self.folded.vh.expr not in consts
+
+    def test_constant_roots(self):
+        vh = self.folded.vh
+        roots = vh.constant_roots(vh.constant_nodes())
+        # -- the layers list and log_lr, not the dicts within layers
+        assert sorted(node.name for node in roots) == ['log', 'pos_args']
+
+    def test_smaller_graph(self):
+        n_folded = len(dfs(self.folded.s_specs_idxs_vals))
+        n_unfolded = len(dfs(self.unfolded.s_specs_idxs_vals))
+        assert n_folded < n_unfolded, (n_folded, n_unfolded)
+
+        def mapped(algo):
+            return sorted(node.pos_args[1]._obj
+                    for node in dfs(algo.s_specs_idxs_vals)
+                    if node.name == 'idxs_map')
+        # -- only the root dict is still built per sample
+        assert mapped(self.unfolded).count('dict') == 3
+        assert mapped(self.folded).count('dict') == 1
+        assert 'log' not in mapped(self.folded)
+
+    def test_same_docs(self):
+        docs0 = self.folded.suggest(range(5), Trials())
+        docs1 = self.unfolded.suggest(range(5), Trials())
+        for d0, d1 in zip(docs0, docs1):
+            s0 = SONify(d0['spec'])
+            s1 = SONify(d1['spec'])
+            assert s0['layers'] == s1['layers']
+            assert s0['layers'][1] == dict(n_units=20, act='relu')
+            assert s0['log_lr'] == s1['log_lr'] == np.log(0.01)
+            assert set(d0['misc']['idxs']) == set(d1['misc']['idxs'])
+        trials_from_docs(docs0)
+
+    def test_unshared_containers(self):
+        # -- folded lists and dicts are copied for each sample
+        docs = self.folded.suggest(range(2), Trials())
+        layers0 = docs[0]['spec']['layers']
+        layers1 = docs[1]['spec']['layers']
+        assert layers0 is not layers1
+        assert layers0[0] is not layers1[0]
+        layers0[0]['n_units'] = 99
+        assert layers1[0]['n_units'] == 10
+
+    def test_run(self):
+        trials = Trials()
+        Experiment(trials, self.folded, async=False).run(5)
+        assert len(trials) == 5
+
+
+def benchmark_SONify(n):
+    """Return the time to SONify a result with several n-element fields
+    """
+    rng = np.random.RandomState(0)
+    curve = rng.rand(n)
+    result = {
+        'loss': np.float64(curve.min()),
+        'status': STATUS_OK,
+        'curve': curve,
+        'epochs': np.arange(n),
+        'curve_list': list(curve[:n // 10]),
+        'per_epoch': [{'epoch': ii, 'err': curve[ii]}
+            for ii in xrange(n // 10)],
+        }
+    t0 = time.time()
+    rval = SONify(result)
+    t1 = time.time()
+    assert rval['curve'] == curve.tolist()
+    assert rval['per_epoch'][-1]['err'] == curve[n // 10 - 1]
+    return t1 - t0
+
+
 class TestSONify(unittest.TestCase):
 
     def SONify(self, foo):
@@ -438,7 +1012,108 @@ class TestSONify(unittest.TestCase):
         thing = dict(a=1, b='2', c=True, d=False, e=np.int(3), f=[1l])
         assert thing == SONify(thing)
 
-
+    def test_np_bool(self):
+        assert self.SONify(np.asarray([True, False])) == [1, 0]
+        assert self.SONify(np.bool_(True)) == 1
+
+    def test_np_0d(self):
+        assert self.SONify(np.asarray(2.5)) == 2.5
+
+    def test_np_object(self):
+        rval = self.SONify(np.asarray([np.float32(1.5), 'a'], dtype=object))
+        assert rval == [1.5, 'a']
+        assert type(rval[0]) is float
+
+    def test_tuple(self):
+        rval = SONify((1, [np.int64(2)], (np.float64(3.5),)))
+        assert rval == (1, [2], (3.5,))
+        assert type(rval[2][0]) is float
+
+    def test_shared(self):
+        shared = [np.int64(1), {'b': np.float64(2)}]
+        rval = SONify({'x': shared, 'y': shared, 'z': (shared, shared)})
+        assert rval['x'] == [1, {'b': 2.0}]
+        assert rval['x'] is rval['y']
+        assert rval['z'][0] is rval['z'][1] is rval['x']
+
+    def test_deep(self):
+        thing = []
+        for ii in xrange(10000):
+            thing = [thing, np.int64(ii)]
+        rval = SONify(thing)
+        assert rval[1] == 9999
+        assert rval[0][0][1] == 9997
+
+    def test_shared_arrays(self):
+        arr = np.arange(3)
+        flags = np.asarray([True, False])
+        rval = self.SONify({'x': arr, 'y': [arr, flags], 'z': flags})
+        assert rval['x'] == [0, 1, 2]
+        assert rval['y'][0] is rval['x']
+        assert rval['z'] == [1, 0]
+        assert rval['y'][1] is rval['z']
+
+    def test_memo_across_calls(self):
+        shared = {'a': [np.int64(1)]}
+        memo = {}
+        rval0 = SONify(shared, memo)
+        rval1 = SONify([shared, shared['a']], memo)
+        assert rval1[0] is rval0
+        assert rval1[1] is rval0['a']
+
+    def test_np_0d_kinds(self):
+        rval = self.SONify(np.asarray(3))
+        assert rval == 3 and type(rval) is int
+        assert self.SONify(np.asarray(True)) == 1
+        assert self.SONify(np.asarray('abc')) == 'abc'
+
+    def test_np_bool_2d(self):
+        assert self.SONify(np.asarray([[True], [False]])) == [[1], [0]]
+
+    def test_large(self):
+        # -- timing: python -m hyperopt.tests.test_base
+        benchmark_SONify(1000)
+
+
+def test_refresh_views():
+    trials = Trials()
+    view_a = trials.view(exp_key='a')
+    view_b = trials.view(exp_key='b')
+    docs = [ok_trial(tid=ii) for ii in range(4)]
+    for doc, key in zip(docs, 'abab'):
+        doc['exp_key'] = key
+    trials.insert_trial_docs(docs)
+    for tt in trials, view_a, view_b:
+        tt.refresh()
+    assert trials.tids == [0, 1, 2, 3]
+    assert view_a.tids == [0, 2]
+    assert view_b.tids == [1, 3]
+
+    # -- a failed job drops out of every view that contains it
+    trials.update_trial(view_a.trials[0], {'state': JOB_STATE_ERROR})
+    trials.update_trial(view_b.trials[0], {'state': JOB_STATE_ERROR})
+    for tt in trials, view_a, view_b:
+        tt.refresh()
+    assert trials.tids == [2, 3]
+    assert view_a.tids == [2]
+    assert view_b.tids == [3]
+
+    # -- re-queueing it puts it back where it was
+    epoch = trials._trials_epoch
+    trials.update_trial(trials._dynamic_trials[0], {'state': JOB_STATE_NEW})
+    # -- failing and re-queueing between refreshes is a no-op
+    view_b.update_trial(trials._dynamic_trials[2], {'state': JOB_STATE_ERROR})
+    view_b.update_trial(trials._dynamic_trials[2], {'state': JOB_STATE_NEW})
+    trials.insert_trial_doc(dict(ok_trial(tid=4), exp_key='a'))
+    for tt in trials, view_a, view_b:
+        tt.refresh()
+    assert trials.tids == [0, 2, 3, 4]
+    assert view_a.tids == [0, 2, 4]
+    assert view_b.tids == [3]
+    assert trials.tids == [tt['tid'] for tt in trials]
+    # -- (not an append, so caches of trials start over)
+    assert trials._trials_epoch > epoch
+    assert trials.columns().tids.tolist() == [0, 2, 3, 4]
 
 
 def test_failure():
@@ -472,4 +1147,6 @@ def test_failure():
     assert trials._dynamic_trials[1]['misc']['error'] != None
 
 
-
+if __name__ == '__main__':
+    print 'SONify of 1M-element result: %f seconds' % (
+            benchmark_SONify(1000000))
@@ -0,0 +1,161 @@
+import copy
+import cPickle
+import sys
+import types
+
+import numpy as np
+
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.base import JOB_STATE_ERROR
+from hyperopt.base import SONify
+from hyperopt.base import Trials
+from hyperopt.compact import CompactMisc
+from hyperopt.compact import CompactTrial
+from hyperopt.compact import CompactTrials
+
+import hyperopt.tests.test_base
+from hyperopt.tests.test_base import ok_trial
+
+
+class TestCompactTrials(hyperopt.tests.test_base.TestTrials):
+    def setUp(self):
+        self.trials = CompactTrials()
+
+    def test_views_match_docs(self):
+        trials = self.trials
+        docs = [ok_trial(ii, ii) for ii in range(5)]
+        docs[3]['misc']['idxs']['z'] = []
+        docs[3]['misc']['vals']['z'] = []
+        docs[4]['misc']['vals']['z'] = [2.5]
+        trials.insert_trial_docs(copy.deepcopy(docs))
+        trials.refresh()
+        assert len(trials) == 5
+        for doc, trial in zip(docs, trials):
+            assert isinstance(trial, CompactTrial)
+            assert isinstance(trial['misc'], CompactMisc)
+            assert trial == SONify(doc)
+            assert copy.deepcopy(trial) == SONify(doc)
+            assert type(copy.deepcopy(trial)) is dict
+        assert trials.tids == range(5)
+        assert trials.vals == {'z': [1, 1, 1, 2.5]}
+        assert trials.idxs == {'z': [0, 1, 2, 4]}
+
+    def test_shared_extras(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        store = trials._store
+        assert store.extras[0] is store.extras[2]
+        assert store.misc_extras[0] is store.misc_extras[2]
+        trials.trials[1]['owner'] = 'me'
+        trials.trials[1]['misc']['error'] = ('a', 'b')
+        assert trials.trials[1]['owner'] == 'me'
+        assert trials.trials[1]['misc']['error'] == ('a', 'b')
+        assert trials.trials[0]['owner'] is None
+        assert 'error' not in trials.trials[2]['misc']
+
+    def test_update_trial(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        trial = trials.trials[1]
+        misc = dict(trial['misc'], idxs={'z': [1]}, vals={'z': [7]})
+        trials.update_trial(trial, {
+            'state': JOB_STATE_DONE,
+            'result': {'status': 'ok', 'loss': 0.5},
+            'misc': misc})
+        assert trials.results[1]['loss'] == 0.5
+        assert trials.count_by_state_unsynced(JOB_STATE_DONE) == 1
+        trials.refresh()
+        assert trials.vals == {'z': [1, 7, 1]}
+
+        # -- misc that does not fit the columns is kept as-is
+        misc = dict(trial['misc'], tid=0, idxs={'z': [0]})
+        trials.update_trial(trial, {'misc': misc})
+        trials.refresh()
+        assert trials.trials[1]['misc'] is misc
+        assert trials.idxs == {'z': [0, 0, 2]}
+
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_ERROR})
+        trials.refresh()
+        assert trials.tids == [1, 2]
+
+    def test_pickle(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        trial = cPickle.loads(cPickle.dumps(trials.trials[2]))
+        assert type(trial) is dict
+        assert trial == trials.trials[2]
+        trials2 = cPickle.loads(cPickle.dumps(trials))
+        assert trials2.tids == trials.tids
+        assert trials2.specs == trials.specs
+
+    def test_views(self):
+        trials = self.trials
+        docs = [ok_trial(tid=ii) for ii in range(4)]
+        for doc, key in zip(docs, 'abab'):
+            doc['exp_key'] = key
+        trials.insert_trial_docs(docs)
+        view_a = trials.view(exp_key='a')
+        view_c = trials.view(exp_key='c')
+        trials.refresh()
+        assert view_a.tids == [0, 2]
+        assert view_c.tids == []
+        assert trials.tids == [0, 1, 2, 3]
+        assert list(view_a.columns().tids) == [0, 2]
+
+
+def footprint(obj):
+    """Return the bytes used by `obj` and everything it references:
+    sys.getsizeof of each object (counted once), plus the data of
+    ndarrays"""
+    seen = set()
+    stack = [obj]
+    rval = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType,
+                types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            # -- a view's getsizeof is the header alone
+            rval += sys.getsizeof(obj.view()) + obj.nbytes
+            if obj.dtype.kind == 'O':
+                stack.extend(obj.ravel().tolist())
+            continue
+        rval += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return rval
+
+
+def test_footprint():
+    n = 1000
+    sizes = []
+    for cls in Trials, CompactTrials:
+        trials = cls()
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(n)])
+        trials.refresh()
+        assert len(trials.columns()) == n
+        sizes.append(footprint(trials))
+    # -- only spec and result are stored as per-trial objects
+    assert sizes[1] < 0.5 * sizes[0], sizes
+    store = trials._store
+    assert len(set(map(id, store.extras))) == 1
+    assert len(set(map(id, store.misc_extras))) == 1
+    assert store.columns._vals['z'].dtype == np.dtype('int64')
+
+
+class TestCompactWaitForChange(hyperopt.tests.test_base.TestWaitForChange):
+    def setUp(self):
+        self.trials = CompactTrials()
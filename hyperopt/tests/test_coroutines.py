@@ -0,0 +1,224 @@
+import subprocess
+import sys
+import time
+import unittest
+
+import hyperopt.coroutines
+from hyperopt.base import Bandit
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.base import JOB_STATE_ERROR
+from hyperopt.base import JOB_STATE_RUNNING
+from hyperopt.base import STATUS_OK
+from hyperopt.base import Trials
+from hyperopt.coroutines import Cancelled
+from hyperopt.coroutines import CoroutineExperiment
+from hyperopt.coroutines import EventLoop
+from hyperopt.coroutines import Return
+from hyperopt.coroutines import WaitAny
+from hyperopt.coroutines import run_experiments
+
+from hyperopt.tests.test_parallel import ListAlgo
+
+
+class CoSleepBandit(Bandit):
+    """Coroutine that waits config['t'] seconds; fails for negative t"""
+    def __init__(self):
+        Bandit.__init__(self, None)
+
+    def evaluate(self, config, ctrl):
+        if config['t'] < 0:
+            raise ValueError('negative t')
+        yield config['t']
+        raise Return({'status': STATUS_OK, 'loss': config['t']})
+
+
+class ClosingBandit(CoSleepBandit):
+    """CoSleepBandit that fails after a while for t == 'fail', and counts
+    the evaluations that were closed"""
+    def __init__(self):
+        CoSleepBandit.__init__(self)
+        self.n_closed = 0
+
+    def evaluate(self, config, ctrl):
+        try:
+            if config['t'] == 'fail':
+                yield 0.05
+                raise ValueError('fail')
+            yield config['t']
+            raise Return({'status': STATUS_OK, 'loss': config['t']})
+        except GeneratorExit:
+            self.n_closed += 1
+            raise
+
+
+class TestEventLoop(unittest.TestCase):
+    def test_sleeps_overlap(self):
+        def sleeper(t):
+            yield t
+            raise Return(t)
+        t0 = time.time()
+        rval = EventLoop().run_until_complete(*[sleeper(.2)
+            for i in range(50)])
+        assert rval == [.2] * 50
+        assert time.time() - t0 < 1.0
+
+    def test_nested_and_errors(self):
+        def inner():
+            yield None
+            raise Return(3)
+
+        def outer():
+            a = yield inner()
+            try:
+                yield failing()
+            except ValueError:
+                raise Return(a + 1)
+
+        def failing():
+            yield None
+            raise ValueError()
+        assert EventLoop().run_until_complete(outer()) == [4]
+
+    def test_sleeps_without_polling(self):
+        class CountingTime(object):
+            n_calls = 0
+            def time(self):
+                self.n_calls += 1
+                return time.time()
+            def sleep(self, secs):
+                time.sleep(secs)
+        def sleeper(t):
+            yield t
+        def waiter(tasks):
+            yield WaitAny(tasks)
+        loop = EventLoop()
+        tasks = [loop.spawn(sleeper(.3)), loop.spawn(sleeper(.2))]
+        counter = hyperopt.coroutines.time = CountingTime()
+        try:
+            loop.run_until_complete(waiter(tasks), *tasks)
+        finally:
+            hyperopt.coroutines.time = time
+        # -- the loop goes round once per timer, rather than spinning or
+        #    waking every poll_interval
+        assert counter.n_calls <= 10
+
+    def test_cancel(self):
+        closed = []
+
+        def inner():
+            try:
+                yield 10
+            finally:
+                closed.append('inner')
+
+        def outer():
+            try:
+                yield inner()
+            finally:
+                closed.append('outer')
+        loop = EventLoop()
+        task = loop.spawn(outer())
+
+        def canceller():
+            # -- (after outer and inner have started)
+            yield 0.05
+            loop.cancel(task)
+        t0 = time.time()
+        loop.run_until_complete(canceller())
+        assert time.time() - t0 < 1.0
+        assert closed == ['inner', 'outer']
+        assert task.done and task.sub.done
+        self.assertRaises(Cancelled, task.get)
+        assert loop._waiting == {}
+
+    def test_deadlock(self):
+        def waiter(holder, ii):
+            yield holder[ii]
+        loop = EventLoop()
+        holder = []
+        t0 = loop.spawn(waiter(holder, 1))
+        t1 = loop.spawn(waiter(holder, 0))
+        holder.extend([t0, t1])
+        self.assertRaises(RuntimeError, loop.run_until_complete, t0)
+
+    def test_popen(self):
+        def waiter():
+            rc = yield subprocess.Popen([sys.executable, '-c',
+                'import sys; sys.exit(3)'])
+            raise Return(rc)
+        assert EventLoop().run_until_complete(waiter()) == [3]
+
+
+class SortedTrials(Trials):
+    """Trials listed by decreasing tid, like a backend that sorts them"""
+    def refresh(self):
+        Trials.refresh(self)
+        self._set_trials(sorted(self._trials, key=lambda t: -t['tid']))
+
+
+class TestCoroutineExperiment(unittest.TestCase):
+    def make(self, ts, trials=None, **kwargs):
+        if trials is None:
+            trials = Trials()
+        return CoroutineExperiment(trials,
+                ListAlgo(CoSleepBandit(), ts), **kwargs)
+
+    def test_trial_order(self):
+        # -- new trials are found by tid, wherever refresh() puts them
+        exp = self.make([0.05] * 6, trials=SortedTrials(),
+                max_in_flight=6, max_queue_len=2)
+        exp.run(6)
+        assert exp.trials.count_by_state_synced(JOB_STATE_DONE) == 6
+
+    def test_concurrent(self):
+        exp = self.make([0.2] * 100, max_in_flight=100, max_queue_len=10)
+        t0 = time.time()
+        exp.run(100)
+        assert time.time() - t0 < 0.2 * 100 / 10.
+        assert exp.trials.count_by_state_synced(JOB_STATE_DONE) == 100
+        assert exp.trials.losses() == [0.2] * 100
+
+    def test_max_in_flight(self):
+        exp = self.make([0.1] * 6, max_in_flight=2)
+        t0 = time.time()
+        exp.run(6)
+        assert time.time() - t0 >= 0.3
+        assert exp.trials.count_by_state_synced(JOB_STATE_DONE) == 6
+
+    def test_error(self):
+        exp = self.make([0.1, -1, 0.1], max_in_flight=3)
+        exp.catch_bandit_exceptions = True
+        exp.run(3)
+        assert exp.trials.count_by_state_synced(JOB_STATE_DONE) == 2
+        assert exp.trials.count_by_state_unsynced(JOB_STATE_ERROR) == 1
+
+        exp = self.make([-1])
+        exp.catch_bandit_exceptions = False
+        self.assertRaises(ValueError, exp.run, 1)
+
+    def test_raise_abandons_running(self):
+        # -- the evaluations still running when one fails are cancelled,
+        #    and their trials marked as errors
+        bandit = ClosingBandit()
+        exp = CoroutineExperiment(Trials(), ListAlgo(bandit, [10, 'fail', 10]),
+                max_in_flight=3, max_queue_len=3)
+        exp.catch_bandit_exceptions = False
+        t0 = time.time()
+        self.assertRaises(ValueError, exp.run, 3)
+        assert time.time() - t0 < 5
+        assert bandit.n_closed == 2
+        trials = exp.trials
+        assert trials.count_by_state_unsynced(JOB_STATE_RUNNING) == 0
+        assert trials.count_by_state_unsynced(JOB_STATE_ERROR) == 3
+        errors = [trial['misc']['error'][0]
+                for trial in trials._dynamic_trials]
+        assert errors.count('cancelled') == 2
+
+    def test_run_experiments(self):
+        exps = [self.make([0.2] * 5, max_in_flight=5, max_queue_len=5)
+                for i in range(4)]
+        t0 = time.time()
+        run_experiments(exps, 5)
+        assert time.time() - t0 < 0.2 * 4
+        for exp in exps:
+            assert exp.trials.count_by_state_synced(JOB_STATE_DONE) == 5
@@ -0,0 +1,94 @@
+import cPickle
+import os
+import shutil
+import tempfile
+
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.base import JOB_STATE_ERROR
+from hyperopt.filetrials import FileTrials
+
+import hyperopt.tests.test_base
+from hyperopt.tests.test_base import ok_trial
+
+
+class TestFileTrials(hyperopt.tests.test_base.TestTrials):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'trials.log')
+        self.trials = FileTrials(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_reload(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_ERROR})
+        trials.update_trial(trials.trials[2], {'state': JOB_STATE_DONE,
+            'result': {'status': 'ok', 'loss': 0.5}})
+        trials.refresh()
+
+        trials2 = FileTrials(self.path)
+        assert trials2.tids == [0, 2]
+        assert trials2.results[1] == {'status': 'ok', 'loss': 0.5}
+        assert trials2.count_by_state_unsynced(JOB_STATE_ERROR) == 1
+        assert trials2.idxs == trials.idxs
+
+    def test_shared(self):
+        trials = self.trials
+        trials2 = FileTrials(self.path)
+        ids = trials.new_trial_ids(2)
+        ids2 = trials2.new_trial_ids(2)
+        assert set(ids).isdisjoint(ids2), (ids, ids2)
+
+        trials2.insert_trial_docs([ok_trial(tid=tid) for tid in ids2])
+        assert trials.count_by_state_unsynced(JOB_STATE_DONE) == 0
+        trials.refresh()
+        assert trials.tids == ids2
+        trials.update_trial(trials.trials[0], {'state': JOB_STATE_DONE})
+        trials2.refresh()
+        assert trials2.trials[0]['state'] == JOB_STATE_DONE
+        assert trials2.count_by_state_unsynced(JOB_STATE_DONE) == 1
+
+    def test_incomplete_record(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        size = os.path.getsize(self.path)
+        trials.insert_trial_docs([ok_trial(tid=2)])
+        # -- simulate a writer that crashed half way through a record
+        fh = open(self.path, 'r+b')
+        fh.truncate(size + 10)
+        fh.close()
+        trials2 = FileTrials(self.path)
+        assert trials2.tids == [0, 1]
+        trials2.insert_trial_docs([ok_trial(tid=3)])
+        assert FileTrials(self.path).tids == [0, 1, 3]
+
+    def test_attachments(self):
+        trials = self.trials
+        trials.attachments['a'] = 'hello'
+        trials.attachments['b'] = 'world'
+        del trials.attachments['a']
+        trials2 = FileTrials(self.path)
+        assert 'a' not in trials2.attachments
+        assert trials2.attachments['b'] == 'world'
+
+    def test_pickle(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        s = cPickle.dumps(trials)
+        assert len(s) < 200
+        trials2 = cPickle.loads(s)
+        assert trials2.tids == [0, 1]
+
+    def test_delete_all(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        trials.attachments['a'] = 'hello'
+        trials2 = FileTrials(self.path)
+        trials.delete_all()
+        assert len(trials) == 0
+        trials2.refresh()
+        assert len(trials2) == 0
+        assert 'a' not in trials2.attachments
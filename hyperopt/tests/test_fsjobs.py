@@ -0,0 +1,175 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from hyperopt import Experiment
+from hyperopt import Random
+from hyperopt.bandits import GaussWave2
+from hyperopt.base import JOB_STATE_NEW
+from hyperopt.base import JOB_STATE_RUNNING
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.fsjobs import FSJobs
+from hyperopt.fsjobs import FSTrials
+from hyperopt.fsjobs import FSWorker
+from hyperopt.mongoexp import OperationFailure
+
+import hyperopt.tests.test_base
+from hyperopt.tests.test_base import ok_trial
+
+
+class TestFSTrials(hyperopt.tests.test_base.TestTrials):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.trials = FSTrials(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_refresh_changed(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        other = FSTrials(self.root)
+        assert other.tids == [0, 1, 2]
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_DONE})
+        other.refresh()
+        assert other.tids == [0, 1, 2]
+        assert other.trials[1]['state'] == JOB_STATE_DONE
+        assert other.trials[1]['version'] == 1
+
+    def test_attachments(self):
+        trials = self.trials
+        assert 'a/name' not in trials.attachments
+        trials.attachments['a/name'] = 'abcde'
+        trials.attachments['a/name'] = 'zzz'
+        assert trials.attachments[u'a/name'] == 'zzz'
+        del trials.attachments['a/name']
+        assert 'a/name' not in trials.attachments
+        trials.attachments['aname'] = 'a'
+        trials.delete_all()
+        assert 'aname' not in trials.attachments
+
+
+class TestFSJobs(object):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.jobs = FSJobs(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_reserve(self):
+        jobs = self.jobs
+        a = ok_trial(tid=0)
+        b = dict(ok_trial(tid=1), exp_key='b')
+        jobs.insert_docs([a, b])
+        assert jobs.reserve('h', exp_key='b')['tid'] == 1
+        job = jobs.reserve(('h', 2))
+        assert job['tid'] == 0
+        assert job['owner'] == ('h', 2)
+        assert job['state'] == JOB_STATE_RUNNING
+        assert jobs.reserve('h') is None
+        assert jobs.count([JOB_STATE_NEW]) == 0
+        assert jobs.count([JOB_STATE_RUNNING]) == 2
+        jobs.update(job, {'state': JOB_STATE_DONE})
+        assert jobs.count([JOB_STATE_RUNNING]) == 1
+        assert [doc['state'] for doc in jobs.find() if doc['tid'] == 0] \
+                == [JOB_STATE_DONE]
+
+    def test_count_exp_key(self):
+        jobs = self.jobs
+        jobs.insert_docs([dict(ok_trial(tid=ii), exp_key='a')
+            for ii in range(3)] + [dict(ok_trial(tid=3), exp_key='b')])
+        job = jobs.reserve('h', exp_key='a')
+        jobs.update(job, {'state': JOB_STATE_DONE})
+        reads = []
+        def read(path):
+            reads.append(path)
+            return FSJobs._read(jobs, path)
+        jobs._read = read
+        # -- NEW jobs are counted from their directory alone
+        assert jobs.count([JOB_STATE_NEW], exp_key='a') == 2
+        assert jobs.count([JOB_STATE_NEW], exp_key='c') == 0
+        assert reads == []
+        # -- others are read once, then found in the cache
+        cache = {}
+        assert jobs.count([JOB_STATE_DONE], exp_key='a', cache=cache) == 1
+        assert jobs.count([JOB_STATE_DONE], exp_key='b', cache=cache) == 0
+        assert len(reads) == 1
+
+    def test_update_version(self):
+        jobs = self.jobs
+        job = jobs.insert(ok_trial(tid=0))
+        stale = dict(job)
+        jobs.update(job, {'result': {'status': 'ok', 'loss': 1.0}})
+        assert job['version'] == 1
+        try:
+            jobs.update(stale, {'owner': 'x'})
+            assert 0
+        except OperationFailure:
+            pass
+        stored, = jobs.find()
+        assert stored['result']['loss'] == 1.0
+        assert stored['owner'] is None
+        assert os.listdir(os.path.join(self.root, 'tmp')) == []
+
+    def test_new_trial_ids(self):
+        assert self.jobs.new_trial_ids(2) == [0, 1]
+        assert FSJobs(self.root).new_trial_ids(3) == [2, 3, 4]
+
+    def test_reserve_processes(self):
+        # -- each job is reserved by exactly one of several processes
+        n_jobs = 200
+        self.jobs.insert_docs([ok_trial(tid=ii) for ii in range(n_jobs)])
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_reserve_all,
+                    args=(self.root, ii, queue))
+                for ii in range(4)]
+        [proc.start() for proc in procs]
+        tids = []
+        for proc in procs:
+            tids.extend(queue.get())
+        [proc.join() for proc in procs]
+        assert sorted(tids) == range(n_jobs)
+
+
+def _reserve_all(root, host_id, queue):
+    jobs = FSJobs(root)
+    tids = []
+    while True:
+        job = jobs.reserve(host_id)
+        if job is None:
+            break
+        tids.append(job['tid'])
+    queue.put(tids)
+
+
+class TestExperimentWithThreads(unittest.TestCase):
+    def worker_thread_fn(self, host_id, n_jobs):
+        worker = FSWorker(FSJobs(self.root))
+        while n_jobs:
+            worker.run_one(host_id, 30.0)
+            n_jobs -= 1
+
+    def test_bandit_json(self):
+        self.root = tempfile.mkdtemp()
+        try:
+            trials = FSTrials(self.root, exp_key='key0')
+            bandit_algo = Random(GaussWave2(), cmd=('bandit_json evaluate',
+                'hyperopt.bandits.GaussWave2'))
+            exp = Experiment(trials, bandit_algo, max_queue_len=10000)
+            threads = [threading.Thread(target=self.worker_thread_fn,
+                    args=(('hostname', ii), 2))
+                for ii in range(3)]
+            [th.start() for th in threads]
+            try:
+                exp.run(6, block_until_done=True)
+            finally:
+                [th.join() for th in threads]
+            assert trials.count_by_state_unsynced(JOB_STATE_DONE) == 6
+            assert len(trials.results) == 6
+        finally:
+            shutil.rmtree(self.root)
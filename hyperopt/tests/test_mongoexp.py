@@ -130,6 +130,26 @@ class TestMongoTrials(hyperopt.tests.test_base.TestTrials):
         self.temp_mongo.__exit__(*args)
 
 
+def test_compact_miscs():
+    with TempMongo() as temp_mongo:
+        trials = MongoTrials(temp_mongo.connection_string('foo'),
+                exp_key=None)
+        docs = [hyperopt.tests.test_base.ok_trial(tid=ii) for ii in range(3)]
+        docs[1]['misc']['idxs']['z'] = []
+        docs[1]['misc']['vals']['z'] = []
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+        idxs, vals = trials.idxs, trials.vals
+        assert trials.handle.compact_miscs() == 3
+        assert trials.handle.compact_miscs() == 0
+        trials = MongoTrials(temp_mongo.connection_string('foo'),
+                exp_key=None)
+        assert trials.miscs[0]['idxs'] is None
+        assert trials.miscs[0]['vals'] == {'z': 1}
+        assert trials.miscs[1]['vals'] == {}
+        assert (trials.idxs, trials.vals) == (idxs, vals)
+
+
 def with_mongo_trials(f):
     def wrapper():
         with TempMongo() as temp_mongo:
@@ -197,6 +217,18 @@ def test_new_trial_ids(trials):
     assert len(s) == 6
 
 
+@with_mongo_trials
+def test_insert_encodes_once(trials):
+    # -- pymongo's encoding on insert is the only one
+    def encode(doc):
+        raise AssertionError('doc encoded before insert')
+    trials._encode_trial = encode
+    trials.insert_trial_docs([hyperopt.tests.test_base.ok_trial(tid=0),
+        hyperopt.tests.test_base.ok_trial(tid=1)])
+    trials.refresh()
+    assert trials.tids == [0, 1]
+
+
 @with_mongo_trials
 def test_attachments(trials):
     blob = 'abcde'
@@ -239,6 +271,32 @@ def test_handles_are_independent():
         assert len(t2) == 0
 
 
+def test_wait_for_signal():
+    with TempMongo() as tm:
+        mj = tm.mongo_jobs('foo')
+        token = mj.last_signal()
+        assert token is not None
+        t0 = time.time()
+        assert not mj.wait_for_signal(token, 'a', timeout=0.2)
+        assert time.time() - t0 >= 0.2
+
+        def signal_later():
+            time.sleep(0.2)
+            # -- events of other experiments are skipped
+            tm.mongo_jobs('foo').signal({'exp_key': 'b', 'tid': 0})
+            time.sleep(0.2)
+            tm.mongo_jobs('foo').signal({'exp_key': 'a', 'tid': 1})
+        thread = threading.Thread(target=signal_later)
+        t0 = time.time()
+        thread.start()
+        try:
+            assert mj.wait_for_signal(token, 'a', timeout=10)
+        finally:
+            thread.join()
+        # -- woken by the event, not by the timeout
+        assert time.time() - t0 < 3
+
+
 class TestExperimentWithThreads(unittest.TestCase):
     """
     Test one or more experiments running simultaneously on a single database,
@@ -403,6 +461,10 @@ def test_main_search_runs(trials):
             workdir=None,
             poll_interval=1,
             max_queue_len=1,
+            wall_budget=None,
+            worker_budget=None,
+            loss_target=None,
+            cancel_queued=False,
             mongo=as_mongo_str('localhost:22334/foodb'),
             )
     args = ('hyperopt.bandits.TwoArms', 'hyperopt.Random')
@@ -424,6 +486,10 @@ def test_main_search_clear_existing(trials):
             workdir=None,
             poll_interval=1,
             max_queue_len=1,
+            wall_budget=None,
+            worker_budget=None,
+            loss_target=None,
+            cancel_queued=False,
             mongo=as_mongo_str('localhost:22334/foo'),
             )
     args = ('hyperopt.bandits.TwoArms', 'hyperopt.Random')
@@ -450,6 +516,10 @@ def test_main_search_driver_attachment(trials):
             workdir=None,
             poll_interval=1,
             max_queue_len=1,
+            wall_budget=None,
+            worker_budget=None,
+            loss_target=None,
+            cancel_queued=False,
             mongo=as_mongo_str('localhost:22334/foo'),
             )
     args = ('hyperopt.bandits.TwoArms', 'hyperopt.Random')
@@ -474,6 +544,10 @@ def test_main_search_driver_reattachment(trials):
             workdir=None,
             poll_interval=1,
             max_queue_len=1,
+            wall_budget=None,
+            worker_budget=None,
+            loss_target=None,
+            cancel_queued=False,
             mongo=as_mongo_str('localhost:22334/foo'),
             )
     args = ('hyperopt.bandits.TwoArms', 'hyperopt.Random')
@@ -0,0 +1,291 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import nose
+
+from hyperopt.base import Bandit
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.base import JOB_STATE_ERROR
+from hyperopt.base import JOB_STATE_NEW
+from hyperopt.base import STATUS_OK
+from hyperopt.base import Trials
+from hyperopt.filetrials import FileTrials
+from hyperopt.parallel import ParallelExperiment
+from hyperopt.parallel import _failure
+from hyperopt.parallel import _private_bytes
+from hyperopt.parallel import SupervisedExperiment
+from hyperopt.parallel import TrialTimeout
+from hyperopt.parallel import ThreadPoolExperiment
+
+from hyperopt.tests.test_base import ok_trial
+
+
+class SleepBandit(Bandit):
+    """Sleeps for config['t'] seconds; fails for negative t"""
+    def __init__(self):
+        Bandit.__init__(self, None)
+
+    def evaluate(self, config, ctrl):
+        if config['t'] < 0:
+            raise ValueError('negative t')
+        time.sleep(config['t'])
+        ctrl.attachments['pid'] = str(os.getpid())
+        return {'status': STATUS_OK, 'loss': config['t'], 'pid': os.getpid()}
+
+
+class ListAlgo(object):
+    """Suggests trials with the spec['t'] values of a list, in order"""
+    def __init__(self, bandit, ts):
+        self.bandit = bandit
+        self.ts = list(ts)
+
+    def suggest(self, new_ids, trials):
+        rval = []
+        for tid in new_ids:
+            if not self.ts:
+                break
+            doc = ok_trial(tid)
+            doc['spec'] = {'t': self.ts.pop(0)}
+            doc['result'] = self.bandit.new_result()
+            rval.append(doc)
+        return rval
+
+
+class TestParallelExperiment(unittest.TestCase):
+    def make(self, ts, trials=None, bandit=None, **kwargs):
+        self.trials = Trials() if trials is None else trials
+        if bandit is None:
+            bandit = SleepBandit()
+        self.exp = ParallelExperiment(self.trials,
+                ListAlgo(bandit, ts), **kwargs)
+        return self.exp
+
+    def tearDown(self):
+        if self.exp is not None:
+            self.exp.close()
+
+    def test_parallel(self):
+        exp = self.make([0.2] * 8, n_procs=4)
+        t0 = time.time()
+        exp.run(8)
+        # -- two rounds of 4 evaluations
+        assert time.time() - t0 < 0.2 * 8 * 0.75
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 8
+        assert self.trials.losses() == [0.2] * 8
+        pids = set([r['pid'] for r in self.trials.results])
+        assert 1 < len(pids) <= 4
+        assert os.getpid() not in pids
+        for trial in self.trials:
+            assert self.trials.trial_attachments(trial)['pid'] \
+                    == str(trial['result']['pid'])
+            assert trial['book_time'] is not None
+
+    def test_queue(self):
+        exp = self.make([0.1] * 6, n_procs=2, max_queue_len=3)
+        exp.run(4, block_until_done=False)
+        assert self.trials.count_by_state_unsynced(JOB_STATE_NEW) <= 3
+        exp.block_until_done()
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 4
+
+    def test_errors(self):
+        exp = self.make([0.0, -1.0, 0.0], n_procs=2)
+        exp.run(3)
+        assert len(self.trials) == 2
+        assert self.trials.count_by_state_unsynced(JOB_STATE_DONE) == 2
+        for trial in self.trials._dynamic_trials:
+            assert trial['refresh_time'] >= trial['book_time']
+
+        exp = self.make([-1.0], n_procs=2)
+        exp.catch_bandit_exceptions = False
+        self.assertRaises(ValueError, exp.run, 1)
+
+    def test_raise_keeps_other_outcomes(self):
+        exp = self.make([], n_procs=2)
+        exp.catch_bandit_exceptions = False
+        self.trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(2)])
+        self.trials.refresh()
+        exp._pending = dict((trial['tid'], trial) for trial in self.trials)
+        exp._finished = [
+                (0, _failure(ValueError('bad'))),
+                (1, ({'status': STATUS_OK, 'loss': 1.0}, None, None, {}, []))]
+        self.assertRaises(ValueError, exp._collect, False)
+        assert exp._pending == {}
+        self.trials.refresh()
+        assert self.trials.losses() == [1.0]
+
+    def test_file_trials(self):
+        # -- FileAttachments has no update()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            exp = self.make([0.05] * 2, n_procs=2, trials=FileTrials(path))
+            exp.run(2)
+            for trial in self.trials:
+                assert self.trials.trial_attachments(trial)['pid'] \
+                        == str(trial['result']['pid'])
+        finally:
+            os.remove(path)
+
+    def test_lost(self):
+        # -- evaluations that the pool never calls back for
+        exp = self.make(['die', 'exit', 'unpicklable', 0.05], n_procs=2,
+                bandit=LostBandit())
+        exp.lost_grace_secs = 0.1
+        exp.check_secs = 0.05
+        t0 = time.time()
+        exp.run(4)
+        assert time.time() - t0 < 5
+        assert self.trials.losses() == [0.05]
+        errors = sorted([trial['misc']['error'][0]
+            for trial in self.trials._dynamic_trials
+            if trial['state'] == JOB_STATE_ERROR])
+        assert len(errors) == 3
+        assert any('TrialDied' in error for error in errors)
+        assert 'SystemExit' in ' '.join(errors)
+
+    def test_maxtasksperchild(self):
+        exp = self.make([0.0] * 4, n_procs=1, maxtasksperchild=1)
+        exp.run(4)
+        pids = set([r['pid'] for r in self.trials.results])
+        assert len(pids) == 4
+
+
+class LostBandit(SleepBandit):
+    """SleepBandit whose process dies for t == 'die', that raises
+    SystemExit for t == 'exit', and whose result cannot be pickled for
+    t == 'unpicklable'"""
+    def evaluate(self, config, ctrl):
+        if config['t'] == 'die':
+            os._exit(3)
+        if config['t'] == 'exit':
+            sys.exit(3)
+        if config['t'] == 'unpicklable':
+            return {'status': STATUS_OK, 'loss': 0, 'f': lambda: None}
+        return SleepBandit.evaluate(self, config, ctrl)
+
+
+class InjectingSleepBandit(SleepBandit):
+    def evaluate(self, config, ctrl):
+        result = SleepBandit.evaluate(self, config, ctrl)
+        ctrl.inject_results([{'t': -config['t']}],
+                [dict(result, loss=-config['t'])],
+                [{'idxs': {'z': []}, 'vals': {'z': []}}])
+        return result
+
+
+class TestThreadPoolExperiment(TestParallelExperiment):
+    def make(self, ts, bandit=None, n_procs=4, max_queue_len=1,
+            maxtasksperchild=None, trials=None):
+        self.trials = Trials() if trials is None else trials
+        if bandit is None:
+            bandit = SleepBandit()
+        self.exp = ThreadPoolExperiment(self.trials,
+                ListAlgo(bandit, ts), n_threads=n_procs,
+                max_queue_len=max_queue_len)
+        return self.exp
+
+    def test_parallel(self):
+        exp = self.make([0.2] * 20, n_procs=10)
+        t0 = time.time()
+        exp.run(20)
+        assert time.time() - t0 < 0.2 * 20 * 0.25
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 20
+        for trial in self.trials:
+            assert self.trials.trial_attachments(trial)['pid'] \
+                    == str(os.getpid())
+
+    def test_maxtasksperchild(self):
+        self.exp = None  # -- threads are not recycled
+
+    def test_lost(self):
+        exp = self.make(['exit', 0.05], n_procs=2, bandit=LostBandit())
+        exp.run(2)
+        assert self.trials.losses() == [0.05]
+        assert self.trials.count_by_state_unsynced(JOB_STATE_ERROR) == 1
+
+    def test_inject(self):
+        exp = self.make([0.05] * 6, bandit=InjectingSleepBandit())
+        exp.run(6)
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 12
+        assert sorted(self.trials.losses()) == [-0.05] * 6 + [0.05] * 6
+        assert len(set(self.trials.tids)) == 12
+
+
+class LimitsBandit(SleepBandit):
+    """SleepBandit that exits for t == 'die', and grabs memory for
+    t == 'hog'"""
+    def evaluate(self, config, ctrl):
+        if config['t'] == 'die':
+            os._exit(3)
+        if config['t'] == 'hog':
+            hog = 'x' * (200 * 2 ** 20)
+            time.sleep(5)
+            return {'status': STATUS_OK, 'loss': len(hog)}
+        return SleepBandit.evaluate(self, config, ctrl)
+
+
+class TestSupervisedExperiment(unittest.TestCase):
+    def make(self, ts, **kwargs):
+        self.trials = Trials()
+        self.exp = SupervisedExperiment(self.trials,
+                ListAlgo(LimitsBandit(), ts), **kwargs)
+        return self.exp
+
+    def tearDown(self):
+        if self.exp is not None:
+            self.exp.close()
+
+    def errors(self):
+        return [trial['misc']['error']
+                for trial in self.trials._dynamic_trials
+                if trial['state'] == JOB_STATE_ERROR]
+
+    def test_ok(self):
+        exp = self.make([0.05, -1, 0.05], timeout=5)
+        exp.run(3)
+        assert self.trials.losses() == [0.05, 0.05]
+        assert len(self.errors()) == 1
+        assert 'ValueError' in self.errors()[0][0]
+
+    def test_timeout(self):
+        exp = self.make([0.05, 10, 0.05], timeout=0.5)
+        t0 = time.time()
+        exp.run(3)
+        assert time.time() - t0 < 5
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 2
+        assert 'TrialTimeout' in self.errors()[0][0]
+
+    def test_max_rss(self):
+        exp = self.make(['hog', 0.05], max_rss=100 * 2 ** 20)
+        # -- memory of the driver, inherited by the forked evaluation
+        #    processes, must not count against their limit
+        ballast = 'y' * (150 * 2 ** 20)
+        t0 = time.time()
+        exp.run(2)
+        assert time.time() - t0 < 4
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 1
+        assert len(self.errors()) == 1
+        assert 'TrialMemoryLimit' in self.errors()[0][0]
+        del ballast
+
+    def test_died(self):
+        exp = self.make(['die', 0.05], n_procs=2)
+        exp.run(2)
+        assert self.trials.count_by_state_synced(JOB_STATE_DONE) == 1
+        assert 'TrialDied' in self.errors()[0][0]
+
+    def test_raise(self):
+        exp = self.make([10], timeout=0.2)
+        exp.catch_bandit_exceptions = False
+        self.assertRaises(TrialTimeout, exp.run, 1)
+
+
+def test_private_bytes():
+    if _private_bytes(os.getpid()) is None:
+        raise nose.SkipTest('no /proc')
+    ballast = 'y' * (50 * 2 ** 20)
+    assert _private_bytes(os.getpid()) > 50 * 2 ** 20
+    del ballast
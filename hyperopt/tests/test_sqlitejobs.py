@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from hyperopt.base import JOB_STATE_NEW
+from hyperopt.base import JOB_STATE_RUNNING
+from hyperopt.base import JOB_STATE_DONE
+from hyperopt.mongoexp import OperationFailure
+from hyperopt.sqlitejobs import SQLiteJobs
+from hyperopt.sqlitejobs import SQLiteTrials
+
+import hyperopt.tests.test_base
+from hyperopt.tests.test_base import ok_trial
+
+
+class TestSQLiteTrials(hyperopt.tests.test_base.TestTrials):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'jobs.sqlite')
+        self.trials = SQLiteTrials(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_refresh_changed(self):
+        trials = self.trials
+        trials.insert_trial_docs([ok_trial(tid=ii) for ii in range(3)])
+        trials.refresh()
+        other = SQLiteTrials(self.path)
+        assert other.tids == [0, 1, 2]
+        trials.update_trial(trials.trials[1], {'state': JOB_STATE_DONE})
+        other.refresh()
+        assert other.trials[1]['state'] == JOB_STATE_DONE
+        assert other.trials[1]['version'] == 1
+
+    def test_attachments(self):
+        trials = self.trials
+        assert 'aname' not in trials.attachments
+        trials.attachments['aname'] = 'abcde'
+        trials.attachments['aname'] = 'zzz'
+        assert trials.attachments[u'aname'] == 'zzz'
+        del trials.attachments['aname']
+        assert 'aname' not in trials.attachments
+        trials.attachments['aname'] = 'a'
+        trials.delete_all()
+        assert 'aname' not in trials.attachments
+
+
+class TestSQLiteJobs(object):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'jobs.sqlite')
+        self.jobs = SQLiteJobs(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_reserve(self):
+        jobs = self.jobs
+        a, b = jobs.insert_docs([ok_trial(tid=0), ok_trial(tid=1)])
+        jobs.update(a, {'exp_key': 'a'})
+        jobs.update(b, {'exp_key': 'b'})
+        assert jobs.reserve('h', exp_key='b')['tid'] == 1
+        job = jobs.reserve('h')
+        assert job['tid'] == 0
+        assert job['owner'] == 'h'
+        assert job['state'] == JOB_STATE_RUNNING
+        assert jobs.reserve('h') is None
+        assert jobs.count([JOB_STATE_NEW]) == 0
+
+    def test_benchmark_reserve(self):
+        # -- the benchmark's work, on a few jobs
+        benchmark_reserve(self.jobs, n=5)
+        assert self.jobs.count([JOB_STATE_DONE]) == 5
+        assert self.jobs.reserve('h') is None
+        losses = sorted(doc['result']['loss']
+                for seq, doc in self.jobs.find())
+        assert losses == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+    def test_update_version(self):
+        jobs = self.jobs
+        job = jobs.insert(ok_trial(tid=0))
+        stale = dict(job)
+        jobs.update(job, {'result': {'status': 'ok', 'loss': 1.0}})
+        assert job['version'] == 1
+        try:
+            jobs.update(stale, {'owner': 'x'})
+            assert 0
+        except OperationFailure:
+            pass
+        (seq, stored), = jobs.find()
+        assert stored['result']['loss'] == 1.0
+        assert stored['owner'] is None
+
+    def test_job_attachments(self):
+        jobs = self.jobs
+        job = jobs.insert(ok_trial(tid=0))
+        jobs.set_attachment(job, 'abc', 'a')
+        assert jobs.attachment_names(job) == ['a']
+        assert jobs.get_attachment(job, 'a') == 'abc'
+        jobs.delete_all()
+        try:
+            jobs.get_attachment(job, 'a')
+            assert 0
+        except OperationFailure:
+            pass
+
+    def test_reserve_processes(self):
+        # -- each job is reserved by exactly one of several processes
+        n_jobs = 200
+        self.jobs.insert_docs([ok_trial(tid=ii) for ii in range(n_jobs)])
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_reserve_all,
+                    args=(self.path, ii, queue))
+                for ii in range(4)]
+        [proc.start() for proc in procs]
+        tids = []
+        for proc in procs:
+            tids.extend(queue.get())
+        [proc.join() for proc in procs]
+        assert sorted(tids) == range(n_jobs)
+
+
+def _reserve_all(path, host_id, queue):
+    jobs = SQLiteJobs(path)
+    tids = []
+    while True:
+        job = jobs.reserve(host_id)
+        if job is None:
+            break
+        tids.append(job['tid'])
+    queue.put(tids)
+
+
+def benchmark_reserve(jobs, n=1000):
+    """Return the time to insert, reserve, and finish `n` jobs, one at a time
+    """
+    t0 = time.time()
+    for ii in range(n):
+        jobs.insert(ok_trial(tid=ii))
+    t1 = time.time()
+    for ii in range(n):
+        job = jobs.reserve('h')
+        jobs.update(job, {'state': JOB_STATE_DONE,
+            'result': {'status': 'ok', 'loss': float(ii)}})
+    t2 = time.time()
+    return t1 - t0, t2 - t1
+
+
+def benchmark_sqlite(n):
+    tempdir = tempfile.mkdtemp()
+    try:
+        return benchmark_reserve(
+                SQLiteJobs(os.path.join(tempdir, 'jobs.sqlite')), n)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def benchmark_mongo(n):
+    from hyperopt.tests.test_mongoexp import TempMongo
+    temp_mongo = TempMongo().__enter__()
+    try:
+        return benchmark_reserve(temp_mongo.mongo_jobs('bench'), n)
+    finally:
+        temp_mongo.__exit__()
+
+
+if __name__ == '__main__':
+    print 'sqlite: insert %.3fs, reserve+update %.3fs' % (
+            benchmark_sqlite(1000))
+    try:
+        print 'mongo: insert %.3fs, reserve+update %.3fs' % (
+                benchmark_mongo(1000))
+    except OSError:
+        print 'mongo: mongod not available'
@@ -1,5 +1,7 @@
 import numpy as np
 from hyperopt.utils import fast_isin
+from hyperopt.utils import pmin_analytic
+from hyperopt.utils import pmin_sampled
 from hyperopt.utils import get_most_recent_inds
 
 
@@ -65,4 +67,37 @@ def test_get_most_recent_inds():
     test_data = [{'_id': -1, 'version':1}, {'_id':0, 'version':1},
                  {'_id':0, 'version':2}, {'_id':0, 'version':2}]
     
-    assert get_most_recent_inds(test_data).tolist() == [0, 3]
\ No newline at end of file
+    assert get_most_recent_inds(test_data).tolist() == [0, 3]
+
+def test_pmin_sampled_chunks():
+    rng = np.random.RandomState(3)
+    mean = rng.randn(7)
+    var = rng.rand(7)
+    a = pmin_sampled(mean, var, n_samples=1000)
+    b = pmin_sampled(mean, var, n_samples=1000, chunk_size=7)
+    assert np.all(a == b)
+
+
+def test_pmin_analytic_vs_sampled():
+    rng = np.random.RandomState(4)
+    for n in [1, 2, 5, 50]:
+        mean = rng.randn(n)
+        var = rng.rand(n) * .5 + .01
+        analytic = pmin_analytic(mean, var)
+        sampled = pmin_sampled(mean, var, n_samples=200000,
+                rng=np.random.RandomState(n))
+        assert np.allclose(analytic.sum(), 1)
+        assert np.allclose(analytic, sampled, atol=3e-3), (n,
+                analytic, sampled)
+    # -- chunking does not change the result
+    assert np.allclose(pmin_analytic(mean, var, chunk_size=3),
+            pmin_analytic(mean, var))
+
+
+def test_pmin_analytic_point_masses():
+    assert np.allclose(pmin_analytic([0, 0], [1, 1]), [.5, .5])
+    assert np.allclose(pmin_analytic([2., 1.], [0, 0]), [0, 1])
+    # -- P(N(1, 1) < 0) = 0.1587
+    assert np.allclose(pmin_analytic([0, 1, 0], [0, 1, 0]),
+            [.4207, .1587, .4207], atol=2e-3)
+    assert len(pmin_analytic([], [])) == 0
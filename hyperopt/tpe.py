@@ -794,8 +794,7 @@ class TreeParzenEstimator(BanditAlgo):
         #print self.post_llik
 
         bandit = self.bandit
-        docs_by_tid = dict([(d['tid'], d) for d in trials.trials])
-        if len(docs_by_tid) != len(trials.trials):
+        if len(trials.tid_index()) != len(trials.trials):
             import cPickle
             cPickle.dump(trials.trials, open('assert_fail_tpe_637.pkl', 'w'))
             assert 0, 'non-unique docid, dumped to assert_fail_tpe_637.pkl'
@@ -870,7 +869,8 @@ class TreeParzenEstimator(BanditAlgo):
 
         miscs_update_idxs_vals(rval_miscs, idxs, vals,
                 idxs_map={fake_ids[0]: new_id},
-                assert_all_vals_used=False)
+                assert_all_vals_used=False,
+                compact=self.compact_miscs)
         rval_docs = trials.new_trial_docs(new_ids,
                 rval_specs, rval_results, rval_miscs)
 
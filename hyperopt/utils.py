@@ -79,7 +79,7 @@ def get_obj(f, argfile=None, argstr=None, args=(), kwargs=None):
     return json_call(f, args=args, kwargs=kwargs)
 
 
-def pmin_sampled(mean, var, n_samples=1000, rng=None):
+def pmin_sampled(mean, var, n_samples=1000, rng=None, chunk_size=None):
     """Probability that each Gaussian-dist R.V. is less than the others
 
     :param vscores: mean vector
@@ -88,17 +88,107 @@ def pmin_sampled(mean, var, n_samples=1000, rng=None):
     This function works by sampling n_samples from every (gaussian) mean distribution,
     and counting up the number of times each element's sample is the best.
 
+    Samples are drawn `chunk_size` at a time (by default, as many as fit
+    in about 1M elements), so memory use does not grow with n_samples.
+    The result does not depend on chunk_size.
     """
     if rng is None:
         rng = numpy.random.RandomState(232342)
-
-    samples = rng.randn(n_samples, len(mean)) * numpy.sqrt(var) + mean
-    winners = (samples.T == samples.min(axis=1)).T
-    wincounts = winners.sum(axis=0)
+    mean = numpy.asarray(mean)
+    std = numpy.sqrt(var)
+    if chunk_size is None:
+        chunk_size = max(1, int(1e6) // max(1, len(mean)))
+
+    wincounts = numpy.zeros(mean.shape, dtype='int64')
+    done = 0
+    while done < n_samples:
+        n = min(chunk_size, n_samples - done)
+        samples = rng.randn(n, len(mean)) * std + mean
+        winners = (samples.T == samples.min(axis=1)).T
+        wincounts += winners.sum(axis=0)
+        done += n
     assert wincounts.shape == mean.shape
     return wincounts.astype('float64') / wincounts.sum()
 
 
+def pmin_analytic(mean, var, n_grid=64, max_grid=2048, chunk_size=None):
+    """Probability that each Gaussian-dist R.V. is less than the others
+
+    :param mean: mean vector
+    :param var: variance vector
+
+    P(X_i is min) = integral of pdf_i(x) * prod_{j != i} (1 - cdf_j(x)) dx,
+    computed by the trapezoid rule on the union of n_grid points spread
+    over +-8 standard deviations of each variable (thinned to at most
+    max_grid points, keeping the density of the union), in log space.
+
+    Variables with 0 variance are point masses: the smallest one(s) win
+    when all the others are larger.
+
+    The work is done `chunk_size` variables at a time (by default, as many
+    as fit in about 1M grid elements).
+    """
+    from scipy.special import log_ndtr
+
+    mean = numpy.asarray(mean, dtype='float64')
+    var = numpy.asarray(var, dtype='float64')
+    assert mean.shape == var.shape and mean.ndim == 1
+    rval = numpy.zeros(len(mean))
+    if len(mean) == 0:
+        return rval
+
+    point = var == 0
+    cont = ~point
+    if point.any():
+        upper = mean[point].min()
+    else:
+        upper = numpy.inf
+    c_mean = mean[cont]
+    c_std = numpy.sqrt(var[cont])
+
+    if len(c_mean):
+        offsets = numpy.linspace(-8, 8, n_grid)
+        grid = (c_mean[:, None] + c_std[:, None] * offsets).ravel()
+        # -- above hi, some variable is almost surely smaller
+        hi = min(upper, (c_mean + 8 * c_std).min())
+        grid = numpy.unique(grid[grid < hi])
+        if len(grid) > max_grid - 1:
+            grid = grid[numpy.linspace(0, len(grid) - 1, max_grid - 1
+                ).astype('int')]
+        grid = numpy.append(grid, [hi])
+        if chunk_size is None:
+            chunk_size = max(1, int(1e6) // len(grid))
+
+        def chunks():
+            for start in xrange(0, len(c_mean), chunk_size):
+                stop = start + chunk_size
+                z = (grid - c_mean[start:stop, None]) / c_std[start:stop, None]
+                yield start, stop, z
+
+        # -- log prod_j (1 - cdf_j(x)) over the grid
+        log_surv = numpy.zeros(len(grid))
+        for start, stop, z in chunks():
+            log_surv += log_ndtr(-z).sum(axis=0)
+
+        c_rval = numpy.zeros(len(c_mean))
+        for start, stop, z in chunks():
+            log_pdf = (-0.5 * z ** 2 - numpy.log(c_std[start:stop, None])
+                    - 0.5 * numpy.log(2 * numpy.pi))
+            integrand = numpy.exp(log_pdf + log_surv - log_ndtr(-z))
+            c_rval[start:stop] = numpy.trapz(integrand, grid, axis=1)
+        rval[cont] = c_rval
+        if point.any():
+            # -- all the continuous variables exceed the smallest point
+            log_p_upper = log_ndtr(-(upper - c_mean) / c_std).sum()
+    else:
+        log_p_upper = 0.0
+
+    if point.any():
+        winners = point & (mean == upper)
+        rval[winners] = numpy.exp(log_p_upper) / winners.sum()
+    return rval / rval.sum()
+
+
 def fast_isin(X,Y):
     """
     Indices of elements in a numpy array that appear in another.
@@ -1,8 +1,13 @@
+import copy
 import sys
 
+import numpy as np
+
 from pyll import Apply
+from pyll import Literal
 from pyll import as_apply
 from pyll import dfs
+from pyll import rec_eval
 from pyll import scope
 from pyll import stochastic
 
@@ -29,6 +34,11 @@ def vchoice_merge(idxs, choices, *vals):
         rval.append(vv[list(vi).index(idx)])
     return rval
 
+@scope.define
+def repeat_copies(n_times, obj):
+    """Return a list of `n_times` deep copies of `obj`"""
+    return [copy.deepcopy(obj) for ii in xrange(n_times)]
+
 @scope.define
 def idxs_map(idxs, cmd, *args, **kwargs):
 
@@ -175,12 +185,58 @@ class VectorizeHelper(object):
                 for arg in node.inputs():
                     self.merge(node_idxs, arg)
 
+    def constant_nodes(self):
+        """Return the set of nodes that have no stochastic ancestors.
+
+        Literals are included. Every other node in the set computes the same
+        value for every sample, so it only has to be evaluated once.
+        """
+        stoch = stochastic.implicit_stochastic_symbols
+        rval = set()
+        for node in self.dfs_nodes:
+            if node.name in stoch or node.name == 'one_of':
+                continue
+            if all(arg in rval for arg in node.inputs()):
+                rval.add(node)
+        return rval
+
+    def constant_roots(self, constants):
+        """Return the maximal sub-graphs of `constants`, by their roots.
+
+        A root is a constant node (not a literal) that is the template
+        itself, or an input of a node that is not constant.
+        """
+        rval = set()
+        if self.expr in constants:
+            rval.add(self.expr)
+        for node in self.dfs_nodes:
+            if node not in constants:
+                rval.update(arg for arg in node.inputs() if arg in constants)
+        return set(node for node in rval if node.name != 'literal')
+
     # -- separate method for testing
-    def build_vals(self):
+    def build_vals(self, fold_constants=False):
+        if fold_constants:
+            roots = self.constant_roots(self.constant_nodes())
+        else:
+            roots = set()
         for node in self.dfs_nodes:
             if node.name == 'literal':
                 n_times = scope.len(self.idxs_memo[node])
                 vnode = scope.asarray(scope.repeat(n_times, node))
+            elif node in roots:
+                # -- deterministic sub-graph: evaluate it once now, and
+                #    give each sample a copy of the value. (The nodes
+                #    within the sub-graph get vals as usual, but the
+                #    samples never evaluate them.)
+                n_times = scope.len(self.idxs_memo[node])
+                value = rec_eval(node)
+                if np.isscalar(value):
+                    vnode = scope.asarray(scope.repeat(n_times,
+                        Literal(value)))
+                else:
+                    # -- a list or dict per sample, not one shared by all
+                    vnode = scope.repeat_copies(n_times, Literal(value))
             elif node in self.choice_memo:
                 # -- choices are natively vectorized
                 choices = self.choice_memo[node]